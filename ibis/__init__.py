@@ -203,6 +203,23 @@ def scalar_function(inputs, output, name=None):
     return udf.scalar_function(inputs, output, name=name)
 
 
+def python_udf(inputs, output, name=None):
+    """
+    Decorator creating a vectorized Python scalar UDF, called by Ibis workers
+    once per batch of rows with NumPy arrays
+
+    Parameters:
+    inputs: list of strings denoting ibis datatypes
+    output: string denoting ibis datatype
+    name: string (optional). Defaults to the function name
+
+    Returns
+    -------
+    decorator returning a PythonUDFInfo
+    """
+    return udf.python_udf(inputs, output, name=name)
+
+
 def add_impala_operation(op, name, database):
     """
     Registers the given operation within the Ibis
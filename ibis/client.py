@@ -31,6 +31,7 @@ from ibis.filesystems import HDFS, WebHDFS
 import ibis.common as com
 import ibis.expr.types as ir
 import ibis.expr.operations as ops
+from ibis.sql.pipeline import QueryPipeline
 import ibis.sql.compiler as sql
 import ibis.sql.ddl as ddl
 import ibis.sql.udf as udf
@@ -149,22 +150,37 @@ LIMIT 0""".format(query)
 
         """
         ast = self._build_ast_ensure_limit(expr, limit)
+        return self._execute_pipeline(ast)
 
-        # TODO: create some query pipeline executor abstraction
-        output = None
-        for query in ast.queries:
-            sql_string = query.compile()
+    def _execute_pipeline(self, ast, main=None):
+        # Setup statements, then main (by default the queries), then
+        # teardown statements
+        pipeline = QueryPipeline(self, ast)
+        try:
+            return pipeline.execute(main)
+        finally:
+            if options.verbose:
+                (options.verbose_log or to_stdout)(
+                    'Pipeline timings: {0}'.format(pipeline.format_timings()))
+
+    def _execute_query(self, query):
+        sql_string = query.compile()
+
+        with self._execute(sql_string, results=True) as cur:
+            result = self._fetch_from_cursor(cur)
 
-            with self._execute(sql_string, results=True) as cur:
-                result = self._fetch_from_cursor(cur)
+        if isinstance(query, ddl.Select):
+            if query.result_handler is not None:
+                result = query.result_handler(result)
 
-            if isinstance(query, ddl.Select):
-                if query.result_handler is not None:
-                    result = query.result_handler(result)
+        return result
 
-                output = result
+    def _ensure_temp_db_exists(self):
+        pass
 
-        return output
+    def _execute_with_setup(self, ast, statement):
+        # A statement built on the AST's result query (e.g. CTAS or INSERT)
+        self._execute_pipeline(ast, lambda: self._execute(statement))
 
     def _build_ast_ensure_limit(self, expr, limit):
         ast = sql.build_ast(expr)
@@ -293,12 +309,18 @@ class ImpalaConnection(object):
                 cur.disable_codegen(self.codegen_disabled)
             return cur
         except Queue.Empty:
-            if self.connection_pool_size < self.max_pool_size:
-                cursor = self._new_cursor()
+            # Queries may run in several threads (see QueryPipeline)
+            with self.lock:
+                if self.connection_pool_size >= self.max_pool_size:
+                    raise com.InternalError('Too many concurrent / hung '
+                                            'queries')
                 self.connection_pool_size += 1
-                return cursor
-            else:
-                raise com.InternalError('Too many concurrent / hung queries')
+            try:
+                return self._new_cursor()
+            except:
+                with self.lock:
+                    self.connection_pool_size -= 1
+                raise
 
     def _new_cursor(self):
         params = self.params.copy()
@@ -355,6 +377,9 @@ class ImpalaCursor(object):
     def fetchall(self):
         return self.cursor.fetchall()
 
+    def fetchmany(self, size):
+        return self.cursor.fetchmany(size)
+
 
 class ImpalaClient(SQLClient):
 
@@ -680,6 +705,9 @@ class ImpalaClient(SQLClient):
         database : string, default None
         """
         ast = sql.build_ast(expr)
+        if ast.setup_queries:
+            raise com.IbisError('Views cannot depend on materialized '
+                                'subqueries')
         select = ast.queries[0]
         statement = ddl.CreateView(name, select, database=database)
         self._execute(statement)
@@ -735,6 +763,7 @@ class ImpalaClient(SQLClient):
         if like_parquet is not None:
             raise NotImplementedError
 
+        ast = None
         if expr is not None:
             ast = sql.build_ast(expr)
             select = ast.queries[0]
@@ -761,7 +790,10 @@ class ImpalaClient(SQLClient):
         else:
             raise com.IbisError('Must pass expr or schema')
 
-        self._execute(statement)
+        if ast is not None:
+            self._execute_with_setup(ast, statement)
+        else:
+            self._execute(statement)
 
     def pandas(self, df, name=None, database=None, persist=False):
         """
@@ -1007,7 +1039,7 @@ class ImpalaClient(SQLClient):
         statement = ddl.InsertSelect(table_name, select,
                                      database=database,
                                      overwrite=overwrite)
-        self._execute(statement)
+        self._execute_with_setup(ast, statement)
 
     def drop_table(self, table_name, database=None, force=False):
         """
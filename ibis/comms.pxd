@@ -16,6 +16,7 @@ from libc.stdint cimport (int8_t, int16_t, int32_t, int64_t,
                           uint8_t, uint16_t, uint32_t, uint64_t)
 
 from posix.time cimport timespec, time_t
+from posix.types cimport mode_t
 from posix.unistd cimport off_t
 
 cdef extern from "ipc_support.h" nogil:
@@ -24,8 +25,16 @@ cdef extern from "ipc_support.h" nogil:
     int semarray_exists(int sem_id)
     int semarray_delete(int sem_id)
 
-    int semarray_lock(int sem_id, int i, timespec* timeout)
-    int semarray_unlock(int sem_id, int i, timespec* timeout)
+    int semarray_lock(int sem_id, int i, timespec* timeout, int undo)
+    int semarray_unlock(int sem_id, int i, timespec* timeout, int undo)
+
+    int shmflag_supported()
+    void shmflag_init(uint32_t* flag, uint32_t value)
+    int shmflag_lock(uint32_t* flag, int spin_count, timespec* timeout)
+    int shmflag_unlock(uint32_t* flag)
+
+    enum:
+        MAP_POPULATE
 
 
 cdef extern from "sys/mman.h" nogil:
@@ -34,9 +43,24 @@ cdef extern from "sys/mman.h" nogil:
         PROT_READ
         PROT_WRITE
 
+    void* MAP_FAILED
+
     void* mmap(void* addr, size_t length, int prot, int flags, int fd,
                off_t offset)
 
+    enum:
+        MADV_NORMAL
+        MADV_RANDOM
+        MADV_SEQUENTIAL
+        MADV_WILLNEED
+        MADV_DONTNEED
+
+    int madvise(void* addr, size_t length, int advice)
+
+    # POSIX shared memory objects (/dev/shm on Linux)
+    int shm_open(const char* name, int oflag, mode_t mode)
+    int shm_unlink(const char* name)
+
     int munmap(void* addr, size_t length)
 
     enum:
@@ -56,9 +80,15 @@ cdef class BufferLike:
         int pos
         size_t size
 
+        # Buffer protocol (PEP 3118) bookkeeping
+        int exports
+        Py_ssize_t shape[1]
+        Py_ssize_t strides[1]
+
     cdef readonly:
         bint closed
 
+    cdef uint8_t* get_data(self) nogil
     cdef uint8_t* get_buffer(self) nogil
 
 
@@ -68,9 +98,14 @@ cdef class SharedMmap(BufferLike):
         int fd
         uint8_t* buf
         off_t offset
-        object location
         object file_handle
 
+    cdef readonly:
+        object location
+
+        # POSIX shared memory object rather than a file
+        bint shm
+
 
 cdef class IPCLock:
     cdef readonly:
@@ -79,6 +114,7 @@ cdef class IPCLock:
         # TODO: is more timeout granularity than milliseconds needed?
         int timeout_ms
         bint is_slave
+        bint undo
 
     cdef create(self)
     cdef _check_semop_status(self, int ret)
@@ -87,6 +123,22 @@ cdef class IPCLock:
     cdef void set_timeout(self, timespec* timeout) nogil
 
 
+cdef class SharedMemoryLock:
+    cdef readonly:
+        size_t offset
+        int spin_count
+        int timeout_ms
+        bint is_slave
+
+    cdef:
+        # Keep the memory holding the flags alive
+        BufferLike container
+        uint32_t* flags
+
+    cdef _check_status(self, int ret)
+    cdef void set_timeout(self, timespec* timeout) nogil
+
+
 #----------------------------------------------------------------------
 # Serialization / deserialization
 
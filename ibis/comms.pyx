@@ -23,6 +23,8 @@
 from libc.errno cimport *
 from libc.stdlib cimport free, malloc, realloc
 from libc.string cimport memcpy, memcmp
+from posix.fcntl cimport O_CREAT, O_RDWR
+from posix.unistd cimport ftruncate
 
 from comms cimport *
 
@@ -30,13 +32,22 @@ from numpy cimport ndarray
 cimport numpy as cnp
 
 cimport cpython as cp
+from cpython.buffer cimport (PyObject_GetBuffer, PyBuffer_Release,
+                             PyBUF_SIMPLE, PyBUF_WRITABLE, PyBUF_FORMAT,
+                             PyBUF_ND, PyBUF_STRIDES)
 from cython.operator cimport (dereference as deref,
                               preincrement as preinc,
                               predecrement as predec)
 cimport cython
 
+from collections import OrderedDict
+import multiprocessing
 import numpy as np
 import os
+import threading
+import time
+
+import ibis.expr.types as ir
 
 cnp.import_array()
 
@@ -61,12 +72,21 @@ cdef class IPCLock:
     Has a flag is_slave so that we can masquerade as the master (or slave) for
     testing purposes. When creating a non-slave, the "other" process lock
     starts off in unlocked state.
+
+    Semaphore operations are made with SEM_UNDO unless undo=False, so the
+    kernel reverts them when the process exits. A process that exits while
+    the other side is still using the semaphores (e.g. a recycled pool
+    worker) must pass undo=False, or its last handoff is taken back.
+
+    See SharedMemoryLock for an alternative that avoids the system call on
+    each handoff.
     """
 
     def __cinit__(self, semaphore_id=None, int lock_timeout_ms=1,
-                  bint is_slave=1):
+                  bint is_slave=1, bint undo=1):
         self.timeout_ms = lock_timeout_ms
         self.is_slave = is_slave
+        self.undo = undo
 
         if not is_slave:
             self.create()
@@ -111,11 +131,11 @@ cdef class IPCLock:
         with nogil:
             if block:
                 ret = semarray_lock(self.semaphore_id, self._our_sem_slot(),
-                                    NULL)
+                                    NULL, self.undo)
             else:
                 self.set_timeout(&timeout)
                 ret = semarray_lock(self.semaphore_id,
-                                    self._our_sem_slot(), &timeout)
+                                    self._our_sem_slot(), &timeout, self.undo)
 
         return self._check_semop_status(ret)
 
@@ -128,11 +148,13 @@ cdef class IPCLock:
         with nogil:
             if block:
                 ret = semarray_unlock(self.semaphore_id,
-                                      self._their_sem_slot(), NULL)
+                                      self._their_sem_slot(), NULL,
+                                      self.undo)
             else:
                 self.set_timeout(&timeout)
                 ret = semarray_unlock(self.semaphore_id,
-                                      self._their_sem_slot(), &timeout)
+                                      self._their_sem_slot(), &timeout,
+                                      self.undo)
 
         return self._check_semop_status(ret)
 
@@ -151,18 +173,206 @@ cdef class IPCLock:
         return 1 if self.is_slave else 0
 
     cdef void set_timeout(self, timespec* timeout) nogil:
-        timeout.tv_sec = 0
-        timeout.tv_nsec = self.timeout_ms * 1000000
+        timeout.tv_sec = self.timeout_ms // 1000
+        timeout.tv_nsec = (self.timeout_ms % 1000) * 1000000
+
+
+# Space reserved in a shared memory region by SharedMemoryLock
+SHARED_LOCK_SIZE = 8
+
+HAVE_SHARED_MEMORY_LOCK = bool(shmflag_supported())
+
+# Spinning only pays off if the other process can run at the same time
+DEFAULT_SPIN_COUNT = 1000 if multiprocessing.cpu_count() > 1 else 0
+
+
+cdef class SharedMemoryLock:
+    """
+    Alternative to IPCLock whose state lives in the shared memory region
+    itself (two 4-byte flags at the indicated offset, SHARED_LOCK_SIZE bytes
+    in total) rather than in a SysV semaphore set. Acquiring spins for a short
+    while on an atomic flag before sleeping on a futex, so a handoff between
+    two busy processes usually costs no system calls at all. Linux only; see
+    make_ipc_lock for falling back to IPCLock elsewhere.
+
+    Uses the same "my turn, your turn" protocol and is_slave convention as
+    IPCLock. The master initializes the flags, so it must be created before
+    the slave starts using the region.
+    """
+
+    def __cinit__(self, BufferLike container, size_t offset=0,
+                  int lock_timeout_ms=1, bint is_slave=1,
+                  spin_count=None):
+        cdef uint8_t* base
+
+        if not HAVE_SHARED_MEMORY_LOCK:
+            raise NotImplementedError('Shared memory locks require futex '
+                                      'support (Linux)')
+
+        if offset + SHARED_LOCK_SIZE > container.size:
+            raise ValueError('Lock does not fit in buffer of size %d'
+                             % container.size)
+
+        base = container.get_data() + offset
+        if <size_t> base % 4 != 0:
+            raise ValueError('Lock offset must be 4-byte aligned')
+
+        self.container = container
+        self.offset = offset
+        self.flags = <uint32_t*> base
+        self.timeout_ms = lock_timeout_ms
+        self.is_slave = is_slave
+        if spin_count is None:
+            spin_count = DEFAULT_SPIN_COUNT
+        self.spin_count = spin_count
+
+        if not is_slave:
+            # Our turn is locked, the other process may go ahead
+            shmflag_init(self.flags + 1, 0)
+            shmflag_init(self.flags, 1)
+
+    def __repr__(self):
+        return ('SharedMemoryLock(offset=%d, is_slave=%s)'
+                % (self.offset, bool(self.is_slave)))
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, type, value, tb):
+        self.release()
+
+    def acquire(self, bint block=1):
+        """
+        Returns True on success, False on failure with timeout. Otherwise
+        Exception is raised for other failures.
+        """
+        cdef:
+            timespec timeout
+            uint32_t* flag = self.flags + (0 if self.is_slave else 1)
+            int ret
+
+        with nogil:
+            if block:
+                ret = shmflag_lock(flag, self.spin_count, NULL)
+            else:
+                self.set_timeout(&timeout)
+                ret = shmflag_lock(flag, self.spin_count, &timeout)
+
+        return self._check_status(ret)
+
+    def release(self, bint block=1):
+        # Releasing never waits, block is accepted for IPCLock compatibility
+        cdef:
+            uint32_t* flag = self.flags + (1 if self.is_slave else 0)
+            int ret
+
+        with nogil:
+            ret = shmflag_unlock(flag)
+
+        return self._check_status(ret)
+
+    cdef _check_status(self, int ret):
+        if ret == -1:
+            if errno == EAGAIN:
+                return False
+            raise OSError(errno, os.strerror(errno))
+        else:
+            return True
+
+    cdef void set_timeout(self, timespec* timeout) nogil:
+        timeout.tv_sec = self.timeout_ms // 1000
+        timeout.tv_nsec = (self.timeout_ms % 1000) * 1000000
+
+
+def make_ipc_lock(BufferLike container=None, size_t offset=0,
+                  semaphore_id=None, int lock_timeout_ms=1,
+                  bint is_slave=1):
+    """
+    Create a SharedMemoryLock in the passed region if the platform supports
+    it, otherwise fall back on an IPCLock using SysV semaphores.
+
+    Parameters
+    ----------
+    container : BufferLike, optional
+      Memory shared by both processes, with SHARED_LOCK_SIZE bytes reserved
+      at offset for the lock
+    offset : int, default 0
+    semaphore_id : int, optional
+      Existing semaphore set to use if falling back on IPCLock as a slave
+    lock_timeout_ms : int, default 1
+    is_slave : boolean, default True
+
+    Returns
+    -------
+    lock : SharedMemoryLock or IPCLock
+    """
+    if container is not None and HAVE_SHARED_MEMORY_LOCK:
+        return SharedMemoryLock(container, offset=offset,
+                                lock_timeout_ms=lock_timeout_ms,
+                                is_slave=is_slave)
+    return IPCLock(semaphore_id, lock_timeout_ms=lock_timeout_ms,
+                   is_slave=is_slave)
 
 
 cdef class BufferLike:
+    """
+    Superclass for data that is accessible in our virtual address space.
+    Supports the (PEP 3118) buffer protocol, so memoryview, numpy.asarray,
+    struct.unpack_from and so forth can work on the memory without copying
+    it.
+
+    The old-style Python 2 segment interface is deliberately not provided:
+    its consumers (e.g. numpy.frombuffer on Python 2) never release their
+    pointers, so SharedMmap.close could not tell they are still in use.
+    """
 
     def __len__(self):
         return self.size
 
-    cdef uint8_t* get_buffer(self) nogil:
+    cdef uint8_t* get_data(self) nogil:
+        # Start of the memory region
         return NULL
 
+    cdef uint8_t* get_buffer(self) nogil:
+        # Current position in the memory region
+        return self.get_data() + self.pos
+
+    def __getbuffer__(self, Py_buffer* buffer, int flags):
+        self._raise_if_closed()
+
+        self.shape[0] = self.size
+        self.strides[0] = 1
+
+        buffer.buf = <void*> self.get_data()
+        buffer.obj = self
+        buffer.len = self.size
+        buffer.readonly = 0
+        buffer.itemsize = 1
+        buffer.format = NULL
+        if flags & PyBUF_FORMAT:
+            buffer.format = 'B'
+        buffer.ndim = 1
+        buffer.shape = NULL
+        if flags & PyBUF_ND:
+            buffer.shape = self.shape
+        buffer.strides = NULL
+        if flags & PyBUF_STRIDES:
+            buffer.strides = self.strides
+        buffer.suboffsets = NULL
+        buffer.internal = NULL
+
+        self.exports += 1
+
+    def __releasebuffer__(self, Py_buffer* buffer):
+        self.exports -= 1
+
+    def __getitem__(self, key):
+        """
+        Slicing returns a memoryview on the underlying memory (no copy)
+        """
+        return memoryview(self)[key]
+
     def read(self, int nbytes=-1):
         self._raise_if_closed()
 
@@ -177,6 +387,42 @@ cdef class BufferLike:
 
         return result
 
+    def read_view(self, int nbytes=-1):
+        """
+        Like read, but return a memoryview on the underlying memory rather
+        than a copy of the bytes
+        """
+        self._raise_if_closed()
+
+        if (nbytes < 0) or nbytes > (self.size - self.pos):
+            nbytes = self.size - self.pos
+
+        result = memoryview(self)[self.pos:self.pos + nbytes]
+        self.pos += nbytes
+        return result
+
+    def readinto(self, b):
+        """
+        Read bytes into a pre-allocated writable buffer (e.g. bytearray or
+        NumPy array), returning the number of bytes read
+        """
+        cdef:
+            Py_buffer view
+            size_t nbytes
+
+        self._raise_if_closed()
+
+        PyObject_GetBuffer(b, &view, PyBUF_SIMPLE | PyBUF_WRITABLE)
+        try:
+            nbytes = min(<size_t> view.len, self.size - self.pos)
+            with nogil:
+                memcpy(view.buf, self.get_buffer(), nbytes)
+        finally:
+            PyBuffer_Release(&view)
+
+        self.pos += nbytes
+        return nbytes
+
     def write(self, object s):
         """
         Write UTF8 encoded bytes to the memory map
@@ -193,10 +439,15 @@ cdef class BufferLike:
 
         self.pos += length
 
+    def tell(self):
+        self._raise_if_closed()
+        return self.pos
+
     def seek(self, int where):
         self._raise_if_closed()
 
-        if where < 0 or where >= self.size:
+        # The end is a valid position, e.g. after reading everything
+        if where < 0 or where > self.size:
             raise IOError('Position out of bounds')
 
         self.pos = where
@@ -219,8 +470,8 @@ cdef class RAMBuffer(BufferLike):
         if self.buf != NULL:
             free(self.buf)
 
-    cdef uint8_t* get_buffer(self) nogil:
-        return self.buf + self.pos
+    cdef uint8_t* get_data(self) nogil:
+        return self.buf
 
 
 cdef class SharedMmap(BufferLike):
@@ -230,34 +481,69 @@ cdef class SharedMmap(BufferLike):
     can be treated as a file-like object by pure Python code.
     """
 
-    def __cinit__(self, location, size, offset=0, create=False):
+    def __cinit__(self, location, size, offset=0, create=False, shm=False,
+                  populate=False):
+        """
+        Parameters
+        ----------
+        location : string
+          File path, or POSIX shared memory object name if shm=True
+        size : int
+        offset : int, default 0
+        create : boolean, default False
+          Create (and size) the file or shared memory object if it does not
+          exist
+        shm : boolean, default False
+          Open location with shm_open rather than as a file
+        populate : boolean, default False
+          Prefault the pages of the mapping (MAP_POPULATE, Linux only) so
+          that the first touches do not each take a page fault
+        """
+        cdef:
+            int fd
+            int flags = MAP_SHARED
+            int err
+
+        self.closed = 1
+        self.fd = -1
         self.location = location
         self.size = size
         self.offset = offset
+        self.shm = shm
 
-        if not os.path.exists(self.location):
-            if not create:
-                # Don't create the file if it's not there already
-                raise IOError('%s does not exist' % self.location)
-            elif offset != 0:
-                raise IOError('File does not exist; nonzero offset invalid')
-
-            # Create the file and truncate to indicated size
-            self.file_handle = open(self.location, 'wb+')
-            self.file_handle.truncate(size)
+        if shm:
+            self.fd = _open_shm(location, size, offset, create)
+            fd = self.fd
         else:
-            self.file_handle = open(self.location, 'rb+')
+            if not os.path.exists(self.location):
+                if not create:
+                    # Don't create the file if it's not there already
+                    raise IOError('%s does not exist' % self.location)
+                elif offset != 0:
+                    raise IOError('File does not exist; nonzero offset '
+                                  'invalid')
+
+                # Create the file and truncate to indicated size
+                self.file_handle = open(self.location, 'wb+')
+                self.file_handle.truncate(size)
+            else:
+                self.file_handle = open(self.location, 'rb+')
+            fd = self.file_handle.fileno()
+
+        if populate:
+            flags |= MAP_POPULATE
 
         # Memory-map the file, raise on failure
-        cdef int fd = self.file_handle.fileno()
         with nogil:
             self.buf = <uint8_t*> mmap(NULL, self.size, PROT_READ | PROT_WRITE,
-                                       MAP_SHARED, fd, self.offset)
+                                       flags, fd, self.offset)
 
-        if self.buf == NULL:
-            # TODO: check various errno failure conditions, raise a more
-            # informative exception
-            raise Exception('Memory mapping failed')
+        if self.buf == <uint8_t*> MAP_FAILED:
+            err = errno
+            self.buf = NULL
+            self._close_handle()
+            raise OSError(err, 'Memory mapping %s failed: %s'
+                          % (self.location, os.strerror(err)))
 
         self.closed = 0
 
@@ -267,8 +553,8 @@ cdef class SharedMmap(BufferLike):
     def __dealloc__(self):
         self.close()
 
-    cdef uint8_t* get_buffer(self) nogil:
-        return self.buf + self.pos
+    cdef uint8_t* get_data(self) nogil:
+        return self.buf
 
     def __repr__(self):
         return ('SharedMmap(%s, size=%d, offset=%d)' %
@@ -278,18 +564,42 @@ cdef class SharedMmap(BufferLike):
         if self.closed:
             return
 
+        if self.exports > 0:
+            raise BufferError('cannot close, exported buffers exist')
+
         with nogil:
             munmap(<void*> self.buf, self.size)
+        self._close_handle()
+
+        self.closed = 1
+
+    def _close_handle(self):
+        if self.shm:
+            if self.fd != -1:
+                os.close(self.fd)
+                self.fd = -1
+            return
+
         try:
             self.file_handle.close()
         except:
             pass
 
-        self.closed = 1
+    def advise(self, hint):
+        """
+        Tell the kernel how the mapped memory will be used (see madvise(2)).
+        Purely advisory; failures are ignored
+
+        Parameters
+        ----------
+        hint : {'normal', 'random', 'sequential', 'willneed', 'dontneed'}
+        """
+        cdef int advice = _madvise_hints[hint]
 
-    def tell(self):
         self._raise_if_closed()
-        return self.pos
+
+        with nogil:
+            madvise(<void*> self.buf, self.size, advice)
 
     def flush(self):
         cdef int ret
@@ -306,37 +616,288 @@ cdef class SharedMmap(BufferLike):
             raise IOError('File is closed')
 
 
+_madvise_hints = {
+    'normal': MADV_NORMAL,
+    'random': MADV_RANDOM,
+    'sequential': MADV_SEQUENTIAL,
+    'willneed': MADV_WILLNEED,
+    'dontneed': MADV_DONTNEED
+}
+
+
+cdef int _open_shm(location, size_t size, off_t offset, bint create) except -1:
+    cdef:
+        bytes name = (location if isinstance(location, bytes)
+                      else location.encode('utf-8'))
+        int fd
+
+    fd = shm_open(name, O_RDWR, 0600)
+    if fd != -1:
+        return fd
+
+    if errno != ENOENT:
+        raise OSError(errno, os.strerror(errno))
+    if not create:
+        raise IOError('%s does not exist' % location)
+    if offset != 0:
+        raise IOError('Shared memory does not exist; nonzero offset invalid')
+
+    fd = shm_open(name, O_RDWR | O_CREAT, 0600)
+    if fd == -1 or ftruncate(fd, size) == -1:
+        err = errno
+        if fd != -1:
+            os.close(fd)
+        raise OSError(err, os.strerror(err))
+
+    return fd
+
+
+def unlink_shm(name):
+    """
+    Remove a POSIX shared memory object. Existing mappings of it stay valid
+    """
+    if not isinstance(name, bytes):
+        name = name.encode('utf-8')
+
+    if shm_unlink(name) == -1:
+        raise OSError(errno, os.strerror(errno))
+
+
+def is_shm_name(name):
+    """
+    POSIX shared memory object names have a single leading slash (e.g.
+    /ibis-1234); anything else is treated as a file path
+    """
+    return name.startswith('/') and '/' not in name[1:]
+
+
+def _segment_identity(name):
+    # Lets us notice that a name refers to a new file or shared memory object
+    # since we mapped it. None if we can't tell
+    if is_shm_name(name):
+        path = '/dev/shm' + name
+    else:
+        path = name
+
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_dev, st.st_ino
+
+
+class SegmentPool(object):
+    """
+    Keeps shared memory mappings open across tasks, handing out a mapping of
+    the same (name, size, offset) again once it has been released rather
+    than opening and mapping it anew (and taking page faults on it) each
+    time. Names with a single leading slash are POSIX shared memory objects
+    (/dev/shm on Linux), anything else is a file path.
+
+    Reuse only pays off when producers hand out the same segment names again;
+    a mapping whose name has been unlinked or recreated as a different file
+    or shared memory object is closed as soon as that is noticed (on release
+    and in reclaim). Otherwise released mappings are closed once they have
+    been idle for more than max_idle seconds, or when more than
+    max_idle_segments are idle. Long-lived owners should call reclaim
+    periodically (e.g. from an idle loop) so that mappings do not outlive
+    their use when no tasks arrive.
+
+    Parameters
+    ----------
+    max_idle : float, default 60
+      Seconds
+    max_idle_segments : int, default 64
+    populate_threshold : int, default 16MB
+      Segments at least this large are prefaulted when mapped, and the
+      kernel is told that they will be needed
+    """
+
+    def __init__(self, max_idle=60, max_idle_segments=64,
+                 populate_threshold=16 << 20):
+        self.max_idle = max_idle
+        self.max_idle_segments = max_idle_segments
+        self.populate_threshold = populate_threshold
+
+        # (name, size, offset) -> list of (mapping, identity, released time)
+        self._idle = {}
+        self._nidle = 0
+
+        # mapping -> ((name, size, offset), identity)
+        self._in_use = {}
+
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return self._nidle + len(self._in_use)
+
+    def get(self, name, size, offset=0, create=False):
+        """
+        Returns
+        -------
+        mapping : SharedMmap
+          Positioned at the start of the segment. Hand it back with release
+          once done
+        """
+        key = (name, size, offset)
+        identity = _segment_identity(name)
+
+        with self._lock:
+            self._reclaim(time.time())
+
+            entries = self._idle.get(key)
+            while entries:
+                mm, mm_identity, _ = entries.pop()
+                self._nidle -= 1
+
+                if mm_identity != identity or mm.closed:
+                    mm.close()
+                    continue
+
+                self._in_use[mm] = key, identity
+                self.hits += 1
+                mm.seek(0)
+                return mm
+
+            self.misses += 1
+
+        mm = self._map(name, size, offset, create)
+
+        with self._lock:
+            if create:
+                identity = _segment_identity(name)
+            self._in_use[mm] = key, identity
+
+        return mm
+
+    def _map(self, name, size, offset, create):
+        populate = size >= self.populate_threshold
+        mm = SharedMmap(name, size, offset=offset, create=create,
+                        shm=is_shm_name(name), populate=populate)
+        if populate:
+            mm.advise('willneed')
+        return mm
+
+    def release(self, mm):
+        """
+        Return a mapping obtained from get to the pool for reuse
+        """
+        with self._lock:
+            try:
+                key, identity = self._in_use.pop(mm)
+            except KeyError:
+                raise ValueError('%r was not obtained from this pool' % mm)
+
+        if mm.closed:
+            return
+
+        if _segment_identity(key[0]) != identity:
+            # Unlinked or replaced, so it can never be handed out again
+            mm.close()
+            return
+
+        with self._lock:
+            self._idle.setdefault(key, []).append((mm, identity,
+                                                   time.time()))
+            self._nidle += 1
+            self._reclaim(time.time())
+
+    def reclaim(self, max_idle=None):
+        """
+        Close idle mappings which have not been used in max_idle seconds
+        (defaults to the pool setting), or whose name has been unlinked or
+        recreated since
+        """
+        with self._lock:
+            self._reclaim(time.time(), max_idle, check_identity=True)
+
+    def clear(self):
+        """
+        Close all idle mappings
+        """
+        self.reclaim(max_idle=-1)
+
+    def _reclaim(self, now, max_idle=None, check_identity=False):
+        if max_idle is None:
+            max_idle = self.max_idle
+
+        entries = []
+        for key, segments in self._idle.items():
+            for mm, identity, released in segments:
+                entries.append((released, key, mm, identity))
+
+        # Oldest first
+        entries.sort(key=lambda x: x[0])
+        nexcess = len(entries) - self.max_idle_segments
+
+        self._idle = {}
+        self._nidle = 0
+        for i, (released, key, mm, identity) in enumerate(entries):
+            if (i < nexcess or now - released > max_idle or
+                    (check_identity and
+                     _segment_identity(key[0]) != identity)):
+                mm.close()
+            else:
+                self._idle.setdefault(key, []).append((mm, identity,
+                                                       released))
+                self._nidle += 1
+
+
 #----------------------------------------------------------------------
 # Read and write tables with as little copying as possible (preferably nearly
 # zero in the case of primitive types) from the binary format delivered by
 # Impala.
 #
-# TODO: is endianness ever a concern?
-# TODO: do we care about the column names? Adds complexity
-#
-# OMITTED FOR NOW
-# uint32_t*
-#   name offsets (K + 1 of them)
-# char*
-#   column names (no null terminators)
-#
-# Version 1 of binary table layout
+# Version 2 of binary table layout (current)
 #
 # uint32_t
-#   M magic number
+#   M magic number (IBIS_TABLE_MAGIC_UINT32)
+# uint16_t
+#   V format version the writer used
+# uint16_t
+#   R oldest reader version able to read the table. Writers only raise this
+#   for breaking changes; readers must accept any table with R no newer
+#   than themselves, whatever V is
+# uint8_t
+#   E endianness of all the integers in the blob (0 little, 1 big)
+# uint8_t
+#   F Column format
+# uint16_t
+#   D column descriptor size in bytes (at least 8)
 # uint32_t
 #   K number of columns
 # uint64_t
 #   table length
-# uint8_t*
-#   T column dtype codes
-# uint32_t*
-#   O byte offsets (K + 1 offsets, so we have an exact length for each)
-# uint8_t
-#   F Column format
+# uint32_t
+#   H header size: byte offset of the first column block
+# uint32_t
+#   P byte offset of the first column descriptor
+#
+# Readers must use H, P and D rather than computing them, so that newer
+# writers can append fields to the fixed header and to each descriptor
+# without breaking older readers (which ignore the fields they don't know).
+#
+# COLUMN_DESCRIPTOR* (K of them, D bytes each)
+#   uint8_t dtype code
+#   uint8_t encoding code (plain, dictionary, RLE, bitmap)
+#   uint8_t precision (DECIMAL only, otherwise 0)
+#   uint8_t scale (DECIMAL only, otherwise 0)
+#   uint32_t byte length of the column name
+# uint64_t*
+#   O byte offsets relative to the first column block (K + 1 offsets)
+# char*
+#   column names (UTF8, no null terminators)
+# (padding so that the column blocks start at an 8-byte boundary)
 # COLUMN* array of column blocks
 # INTERN_TABLE
-#   All strings refer to a master array of strings at the end of the blob
+#
+# Since every column has an explicit offset, readers can skip columns whose
+# type or encoding they don't understand and still read the others.
+#
+# Version 1 of binary table layout (no version field, still readable)
 #
 # The most general column format looks like the following:
 # uint8_t*
@@ -383,12 +944,41 @@ NPY_O = np.dtype('O')
 
 cdef uint32_t IMPALA_MAGIC_UINT32 = 1337959792
 
+# The version 1 layout has no version field, so versioned tables are marked
+# with a different magic number
+cdef uint32_t IBIS_TABLE_MAGIC_UINT32 = 1229081938
+
+# Newest table format version we can read and write
+cdef uint16_t TABLE_FORMAT_VERSION = 2
+
+# Version written unless asked otherwise. Stays at 1 until deployed workers,
+# which only read version 1 tables, have been upgraded
+DEFAULT_TABLE_VERSION = 1
+
+cdef uint8_t ENDIAN_LITTLE = 0
+cdef uint8_t ENDIAN_BIG = 1
+
+cdef uint16_t _endian_probe = 1
+cdef uint8_t NATIVE_ENDIANNESS = (
+    ENDIAN_LITTLE if (<uint8_t*> &_endian_probe)[0] == 1 else ENDIAN_BIG)
+
+# Fixed part of the version 2 header, and size of a column descriptor
+cdef size_t TABLE_HEADER_V2_SIZE = 32
+cdef size_t COLUMN_DESCRIPTOR_SIZE = 8
+
 # Only implementing the first type for now
 cdef uint8_t FORMAT_MASKED = 0
 cdef uint8_t FORMAT_PANDAS = 1
 
 # cdef uint8_t FORMAT_BADGER = 2
 
+# Per-column data encodings. Only plain encoding can be read or written for
+# now, the other codes are reserved so that writers and readers agree on them
+ENCODING_PLAIN = 0
+ENCODING_DICTIONARY = 1
+ENCODING_RLE = 2
+ENCODING_BITMAP = 3
+
 
 # Enum-like class, for use on the Python side
 cdef class IbisType:
@@ -432,9 +1022,21 @@ _ibis_stride = {
     IbisType.BIGINT: 8,
     IbisType.FLOAT: 4,
     IbisType.DOUBLE: 8,
+    IbisType.DECIMAL: 8,  # HACK, delivered as doubles for now
     IbisType.STRING: 1
 }
 
+# Ibis schema type names which can be written to masked format columns
+_type_name_to_ibis = {
+    'boolean': IbisType.BOOLEAN,
+    'int8': IbisType.TINYINT,
+    'int16': IbisType.SMALLINT,
+    'int32': IbisType.INT,
+    'int64': IbisType.BIGINT,
+    'float': IbisType.FLOAT,
+    'double': IbisType.DOUBLE
+}
+
 cdef inline int type_to_stride(int dtype) except -1:
     return _ibis_stride[dtype]
 
@@ -562,75 +1164,309 @@ cdef class InternTable:
 
 cdef class IbisTableReader:
     """
-
+    Reads tables in the Ibis binary format (versions 1 and 2) without copying
+    the column data
     """
     cdef readonly:
         int ncolumns
         uint64_t length
+        int version
 
     cdef:
         uint8_t* buf
         size_t bufsize
 
+        # Keep the memory we read from alive
+        BufferLike container
+
         uint8_t* dtypes
-        uint32_t* col_offsets
+        uint8_t* encodings
+        uint8_t* precisions
+        uint8_t* scales
+        uint64_t* col_offsets
         uint8_t table_format
 
+        list _names
+        dict _name_locs
+
         uint8_t* data_start
         InternTable intern_table
 
     def __cinit__(self, BufferLike container, format='numpy'):
+        self.container = container
         self.buf = container.get_buffer()
-        self.bufsize = container.size
+        self.bufsize = container.size - container.pos
+        self.dtypes = self.encodings = self.precisions = self.scales = NULL
+        self.col_offsets = NULL
+
+        if self.bufsize < 4:
+            raise ValueError('Buffer too small to contain a table')
 
         cdef BufferInterface reader = BufferInterface()
         reader.set_buffer(self.buf)
 
         cdef uint32_t magic = reader.read_uint32()
-        if magic != IMPALA_MAGIC_UINT32:
+        if magic == IMPALA_MAGIC_UINT32:
+            self._read_header_v1(reader)
+        elif magic == IBIS_TABLE_MAGIC_UINT32:
+            self._read_header_v2(reader)
+        else:
             raise ValueError('Magic code at start of buffer did not match')
 
+        # Initialize the intern table
+        self.intern_table = None
+
+    def __dealloc__(self):
+        free(self.dtypes)
+        free(self.encodings)
+        free(self.precisions)
+        free(self.scales)
+        free(self.col_offsets)
+
+    cdef _allocate_metadata(self):
+        cdef int k = self.ncolumns
+
+        self.dtypes = <uint8_t*> malloc(k)
+        self.encodings = <uint8_t*> malloc(k)
+        self.precisions = <uint8_t*> malloc(k)
+        self.scales = <uint8_t*> malloc(k)
+        self.col_offsets = <uint64_t*> malloc((k + 1) * sizeof(uint64_t))
+
+        if (self.dtypes == NULL or self.encodings == NULL or
+                self.precisions == NULL or self.scales == NULL or
+                self.col_offsets == NULL):
+            raise MemoryError
+
+    cdef _read_header_v1(self, BufferInterface reader):
+        cdef:
+            int i
+            uint8_t* data
+            uint32_t* offsets
+
+        if self.bufsize < 16:
+            raise ValueError('Buffer too small to contain a table')
+
+        self.version = 1
         self.ncolumns = reader.read_uint32()
         self.length = reader.read_uint64()
 
-        cdef uint8_t* data = self.buf + reader.pos
+        if 16 + 5 * self.ncolumns + 5 > self.bufsize:
+            raise ValueError('Table header is larger than the buffer')
 
-        # TODO: decide if column names are desired
+        self._allocate_metadata()
 
-        # Just the bytes there. Any reason to copy?
-        self.dtypes = data
-        data += self.ncolumns
+        data = self.buf + reader.pos
+        offsets = <uint32_t*> (data + self.ncolumns)
 
-        self.col_offsets = <uint32_t*> data
-        data += 4 * (self.ncolumns + 1)
+        for i in range(self.ncolumns):
+            self.dtypes[i] = data[i]
+            self.encodings[i] = ENCODING_PLAIN
+            self.precisions[i] = self.scales[i] = 0
+            self.col_offsets[i] = offsets[i]
+        self.col_offsets[self.ncolumns] = offsets[self.ncolumns]
 
-        # Validate this?
+        data += self.ncolumns + 4 * (self.ncolumns + 1)
         self.table_format = data[0]
-
         self.data_start = data + 1
 
-        # Initialize the intern table
-        self.intern_table = None
+        # Version 1 tables have no column names
+        self._names = [None] * self.ncolumns
+        self._name_locs = {}
+
+    cdef _read_header_v2(self, BufferInterface reader):
+        cdef:
+            int i
+            uint16_t min_reader_version, descriptor_size
+            uint8_t endianness
+            uint32_t header_size, descriptors_offset, name_length
+            uint8_t* descriptors
+            uint64_t* offsets
+            char* names
+
+        if self.bufsize < TABLE_HEADER_V2_SIZE:
+            raise ValueError('Buffer too small to contain a table')
+
+        self.version = reader.read_uint16()
+        min_reader_version = reader.read_uint16()
+        if min_reader_version > TABLE_FORMAT_VERSION:
+            raise ValueError('Table format version %d requires a reader for '
+                             'version %d or newer, this one reads version %d'
+                             % (self.version, min_reader_version,
+                                TABLE_FORMAT_VERSION))
+
+        endianness = reader.read_uint8()
+        if endianness != NATIVE_ENDIANNESS:
+            raise NotImplementedError('Reading tables with non-native '
+                                      'endianness')
+
+        self.table_format = reader.read_uint8()
+        descriptor_size = reader.read_uint16()
+        self.ncolumns = reader.read_uint32()
+        self.length = reader.read_uint64()
+        header_size = reader.read_uint32()
+        descriptors_offset = reader.read_uint32()
+
+        if (descriptor_size < COLUMN_DESCRIPTOR_SIZE or
+                descriptors_offset < TABLE_HEADER_V2_SIZE):
+            raise ValueError('Invalid table header')
+
+        if header_size > self.bufsize or (
+                descriptors_offset +
+                (<uint64_t> descriptor_size + 8) * self.ncolumns + 8 >
+                header_size):
+            raise ValueError('Invalid table header size %d' % header_size)
+
+        self._allocate_metadata()
+
+        descriptors = self.buf + descriptors_offset
+        offsets = <uint64_t*> (descriptors +
+                               <size_t> descriptor_size * self.ncolumns)
+        names = <char*> (offsets + self.ncolumns + 1)
+
+        self._names = []
+        self._name_locs = {}
+        for i in range(self.ncolumns):
+            self.dtypes[i] = descriptors[0]
+            self.encodings[i] = descriptors[1]
+            self.precisions[i] = descriptors[2]
+            self.scales[i] = descriptors[3]
+            name_length = (<uint32_t*> (descriptors + 4))[0]
+            descriptors += descriptor_size
+
+            if names + name_length > <char*> self.buf + header_size:
+                raise ValueError('Column names overrun the table header')
+
+            name = names[:name_length].decode('utf-8')
+            names += name_length
+
+            self._names.append(name)
+            self._name_locs.setdefault(name, i)
+
+            self.col_offsets[i] = offsets[i]
+        self.col_offsets[self.ncolumns] = offsets[self.ncolumns]
+
+        self.data_start = self.buf + header_size
+
+    property names:
+        """
+        Column names, all None for version 1 tables
+        """
+        def __get__(self):
+            return list(self._names)
+
+    property nbytes:
+        """
+        Size of the table in the buffer, header included
+        """
+        def __get__(self):
+            return ((self.data_start - self.buf) +
+                    self.col_offsets[self.ncolumns])
+
+    def column_info(self, i):
+        """
+        Returns
+        -------
+        info : dict
+          name, dtype, encoding, precision, and scale of the column
+        """
+        i = self._column_index(i)
+        return {
+            'name': self._names[i],
+            'dtype': self.dtypes[i],
+            'encoding': self.encodings[i],
+            'precision': self.precisions[i],
+            'scale': self.scales[i]
+        }
 
     def get_column(self, i):
-        # TODO: boundscheck
+        """
+        Parameters
+        ----------
+        i : int or string
+          Column position or name
+
+        Returns
+        -------
+        column : IbisColumn
+        """
+        cdef int k = self._column_index(i)
+
+        if self.encodings[k] != ENCODING_PLAIN:
+            raise NotImplementedError('Column %s has unsupported encoding %d'
+                                      % (i, self.encodings[k]))
+
+        if self.data_start + self.col_offsets[k + 1] > self.buf + self.bufsize:
+            raise ValueError('Column %s extends past the end of the buffer'
+                             % i)
+
         if self.table_format == FORMAT_MASKED:
-            return self._read_masked(i)
+            return self._read_masked(k)
         else:
             raise NotImplementedError
 
+    cdef int _column_index(self, i) except -1:
+        if isinstance(i, basestring):
+            if i not in self._name_locs:
+                raise KeyError(i)
+            return self._name_locs[i]
+
+        if i < 0 or i >= self.ncolumns:
+            raise IndexError('Column index %d out of bounds' % i)
+        return i
+
     cdef _read_masked(self, int i):
-        cdef MaskedColumnReader reader = MaskedColumnReader()
+        cdef:
+            MaskedColumnReader reader = MaskedColumnReader()
+            MaskedColumn result
 
         reader.init(self.dtypes[i], self.length,
                     self.data_start + self.col_offsets[i],
                     self.intern_table)
 
-        return reader.read()
+        result = reader.read()
+        result.precision = self.precisions[i]
+        result.scale = self.scales[i]
+        result.obj_refs = [self.container]
+        return result
 
     cdef _read_pandas(self, int i):
         raise NotImplementedError
 
+    def to_pandas(self, nthreads=1, copy=True):
+        """
+        Decode all the columns into a pandas DataFrame. Nulls are converted
+        following pandas conventions (see MaskedColumn.to_numpy_for_pandas).
+
+        Parameters
+        ----------
+        nthreads : int, default 1
+          Number of threads decoding columns at once. The per-value work
+          releases the GIL, so wide tables decode up to nthreads times
+          faster
+        copy : boolean, default True
+          Do not return data referencing the memory being read (which the
+          other process may overwrite later)
+
+        Returns
+        -------
+        df : pandas.DataFrame
+        """
+        import pandas as pd
+
+        columns = [self.get_column(i) for i in range(self.ncolumns)]
+
+        def decode(MaskedColumn col):
+            return col.to_numpy_for_pandas(copy=copy)
+
+        arrays = _parallel_map(decode, columns, nthreads)
+
+        # Built positionally, so duplicate names don't collapse columns.
+        # Unnamed columns are labeled by position
+        df = pd.DataFrame(OrderedDict(enumerate(arrays)))
+        df.columns = [name if name else i
+                      for i, name in enumerate(self._names)]
+        return df
+
 
 cdef class IbisColumnReader:
     pass
@@ -674,6 +1510,11 @@ cdef class IbisColumn:
         uint64_t length
         size_t stride
 
+    cdef public:
+        # DECIMAL only; written to version 2 table headers
+        int precision
+        int scale
+
     # N.B. all Cython cdef methods are "virtual" in the C++ sense, so it's safe
     # to use cdef IbisColumn and you'll get the subclass methods
     cpdef nbytes(self):
@@ -873,8 +1714,22 @@ cdef _box_pandas_floating(cython.floating* data, uint8_t* mask, int length,
                           object dtype, copy=False):
     cdef:
         int i
+        bint has_null = 0
         ndarray[cython.floating] result
 
+    # Is there a null?
+    with nogil:
+        for i in range(length):
+            if mask[i]:
+                has_null = 1
+                break
+
+    if not has_null:
+        view = buffer_to_numpy_view(data, length, dtype.num)
+        if copy:
+            view = view.copy()
+        return view
+
     result = np.empty(length, dtype=dtype)
     with nogil:
         for i in range(length):
@@ -895,6 +1750,42 @@ cdef _box_pandas_string(uint32_t* labels, uint8_t* mask, int length,
     return result
 
 
+def _parallel_map(func, items, nthreads):
+    # Apply func to the items in up to nthreads threads, preserving order.
+    # Only worthwhile if func spends most of its time without the GIL
+    nthreads = min(nthreads, len(items))
+    if nthreads <= 1:
+        return [func(x) for x in items]
+
+    results = [None] * len(items)
+    errors = []
+    work = iter(enumerate(items))
+    work_lock = threading.Lock()
+
+    def worker():
+        while not errors:
+            with work_lock:
+                try:
+                    i, x = next(work)
+                except StopIteration:
+                    return
+            try:
+                results[i] = func(x)
+            except Exception as e:
+                errors.append(e)
+
+    threads = [threading.Thread(target=worker) for i in range(nthreads)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    if errors:
+        raise errors[0]
+
+    return results
+
+
 cdef buffer_to_numpy_view(void* data, int n, int ndtype):
     cdef:
         cnp.npy_intp shape[1]
@@ -908,9 +1799,11 @@ cdef buffer_to_numpy_view(void* data, int n, int ndtype):
 
 
 def masked_from_numpy(ndarray values, ndarray mask, int ibis_type,
-                      InternTableBuilder intern_t=None):
+                      InternTableBuilder intern_t=None, int precision=0,
+                      int scale=0):
     # Helper function to convert masked format data represented as NumPy arrays
-    # into a MaskedColumn which can be written out to an Ibis-format file
+    # into a MaskedColumn which can be written out to an Ibis-format file.
+    # precision and scale are for DECIMAL columns
     cdef MaskedColumn result = MaskedColumn()
 
     check_numpy_compat(mask, IbisType.BOOLEAN)
@@ -922,6 +1815,8 @@ def masked_from_numpy(ndarray values, ndarray mask, int ibis_type,
     # TODO: conversion of strings / other non-natively mapping types
 
     result.dtype = ibis_type
+    result.precision = precision
+    result.scale = scale
     result.stride = values.dtype.itemsize
     result.length = len(values)
     result.null_mask = <uint8_t*> mask.data
@@ -933,6 +1828,46 @@ def masked_from_numpy(ndarray values, ndarray mask, int ibis_type,
     return result
 
 
+def masked_from_pandas(values, type_name):
+    """
+    Convert values in pandas representation (nulls are NaN or None, or
+    masked in a numpy.ma.MaskedArray) into a MaskedColumn. The inverse of
+    MaskedColumn.to_numpy_for_pandas
+
+    Parameters
+    ----------
+    values : array-like
+    type_name : string
+      Ibis type of the column, e.g. 'double'
+
+    Returns
+    -------
+    column : MaskedColumn
+    """
+    import pandas as pd
+
+    if type_name not in _type_name_to_ibis:
+        raise NotImplementedError('Writing %s columns not supported'
+                                  % type_name)
+    code = _type_name_to_ibis[type_name]
+
+    if isinstance(values, np.ma.MaskedArray):
+        mask = np.ma.getmaskarray(values)
+        values = values.data
+    else:
+        values = np.asarray(values)
+        mask = pd.isnull(values)
+
+    if mask.any():
+        values = np.where(mask, 0, values)
+
+    # Always copies, so the column never aliases the input (which may live
+    # in the buffer the column gets written to)
+    values = np.array(values, dtype=_ibis_to_numpy[code])
+    mask = np.array(mask, dtype=NPY_U1)
+    return masked_from_numpy(values, mask, code)
+
+
 cdef class IbisTableWriter:
     """
     Writes the Ibis binary file format (in production this will be produced by
@@ -946,22 +1881,64 @@ cdef class IbisTableWriter:
     """
     cdef:
         object columns
+        list names
         InternTable intern_table
 
         uint32_t ncols
         uint8_t* dtypes
-        uint32_t* col_offsets
-        uint32_t length
+        uint64_t* col_offsets
+        uint64_t length
         uint8_t col_format
 
-    def __cinit__(self, columns, InternTable intern_table=None):
+        int version
+        size_t header_size
+
+    def __cinit__(self, columns, InternTable intern_table=None, names=None,
+                  int version=DEFAULT_TABLE_VERSION):
+        """
+        Parameters
+        ----------
+        columns : sequence of IbisColumn
+        intern_table : InternTable, optional
+        names : sequence of strings, optional
+          Column names, written to the table header. Empty if not passed
+        version : int, default 1
+          Table format version. Version 1 can be read by every deployed
+          worker, but cannot store column names or DECIMAL precision and
+          scale (set on the columns, see masked_from_numpy); those need
+          version 2
+        """
+        self.col_offsets = NULL
+        self.dtypes = NULL
+
         if len(columns) == 0:
             raise ValueError('must be at least one column')
 
+        if version not in (1, TABLE_FORMAT_VERSION):
+            raise ValueError('Cannot write table format version %d'
+                             % version)
+
+        if names is None:
+            names = [''] * len(columns)
+        elif len(names) != len(columns):
+            raise ValueError('Number of names did not match number of '
+                             'columns')
+        elif version == 1:
+            raise ValueError('Version 1 tables cannot store column names')
+
+        for col in columns:
+            if not (0 <= col.precision <= 255 and 0 <= col.scale <= 255):
+                raise ValueError('Invalid DECIMAL precision or scale')
+            if version == 1 and (col.precision or col.scale):
+                raise ValueError('Version 1 tables cannot store DECIMAL '
+                                 'precision and scale')
+
         self.columns = columns
+        self.names = [x if isinstance(x, bytes) else x.encode('utf-8')
+                      for x in names]
         self.intern_table = intern_table
+        self.version = version
 
-        self.col_offsets = self.dtypes = NULL
         self._populate_metadata()
 
     def _populate_metadata(self):
@@ -973,12 +1950,9 @@ cdef class IbisTableWriter:
         self.ncols = len(self.columns)
 
         self.dtypes = <uint8_t*> malloc(self.ncols)
-        if self.dtypes == NULL:
-            raise MemoryError
-
-        self.col_offsets = <uint32_t*> malloc((self.ncols + 1) * 4)
-        if self.col_offsets == NULL:
-            free(self.dtypes)
+        self.col_offsets = <uint64_t*> malloc((self.ncols + 1) *
+                                              sizeof(uint64_t))
+        if self.dtypes == NULL or self.col_offsets == NULL:
             raise MemoryError
 
         cdef size_t offset = 0
@@ -993,25 +1967,95 @@ cdef class IbisTableWriter:
         self.col_offsets[self.ncols] = offset
         self.col_format = self.columns[0].format_code
 
-    def total_size(self):
-        cdef size_t total = 0
+        if self.version == 1:
+            if offset > 0xFFFFFFFF:
+                raise ValueError('Version 1 tables are limited to 4GB')
+
+            self.header_size = (
+                4 +  # Magic
+                4 +  # num columns
+                8 +  # length
+                self.ncols + # dtypes
+                4 * (self.ncols + 1) + # column byte offsets
+                1    # column format
+            )
+        else:
+            self.header_size = (
+                TABLE_HEADER_V2_SIZE +
+                COLUMN_DESCRIPTOR_SIZE * self.ncols +
+                8 * (self.ncols + 1) + # column byte offsets
+                sum(len(x) for x in self.names)
+            )
+
+            # Column blocks start 8-byte aligned
+            self.header_size = (self.header_size + 7) & ~(<size_t> 7)
+
+    @classmethod
+    def from_dataframe(cls, df, schema=None,
+                       int version=DEFAULT_TABLE_VERSION):
+        """
+        Create a writer for all the columns of a pandas DataFrame. Null masks
+        for every column are computed in a single vectorized pass, and null
+        values are replaced with zeros in the data arrays.
 
-        # Total up preamble
-        total = (
-            4 +  # Magic
-            4 +  # num columns
-            8 +  # length
-            self.ncols + # dtypes
-            4 * (self.ncols + 1) + # column byte offsets
-            1    # column format
-        )
+        Parameters
+        ----------
+        df : pandas.DataFrame
+        schema : ibis Schema or list of (name, type) tuples, optional
+          Target types for the columns (looked up by name). Inferred from the
+          DataFrame dtypes if not passed
+        version : int, default 1
+          Table format version; the column names (and DECIMAL precision and
+          scale) are only written with version 2
+
+        Returns
+        -------
+        writer : IbisTableWriter
+        """
+        from ibis.util import pandas_to_ibis_schema
+
+        if schema is None:
+            schema = pandas_to_ibis_schema(df)
+        elif not hasattr(schema, 'names'):
+            schema = ir.Schema.from_tuples(schema)
+
+        # Column-major copy so that each column's mask is contiguous. Masks
+        # are in schema order, which need not match the frame's
+        masks = np.ascontiguousarray(
+            df[list(schema.names)].isnull().values.T).view(NPY_U1)
+
+        columns = []
+        for i, (name, ibis_type) in enumerate(zip(schema.names,
+                                                  schema.types)):
+            precision = scale = 0
+            if isinstance(ibis_type, ir.DecimalType):
+                code = IbisType.DECIMAL
+                precision = ibis_type.precision
+                scale = ibis_type.scale
+            elif str(ibis_type) in _type_name_to_ibis:
+                code = _type_name_to_ibis[str(ibis_type)]
+            else:
+                raise NotImplementedError('Writing %s columns not supported'
+                                          % ibis_type)
 
-        # Add column bytes
-        total += self.col_offsets[self.ncols]
+            values = df[name].values
+            if masks[i].any():
+                values = np.where(masks[i], 0, values)
+            values = np.ascontiguousarray(values, dtype=_ibis_to_numpy[code])
 
-        # TODO: Add intern table bytes
+            if version == 1:
+                precision = scale = 0
+            columns.append(masked_from_numpy(values, masks[i], code,
+                                             precision=precision,
+                                             scale=scale))
+
+        names = schema.names if version >= 2 else None
+        return cls(columns, names=names, version=version)
 
-        return total
+    def total_size(self):
+        # Header plus column bytes
+        # TODO: Add intern table bytes
+        return self.header_size + self.col_offsets[self.ncols]
 
     def __dealloc__(self):
         if self.col_offsets != NULL:
@@ -1032,28 +2076,138 @@ cdef class IbisTableWriter:
         cdef:
             BufferInterface writer = BufferInterface()
             IbisColumn col
+            int i
 
         # Write table preamble
         writer.set_buffer(buf)
 
+        if self.version == 1:
+            self._write_header_v1(writer)
+        else:
+            self._write_header_v2(writer)
+
+        buf += self.header_size
+
+        # Write columns
+        if self.col_format == FORMAT_MASKED:
+            self._write_masked_columns(buf)
+        else:
+            for i in range(self.ncols):
+                col = self.columns[i]
+                col.write_buffer(buf + self.col_offsets[i])
+        buf += self.col_offsets[self.ncols]
+
+        # Write string intern table and any other data
+        if self.intern_table is not None:
+            self.intern_table.write_buffer(buf)
+
+
+    cdef _write_header_v1(self, BufferInterface writer):
+        cdef int i
+
         writer.write_uint32(IMPALA_MAGIC_UINT32)
         writer.write_uint32(self.ncols)
         writer.write_uint64(self.length)
 
         writer.write_array(self.dtypes, self.ncols, 1)
-        writer.write_array(self.col_offsets, self.ncols + 1, 4)
+        for i in range(self.ncols + 1):
+            writer.write_uint32(<uint32_t> self.col_offsets[i])
         writer.write_uint8(self.col_format)
 
-        buf += writer.pos
+    cdef _write_header_v2(self, BufferInterface writer):
+        cdef:
+            int i
+            IbisColumn col
 
-        # Write columns
-        for col in self.columns:
-            col.write_buffer(buf)
-            buf += col.nbytes()
+        writer.write_uint32(IBIS_TABLE_MAGIC_UINT32)
+        writer.write_uint16(TABLE_FORMAT_VERSION)
 
-        # Write string intern table and any other data
-        if self.intern_table is not None:
-            self.intern_table.write_buffer(buf)
+        # Nothing we write needs a newer reader than version 2
+        writer.write_uint16(2)
+
+        writer.write_uint8(NATIVE_ENDIANNESS)
+        writer.write_uint8(self.col_format)
+        writer.write_uint16(COLUMN_DESCRIPTOR_SIZE)
+        writer.write_uint32(self.ncols)
+        writer.write_uint64(self.length)
+        writer.write_uint32(self.header_size)
+        writer.write_uint32(TABLE_HEADER_V2_SIZE)
+
+        for i in range(self.ncols):
+            col = self.columns[i]
+            writer.write_uint8(self.dtypes[i])
+            writer.write_uint8(ENCODING_PLAIN)
+            writer.write_uint8(col.precision)
+            writer.write_uint8(col.scale)
+            writer.write_uint32(len(self.names[i]))
+
+        writer.write_array(self.col_offsets, self.ncols + 1, 8)
+
+        for name in self.names:
+            writer.write_array(<char*> name, len(name), 1)
+
+        # Zero the alignment padding
+        memset(writer.buf + writer.pos, 0, self.header_size - writer.pos)
+
+    cdef _write_masked_columns(self, uint8_t* buf):
+        # Gather the source regions first so that all of the copying can
+        # happen without the GIL
+        cdef:
+            int i, nchunks = 2 * self.ncols
+            MaskedColumn col
+            uint8_t** sources
+            size_t* sizes
+
+        sources = <uint8_t**> malloc(nchunks * sizeof(uint8_t*))
+        sizes = <size_t*> malloc(nchunks * sizeof(size_t))
+        if sources == NULL or sizes == NULL:
+            free(sources)
+            free(sizes)
+            raise MemoryError
+
+        for i in range(self.ncols):
+            col = self.columns[i]
+            sources[2 * i] = col.null_mask
+            sizes[2 * i] = col.length
+            sources[2 * i + 1] = col.data
+            sizes[2 * i + 1] = col.length * col.stride
+
+        with nogil:
+            for i in range(nchunks):
+                memcpy(buf, sources[i], sizes[i])
+                buf += sizes[i]
+
+        free(sources)
+        free(sizes)
+
+
+def write_dataframe(df, schema=None, BufferLike out=None,
+                    int version=DEFAULT_TABLE_VERSION):
+    """
+    Write a pandas DataFrame to a new RAMBuffer (or the passed buffer, e.g.
+    a SharedMmap) in the Ibis binary table format. See
+    IbisTableWriter.from_dataframe for details.
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+    schema : ibis Schema or list of (name, type) tuples, optional
+    out : BufferLike, optional
+      Must be at least as large as the table
+    version : int, default 1
+
+    Returns
+    -------
+    buf : BufferLike
+    """
+    writer = IbisTableWriter.from_dataframe(df, schema=schema,
+                                            version=version)
+
+    if out is None:
+        out = RAMBuffer(writer.total_size())
+
+    writer.write(out)
+    return out
 
 
 cdef class BufferInterface:
@@ -1086,6 +2240,15 @@ cdef class BufferInterface:
         self.pos += 1
         return val
 
+    cdef inline void write_uint16(self, uint16_t val):
+        (<uint16_t*> (self.buf + self.pos))[0] = val
+        self.pos += 2
+
+    cdef inline uint16_t read_uint16(self):
+        cdef uint16_t val = (<uint16_t*> (self.buf + self.pos))[0]
+        self.pos += 2
+        return val
+
     cdef inline void write_uint32(self, uint32_t val):
         (<uint32_t*> (self.buf + self.pos))[0] = val
         self.pos += 4
@@ -36,8 +36,55 @@ impala_temp_hdfs_path_doc = """
 HDFS path for storage of temporary data
 """
 
+impala_materialize_subqueries_doc = """
+Compute expensive subqueries (aggregations, joins, DISTINCT) referenced more
+than once in a query into temporary tables in temp_db first, rather than
+having Impala evaluate them for every reference
+"""
+
 
 with cf.config_prefix('impala'):
     cf.register_option('temp_db', '__ibis_tmp', impala_temp_db_doc)
     cf.register_option('temp_hdfs_path', '/tmp/ibis',
                        impala_temp_hdfs_path_doc)
+    cf.register_option('materialize_subqueries', False,
+                       impala_materialize_subqueries_doc,
+                       validator=cf.is_bool)
+
+
+optimizer_enabled_doc = """
+Rewrite expressions with the optimizer rules enabled below before compiling
+them to SQL (see ibis.expr.optimize)
+"""
+
+# name, default, doc
+optimizer_rules = [
+    ('constant_folding', False, """
+Evaluate arithmetic, comparisons and boolean logic on literals. Off by
+default: Impala folds constants itself when planning
+"""),
+    ('redundant_sort', True, """
+Drop sorts directly below an aggregation or a join
+"""),
+    ('limit_pushdown', True, """
+Combine a limit of a limit into one
+"""),
+    ('predicate_pushdown', True, """
+Move filter predicates on one side of an inner join into that side, when it
+is a subquery
+"""),
+    ('projection_pruning', True, """
+Drop projections of all the columns of their input
+"""),
+    ('column_pruning', True, """
+Drop the columns of projections and aggregations in subqueries that the
+query does not use
+""")
+]
+
+
+with cf.config_prefix('optimizer'):
+    cf.register_option('enabled', True, optimizer_enabled_doc,
+                       validator=cf.is_bool)
+    for name, default, doc in optimizer_rules:
+        cf.register_option(name, default, doc, validator=cf.is_bool)
@@ -373,30 +373,81 @@ def apply_filter(expr, predicates):
         # below the projection, we need to rewrite the predicate referencing
         # the parent tables in the join being projected
 
-        # TODO: is partial pushdown (one or more, but not all of the passed
-        # predicates) something we should consider doing? Could be reasonable
+        # Push down the predicates that can be, keeping the others above
+        pushable, rest = _split_pushdown(op, predicates)
 
-        # if isinstance(op, ops.Projection):
-        # else:
-        #     # Aggregation
-        #     can_pushdown = op.table.is_an
-
-        can_pushdown = _can_pushdown(op, predicates)
-
-        if can_pushdown:
-            predicates = [substitute_parents(x) for x in predicates]
+        if pushable:
+            pushable = [substitute_parents(x) for x in pushable]
 
             # this will further fuse, if possible
-            filtered = op.table.filter(predicates)
+            filtered = op.table.filter(pushable)
             result = op.substitute_table(filtered)
+
+            if rest:
+                # The remaining predicates refer to the table we are replacing
+                new_expr = ir.TableExpr(result)
+                rest = [sub_for(x, [(expr, new_expr)]) for x in rest]
+                result = ops.Filter(new_expr, rest)
         else:
             result = ops.Filter(expr, predicates)
+
+    elif isinstance(op, ops.InnerJoin):
+        result = _push_into_join(expr, predicates)
     else:
         result = ops.Filter(expr, predicates)
 
     return result
 
 
+def _split_pushdown(op, predicates):
+    # Predicates which can and cannot be pushed below a projection or
+    # aggregation
+    pushable = []
+    rest = []
+    for pred in predicates:
+        if _can_pushdown(op, [pred]):
+            pushable.append(pred)
+        else:
+            rest.append(pred)
+    return pushable, rest
+
+
+def _push_into_join(expr, predicates):
+    # Filter each input of an inner join by the predicates referring only to
+    # it, keeping those referring to both above. The inputs stay roots of the
+    # join, so that their column references remain valid; when compiled, the
+    # optimizer may move the predicates into an input that is a subquery
+    op = expr.op()
+
+    sides = [op.left, op.right]
+    pushed = [[], []]
+    rest = []
+    for pred in predicates:
+        for i, side in enumerate(sides):
+            if ExprValidator([side]).validate(pred):
+                pushed[i].append(pred)
+                break
+        else:
+            rest.append(pred)
+
+    if not (pushed[0] or pushed[1]):
+        return ops.Filter(expr, predicates)
+
+    new_sides = []
+    for side, side_preds in zip(sides, pushed):
+        if not side_preds:
+            new_sides.append(side)
+        elif isinstance(side.op(), ops.InnerJoin):
+            new_sides.append(ir.TableExpr(_push_into_join(side, side_preds)))
+        else:
+            new_sides.append(ir.TableExpr(ops.Filter(side, side_preds)))
+
+    result = type(op)(new_sides[0], new_sides[1], op.predicates)
+    if rest:
+        result = ops.Filter(ir.TableExpr(result), rest)
+    return result
+
+
 def _can_pushdown(op, predicates):
     # Per issues discussed in #173
     #
@@ -1421,6 +1421,10 @@ class CrossJoin(InnerJoin):
         if len(args) < 2:
             raise com.IbisInputError('Must pass at least 2 tables')
 
+        # Rebuilt from its args, like the other joins, when rewriting
+        if len(args) == 3 and isinstance(args[2], list):
+            args = args[:2]
+
         left = args[0]
         right = args[1]
         for t in args[2:]:
@@ -1588,6 +1592,23 @@ class SelfReference(ir.BlockingTableNode, HasSchema):
         return [self]
 
 
+class MaterializedSubquery(ir.BlockingTableNode, HasSchema):
+
+    """
+    A table expression to be computed once, into a temporary table, before
+    the query referencing it runs. See TableExpr.materialize
+    """
+
+    def __init__(self, table_expr):
+        self.table = table_expr
+        TableNode.__init__(self, [table_expr])
+        HasSchema.__init__(self, table_expr.schema())
+
+    def root_tables(self):
+        # Like SelfReference, a relation of its own: the temporary table
+        return [self]
+
+
 class Projection(ir.BlockingTableNode, HasSchema):
 
     _arg_names = ['table', 'selections']
@@ -1650,6 +1671,12 @@ class Projection(ir.BlockingTableNode, HasSchema):
             table = table.op().table
             exist_layers = True
 
+        # Likewise filters pushed down to the inputs of a join
+        unfiltered = _unfilter_join_inputs(table)
+        if unfiltered is not table:
+            table = unfiltered
+            exist_layers = True
+
         if exist_layers:
             reboxed = Projection(table, self.selections)
             return reboxed.is_ancestor(other)
@@ -1657,6 +1684,24 @@ class Projection(ir.BlockingTableNode, HasSchema):
             return False
 
 
+def _unfilter_join_inputs(table):
+    # The inner join with the filters on its inputs (and their inputs, if
+    # joins) removed; the table itself if there are none
+    op = table.op()
+    if not isinstance(op, InnerJoin):
+        return table
+
+    sides = []
+    for side in [op.left, op.right]:
+        while isinstance(side.op(), Filter):
+            side = side.op().table
+        sides.append(_unfilter_join_inputs(side))
+
+    if sides[0] is op.left and sides[1] is op.right:
+        return table
+    return type(op)(sides[0], sides[1], op.predicates).to_expr()
+
+
 class Aggregation(ir.BlockingTableNode, HasSchema):
 
     """
@@ -0,0 +1,757 @@
+# Copyright 2015 Cloudera Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Rule-based rewriting of expressions, run ahead of SQL compilation (see
+# build_ast). A rule looks at one node, its inputs rewritten already, and
+# returns an equivalent expression or None. The rules enabled (see the
+# optimizer.* options) are applied bottom-up over the whole expression DAG,
+# pass after pass until none applies.
+#
+# Column references look through filters, sorts and joins to the tables
+# below. A rule rewriting one of those tables (e.g. pushing a filter into a
+# join input) returns (expr, replaced) instead, replaced being a list of
+# (old, new) tables: references to old from the nodes above, up to the next
+# projection or aggregation, are rewritten to refer to new
+#
+# A rule needing to know about the nodes above one (e.g. which of its columns
+# they use) is registered with an analysis, run over the whole expression
+# before each pass, and is passed its result too. Such a rule applies to a
+# node as it is in the input, before its inputs are rewritten, so that
+# whatever it drops is not rewritten in vain (or at all: it may no longer be
+# valid)
+
+import operator
+import time
+
+from ibis.expr.analysis import ExprValidator, sub_for
+from ibis.expr.window import Window
+import ibis.config as config
+import ibis.expr.operations as ops
+import ibis.expr.types as ir
+
+
+class Rule(object):
+
+    def __init__(self, name, func, analysis=None):
+        self.name = name
+        self.func = func
+        self.analysis = analysis
+
+    def __repr__(self):
+        return 'Rule({0!r})'.format(self.name)
+
+    def __call__(self, expr):
+        return self.func(expr)
+
+    @property
+    def top_down(self):
+        return self.analysis is not None
+
+    def bind(self, expr):
+        """
+        The rewrite function for a pass over expr
+        """
+        if self.analysis is None:
+            return self.func
+
+        info = self.analysis(expr)
+        return lambda node: self.func(node, info)
+
+
+# In the order they are applied to a node
+_rules = []
+
+
+def register_rule(name, analysis=None):
+    """
+    Decorator adding a rewrite rule to the registry. Enable or disable it
+    with the option optimizer.<name>, which must be registered too
+
+    Parameters
+    ----------
+    name : string
+    analysis : function, optional
+      Run over the whole expression before each pass; its result is passed
+      to the rule with each node
+    """
+    def decorator(func):
+        _rules.append(Rule(name, func, analysis=analysis))
+        return func
+    return decorator
+
+
+def get_rules():
+    return list(_rules)
+
+
+def enabled_rules():
+    if not config.get_option('optimizer.enabled'):
+        return []
+    return [rule for rule in _rules
+            if config.get_option('optimizer.{0}'.format(rule.name))]
+
+
+def optimize(expr, rules=None):
+    """
+    Rewrite an expression with the optimizer rules
+
+    Parameters
+    ----------
+    expr : Expr
+    rules : list of rule names, optional
+      By default, the rules enabled in the options
+
+    Returns
+    -------
+    optimized : Expr
+      expr itself if no rule applies
+    """
+    return Optimizer(rules=rules).optimize(expr)
+
+
+class Optimizer(object):
+
+    """
+    Applies rewrite rules until none applies, up to max_passes passes over
+    an expression. Keeps per-rule statistics, for benchmarking
+
+    Parameters
+    ----------
+    rules : list of rule names, optional
+      By default, the rules enabled in the options
+    max_passes : int, default 10
+    """
+
+    def __init__(self, rules=None, max_passes=10):
+        if rules is None:
+            self.rules = enabled_rules()
+        else:
+            by_name = dict((rule.name, rule) for rule in _rules)
+            self.rules = [by_name[name] for name in rules]
+
+        self.max_passes = max_passes
+
+        self.passes = 0
+
+        # rule name -> number of rewrites, seconds spent
+        self.rewrites = dict((rule.name, 0) for rule in self.rules)
+        self.seconds = dict((rule.name, 0.) for rule in self.rules)
+
+    def optimize(self, expr):
+        if not self.rules:
+            return expr
+
+        for i in range(self.max_passes):
+            # id of a node of the input -> rewritten node
+            self._memo = {}
+
+            # id of a rewritten table node -> (old, new) tables to replace
+            # in the nodes above
+            self._replaced = {}
+
+            # (rule name, function) applied before / after rewriting the
+            # inputs of a node
+            self._before = []
+            self._after = []
+            for rule in self.rules:
+                start = time.time()
+                funcs = self._before if rule.top_down else self._after
+                funcs.append((rule.name, rule.bind(expr)))
+                self.seconds[rule.name] += time.time() - start
+
+            result = self._rewrite(expr)
+            self.passes += 1
+
+            if result is expr:
+                break
+            expr = result
+
+        return expr
+
+    def _rewrite(self, expr):
+        op = expr.op()
+        key = id(op)
+
+        if key in self._memo:
+            new_op = self._memo[key]
+        else:
+            result = expr
+            for name, func in self._before:
+                start = time.time()
+                rewritten = func(result)
+                self.seconds[name] += time.time() - start
+                if rewritten is not None:
+                    self.rewrites[name] += 1
+                    result = rewritten
+
+            result, replaced = self._rewrite_args(result)
+            for name, func in self._after:
+                start = time.time()
+                rewritten = func(result)
+                self.seconds[name] += time.time() - start
+                if rewritten is None:
+                    continue
+
+                self.rewrites[name] += 1
+                if isinstance(rewritten, tuple):
+                    result, rule_replaced = rewritten
+                    replaced = replaced + rule_replaced
+                else:
+                    result = rewritten
+
+            new_op = result.op()
+            self._memo[key] = new_op
+
+            if replaced and not isinstance(new_op, ir.BlockingTableNode):
+                self._replaced[id(new_op)] = replaced
+
+        if new_op is op:
+            return expr
+        return _rebox(expr, new_op)
+
+    def _rewrite_args(self, expr):
+        # The node with its inputs rewritten, and the tables replaced below
+        # it (see above)
+        op = expr.op()
+
+        new_args = [self._rewrite_arg(arg) for arg in op.args]
+
+        replaced = []
+        if isinstance(op, ir.TableNode):
+            for arg in new_args:
+                if isinstance(arg, ir.TableExpr):
+                    replaced.extend(self._replaced.get(id(arg.op()), []))
+
+        if replaced:
+            new_args = [arg if isinstance(arg, ir.TableExpr)
+                        else _replace_tables(arg, replaced)
+                        for arg in new_args]
+
+        if all(_same(x, y) for x, y in zip(op.args, new_args)):
+            return expr, replaced
+
+        return _rebox(expr, type(op)(*new_args)), replaced
+
+    def _rewrite_arg(self, arg):
+        if isinstance(arg, (tuple, list)):
+            new_arg = [self._rewrite_arg(x) for x in arg]
+            if all(x is y for x, y in zip(arg, new_arg)):
+                return arg
+            return new_arg
+        elif isinstance(arg, ir.Expr):
+            return self._rewrite(arg)
+        elif isinstance(arg, ops.SortKey):
+            new_expr = self._rewrite(arg.expr)
+            if new_expr is arg.expr:
+                return arg
+            return ops.SortKey(new_expr, ascending=arg.ascending)
+        elif isinstance(arg, Window):
+            return self._rewrite_window(arg)
+        return arg
+
+    def _rewrite_window(self, window):
+        group_by = [self._rewrite_arg(x) for x in window._group_by]
+        order_by = [self._rewrite_arg(x) for x in window._order_by]
+
+        if (all(x is y for x, y in zip(group_by, window._group_by)) and
+                all(x is y for x, y in zip(order_by, window._order_by))):
+            return window
+
+        return Window(group_by=group_by, order_by=order_by,
+                      preceding=window.preceding,
+                      following=window.following)
+
+
+def _rebox(expr, op):
+    if isinstance(expr, ir.ValueExpr):
+        return expr._factory(op, name=expr._name)
+    return expr._factory(op)
+
+
+def _same(x, y):
+    if isinstance(x, (tuple, list)):
+        return all(a is b for a, b in zip(x, y))
+    return x is y
+
+
+def _replace_tables(arg, replaced):
+    # Argument of a node (expression, sort key or list of them) rewritten to
+    # refer to the new tables in place of the old ones
+    if isinstance(arg, (tuple, list)):
+        new_arg = [_replace_tables(x, replaced) for x in arg]
+        if all(x is y for x, y in zip(arg, new_arg)):
+            return arg
+        return new_arg
+    elif isinstance(arg, ops.SortKey):
+        new_expr = _replace_tables(arg.expr, replaced)
+        if new_expr is arg.expr:
+            return arg
+        return ops.SortKey(new_expr, ascending=arg.ascending)
+    elif not isinstance(arg, ir.Expr):
+        return arg
+
+    for old, new in replaced:
+        if arg.op() is old.op():
+            return new
+    return sub_for(arg, replaced)
+
+
+# ---------------------------------------------------------------------
+# Rules
+
+
+_FOLDABLE = {
+    ops.Add: operator.add,
+    ops.Subtract: operator.sub,
+    ops.Multiply: operator.mul,
+    ops.Equals: operator.eq,
+    ops.NotEquals: operator.ne,
+    ops.Greater: operator.gt,
+    ops.GreaterEqual: operator.ge,
+    ops.Less: operator.lt,
+    ops.LessEqual: operator.le,
+    ops.And: lambda x, y: x and y,
+    ops.Or: lambda x, y: x or y
+}
+
+
+def _literal_value(expr):
+    op = expr.op()
+    if isinstance(op, ir.Literal) and op.value is not None:
+        return True, op.value
+    return False, None
+
+
+@register_rule('constant_folding')
+def fold_constants(expr):
+    """
+    Evaluate arithmetic, comparisons and boolean logic on literals, as long
+    as the result has the type of the expression
+    """
+    op = expr.op()
+
+    func = _FOLDABLE.get(type(op))
+    if func is not None:
+        left_ok, left = _literal_value(op.left)
+        right_ok, right = _literal_value(op.right)
+        if not (left_ok and right_ok):
+            return None
+        value = func(left, right)
+    elif isinstance(op, ops.Negate):
+        is_literal, arg = _literal_value(op.args[0])
+        if not is_literal:
+            return None
+        value = not arg if isinstance(arg, bool) else -arg
+    else:
+        return None
+
+    result = ir.literal(value)
+    if result.type() != expr.type():
+        # e.g. an int8 sum overflowing into an int16 literal
+        return None
+
+    if expr._name is not None:
+        result = result.name(expr._name)
+    return result
+
+
+@register_rule('redundant_sort')
+def remove_redundant_sort(expr):
+    """
+    Drop a sort directly below an aggregation or a join, which do not keep
+    the order of their input
+    """
+    op = expr.op()
+
+    if isinstance(op, ops.Aggregation):
+        sorted_table = op.table
+        if not isinstance(sorted_table.op(), ops.SortBy):
+            return None
+
+        table = sorted_table.op().table
+        replaced = [(sorted_table, table)]
+        agg_exprs, by, having = [_replace_tables(x, replaced)
+                                 for x in (op.agg_exprs, op.by, op.having)]
+        return ir.TableExpr(ops.Aggregation(table, agg_exprs, by=by,
+                                            having=having))
+
+    elif isinstance(op, ops.Join):
+        replaced = [(side, side.op().table) for side in (op.left, op.right)
+                    if isinstance(side.op(), ops.SortBy)]
+        if not replaced:
+            return None
+
+        left, right, predicates = [_replace_tables(x, replaced)
+                                   for x in (op.left, op.right,
+                                             op.predicates)]
+        return ir.TableExpr(type(op)(left, right, predicates)), replaced
+
+    return None
+
+
+@register_rule('limit_pushdown')
+def fuse_limits(expr):
+    """
+    Combine a limit of a limit into one
+    """
+    op = expr.op()
+    if not isinstance(op, ops.Limit) or not isinstance(op.table.op(),
+                                                       ops.Limit):
+        return None
+
+    inner = op.table.op()
+    n = max(min(op.n, inner.n - op.offset), 0)
+    return ir.TableExpr(ops.Limit(inner.table, n,
+                                  offset=inner.offset + op.offset))
+
+
+@register_rule('predicate_pushdown')
+def push_predicates(expr):
+    """
+    Move filter predicates on one side of an inner join into that side, when
+    it is a subquery anyway (so as not to introduce one)
+    """
+    op = expr.op()
+    if isinstance(op, ops.InnerJoin):
+        return _sink_side_filters(expr)
+
+    if not isinstance(op, ops.Filter):
+        return None
+
+    join = op.table
+    if not isinstance(join.op(), ops.InnerJoin):
+        return None
+
+    return _push_into_join(join, op.predicates, subqueries_only=True)
+
+
+def _sink_side_filters(join):
+    # A filter on an inner join side, as left by apply_filter, moved into the
+    # subquery it filters. None if there are none to move
+    op = join.op()
+    sides = [op.left, op.right]
+    new_sides = []
+    replaced = []
+
+    for side in sides:
+        side_op = side.op()
+        if not (isinstance(side_op, ops.Filter) and
+                _is_subquery(side_op.table)):
+            new_sides.append(side)
+            continue
+
+        table = side_op.table
+        new_side = table.filter(side_op.predicates)
+
+        # Partially pushed: the rest stay filtering the new subquery
+        new_table = new_side
+        if isinstance(new_side.op(), ops.Filter):
+            new_table = new_side.op().table
+
+        if new_table.op() is table.op():
+            new_sides.append(side)
+            continue
+
+        new_sides.append(new_side)
+        replaced.append((table, new_table))
+
+    if not replaced:
+        return None
+
+    predicates = _replace_tables(op.predicates, replaced)
+    result = ir.TableExpr(type(op)(new_sides[0], new_sides[1], predicates))
+    return result, replaced
+
+
+def _push_into_join(join, predicates, subqueries_only=False):
+    # Filter(join, predicates) with the predicates referring to only one side
+    # moved into that side, and the tables replaced. None if there are none
+    # to move
+    op = join.op()
+    sides = [op.left, op.right]
+    pushed = [[], []]
+    remaining = []
+
+    for pred in predicates:
+        for i, side in enumerate(sides):
+            if subqueries_only and not _is_subquery(side):
+                continue
+            if ExprValidator([side]).validate(pred):
+                pushed[i].append(pred)
+                break
+        else:
+            remaining.append(pred)
+
+    if not (pushed[0] or pushed[1]):
+        return None
+
+    new_sides = [side.filter(preds) if preds else side
+                 for side, preds in zip(sides, pushed)]
+
+    # The filter went into a projection or aggregation, making a new one
+    replaced = [(side, new_side) for side, new_side in zip(sides, new_sides)
+                if isinstance(new_side.op(), ir.BlockingTableNode) and
+                new_side is not side]
+    predicates = _replace_tables(op.predicates, replaced)
+    remaining = _replace_tables(remaining, replaced)
+
+    result = ir.TableExpr(type(op)(new_sides[0], new_sides[1], predicates))
+    if remaining:
+        result = ir.TableExpr(ops.Filter(result, remaining))
+    return result, replaced
+
+
+def _is_subquery(table):
+    # Compiled into a subquery of its own when joined
+    return isinstance(table.op(), (ops.Projection, ops.Aggregation,
+                                   ops.Distinct, ops.Union, ops.Limit))
+
+
+@register_rule('projection_pruning')
+def remove_identity_projection(expr):
+    """
+    Drop a projection of all the columns of its input, in order and under
+    their names
+    """
+    op = expr.op()
+    if not isinstance(op, ops.Projection):
+        return None
+
+    table = op.table
+    if isinstance(table.op(), ops.Join):
+        # A projection is what makes a join a table
+        return None
+
+    if len(op.selections) == 1 and op.selections[0].equals(table):
+        return table
+
+    # Column references look through filters and sorts
+    lineage = [table]
+    while isinstance(lineage[-1].op(), (ops.Filter, ops.SortBy)):
+        lineage.append(lineage[-1].op().table)
+
+    names = []
+    for sel in op.selections:
+        sel_op = sel.op()
+        if not (isinstance(sel_op, ops.TableColumn) and
+                sel.get_name() == sel_op.name and
+                any(sel_op.table.equals(x) for x in lineage)):
+            return None
+        names.append(sel_op.name)
+
+    if names == list(table.schema().names):
+        return table
+    return None
+
+
+# ---------------------------------------------------------------------
+# Column pruning
+
+
+# Every column of a table is used
+ALL_COLUMNS = None
+
+
+def required_columns(expr):
+    """
+    Find the columns of each table node in expr used by the nodes above it,
+    leaving out the selections and metrics of projections and aggregations
+    nothing uses
+
+    Returns
+    -------
+    required : dict
+      id of a table node -> set of column names, or ALL_COLUMNS
+    """
+    required = {}
+    if isinstance(expr, ir.TableExpr):
+        required[id(expr.op())] = ALL_COLUMNS
+
+    order = _topological_order(expr)
+
+    # Pruning one of these, but not the other, would break them apart
+    for op in _interchangeable_tables(order):
+        required[id(op)] = ALL_COLUMNS
+
+    # Nodes some node using it (or the result) depends on
+    live = set([id(expr.op())])
+
+    # Each node comes before its inputs, so all its uses are known by then
+    for node in order:
+        op = node.op()
+        if id(op) not in live:
+            continue
+
+        needed = required.get(id(op), set())
+        for child in _used_inputs(op, needed, required):
+            live.add(id(child.op()))
+
+    return required
+
+
+def _used_inputs(op, needed, required):
+    # Inputs of a node that its needed columns depend on, recording which of
+    # their columns are required
+    if isinstance(op, ops.TableColumn):
+        _require(required, op.table, [op.name])
+        return [op.table]
+
+    inputs = list(_input_exprs(op))
+
+    if isinstance(op, (ops.Filter, ops.SortBy, ops.Limit)):
+        # Columns pass through
+        _require(required, op.table, needed)
+    elif isinstance(op, ops.Join):
+        # Columns come from either side. The names of those of the other do
+        # no harm
+        _require(required, op.left, needed)
+        _require(required, op.right, needed)
+    elif isinstance(op, ops.Projection):
+        inputs = [op.table]
+        for sel in _pruned_selections(op.selections, needed):
+            if isinstance(sel, ir.TableExpr):
+                _require(required, sel, ALL_COLUMNS)
+            elif isinstance(sel.op(), ops.TableColumn):
+                # Perhaps part of a table selection (e.g. t0.*) pruned
+                _require(required, sel.op().table, [sel.op().name])
+            inputs.append(sel)
+    elif isinstance(op, ops.Aggregation):
+        metrics = _pruned_metrics(op.agg_exprs, needed)
+        inputs = [op.table] + list(_arg_exprs([metrics, op.by, op.having]))
+    else:
+        for child in inputs:
+            if isinstance(child, ir.TableExpr):
+                _require(required, child, ALL_COLUMNS)
+
+    return inputs
+
+
+def _interchangeable_tables(nodes):
+    # Projections and aggregations among nodes standing for one another:
+    # equal ones, compiled once (as a WITH clause), and those that column
+    # references look through filters to (see Projection.is_ancestor)
+    groups = {}
+    for node in nodes:
+        op = node.op()
+        if isinstance(op, (ops.Projection, ops.Aggregation)):
+            key = type(op), tuple(op.schema.names)
+            groups.setdefault(key, []).append(op)
+
+    result = []
+    for group in groups.values():
+        for i, op in enumerate(group):
+            if any(op.is_ancestor(other) or other.is_ancestor(op)
+                   for j, other in enumerate(group) if j != i):
+                result.append(op)
+    return result
+
+
+def _require(required, table, names):
+    key = id(table.op())
+    if names is ALL_COLUMNS or required.get(key, ()) is ALL_COLUMNS:
+        required[key] = ALL_COLUMNS
+    else:
+        required.setdefault(key, set()).update(names)
+
+
+def _pruned_selections(selections, needed):
+    # Selections of a projection producing the needed columns, the table
+    # selections among them narrowed to the needed columns
+    if needed is ALL_COLUMNS:
+        return list(selections)
+
+    result = []
+    for sel in selections:
+        if isinstance(sel, ir.TableExpr):
+            names = sel.schema().names
+            if all(x in needed for x in names):
+                result.append(sel)
+            else:
+                result.extend(sel[x] for x in names if x in needed)
+        elif sel.get_name() in needed:
+            result.append(sel)
+    return result
+
+
+def _pruned_metrics(metrics, needed):
+    if needed is ALL_COLUMNS:
+        return list(metrics)
+    return [x for x in metrics if x.get_name() in needed]
+
+
+def _topological_order(expr):
+    # The nodes of expr, each once and before all its inputs
+    order = []
+    seen = set()
+
+    def visit(node):
+        op = node.op()
+        if id(op) in seen:
+            return
+        seen.add(id(op))
+        for child in _input_exprs(op):
+            visit(child)
+        order.append(node)
+
+    visit(expr)
+    order.reverse()
+    return order
+
+
+def _input_exprs(op):
+    return _arg_exprs(op.args)
+
+
+def _arg_exprs(arg):
+    # The expressions in a node argument (see Optimizer._rewrite_arg)
+    if isinstance(arg, (tuple, list)):
+        for x in arg:
+            for expr in _arg_exprs(x):
+                yield expr
+    elif isinstance(arg, ir.Expr):
+        yield arg
+    elif isinstance(arg, ops.SortKey):
+        yield arg.expr
+    elif isinstance(arg, Window):
+        for expr in _arg_exprs([arg._group_by, arg._order_by]):
+            yield expr
+
+
+@register_rule('column_pruning', analysis=required_columns)
+def prune_columns(expr, required):
+    """
+    Drop the selections of a projection and the metrics of an aggregation
+    that no node above uses, and narrow table selections (e.g. t0.*) to the
+    columns used
+    """
+    op = expr.op()
+    needed = required.get(id(op), ALL_COLUMNS)
+    if needed is ALL_COLUMNS:
+        return None
+
+    if isinstance(op, ops.Projection):
+        selections = _pruned_selections(op.selections, needed)
+        if not selections or (len(selections) == len(op.selections) and
+                              _same(selections, op.selections)):
+            return None
+        return ir.TableExpr(ops.Projection(op.table, selections))
+
+    elif isinstance(op, ops.Aggregation):
+        metrics = _pruned_metrics(op.agg_exprs, needed)
+        if not metrics or len(metrics) == len(op.agg_exprs):
+            return None
+        return ir.TableExpr(ops.Aggregation(op.table, metrics, by=op.by,
+                                            having=op.having))
+
+    return None
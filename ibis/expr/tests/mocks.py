@@ -131,7 +131,8 @@ class MockConnection(SQLClient):
 
     def execute(self, expr, limit=None):
         ast = self._build_ast_ensure_limit(expr, limit)
-        for query in ast.queries:
+        queries = ast.setup_queries + ast.queries + ast.teardown_queries
+        for query in queries:
             self.executed_queries.append(query.compile())
         return None
 
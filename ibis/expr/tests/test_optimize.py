@@ -0,0 +1,212 @@
+# Copyright 2015 Cloudera Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from ibis.compat import unittest
+from ibis.expr.optimize import Optimizer, get_rules, optimize
+from ibis.expr.tests.mocks import MockConnection
+from ibis.sql.compiler import to_sql
+import ibis.config as config
+import ibis.expr.operations as ops
+import ibis
+
+
+class TestOptimizer(unittest.TestCase):
+
+    def setUp(self):
+        self.con = MockConnection()
+        self.t = self.con.table('alltypes')
+
+    def test_unchanged(self):
+        t = self.t
+        expr = t[t.a > 0].group_by('g').aggregate([t.f.sum().name('total')])
+        assert optimize(expr) is expr
+
+    def test_redundant_sort(self):
+        t = self.t.sort_by('f')
+        expr = t.group_by('g').aggregate([t.f.sum().name('total')])
+
+        result = to_sql(expr)
+        expected = """SELECT `g`, sum(`f`) AS `total`
+FROM alltypes
+GROUP BY 1"""
+        assert result == expected
+
+    def test_redundant_sort_join(self):
+        t = self.t.sort_by('f')
+        view = self.t.view()
+        expr = t.inner_join(view, [t.g == view.g])[t, view.a.name('a2')]
+
+        result = to_sql(expr)
+        expected = """SELECT t0.*, t1.`a` AS `a2`
+FROM alltypes t0
+  INNER JOIN alltypes t1
+    ON t0.`g` = t1.`g`"""
+        assert result == expected
+
+    def test_fuse_limits(self):
+        expr = self.t.limit(10).limit(20, offset=5)
+        op = optimize(expr).op()
+        assert isinstance(op, ops.Limit)
+        assert op.table.equals(self.t)
+        assert (op.n, op.offset) == (5, 5)
+
+        op = optimize(self.t.limit(10).limit(20, offset=15)).op()
+        assert op.n == 0
+
+    def test_identity_projection(self):
+        t = self.t
+        filtered = t[t.a > 1]
+
+        assert optimize(t.projection([t])).equals(t)
+        assert optimize(filtered[t.columns]).equals(filtered)
+
+        # Renamed or reordered columns stay
+        renamed = filtered[[t.a.name('foo')] + t.columns[1:]]
+        assert optimize(renamed) is renamed
+        reordered = filtered[t.columns[::-1]]
+        assert optimize(reordered) is reordered
+
+    def test_predicate_pushdown_join(self):
+        t = self.t
+        agg = t.group_by('g').aggregate([t.f.sum().name('total')])
+        proj = t[t.g, t.a, (t.f * 2).name('f2')]
+
+        joined = proj.inner_join(agg, [proj.g == agg.g])
+        expr = (joined.filter([proj.a > 1, proj.f2 > agg.total])
+                [proj, agg.total])
+
+        # The projection takes the predicate on its side; the references
+        # above are rewritten to the new projection
+        result = to_sql(expr)
+        expected = """SELECT t0.*, t1.`total`
+FROM (
+  SELECT `g`, `a`, `f` * 2 AS `f2`
+  FROM alltypes
+  WHERE `a` > 1
+) t0
+  INNER JOIN (
+    SELECT `g`, sum(`f`) AS `total`
+    FROM alltypes
+    GROUP BY 1
+  ) t1
+    ON t0.`g` = t1.`g`
+WHERE t0.`f2` > t1.`total`"""
+        assert result == expected
+
+    def test_predicate_pushdown_physical_table(self):
+        # No subquery just to hold the filter
+        t1 = self.t
+        t2 = self.con.table('star1')
+        joined = t1.inner_join(t2, [t1.g == t2.foo_id])
+        expr = joined.filter([t1.a > 1])
+        assert optimize(expr) is expr
+
+    def test_constant_folding(self):
+        t = self.t
+        expr = t[t.a > ibis.literal(1) + 2]
+
+        # Off by default
+        assert optimize(expr) is expr
+
+        with config.option_context('optimizer.constant_folding', True):
+            result = to_sql(expr)
+        assert result == """SELECT *
+FROM alltypes
+WHERE `a` > 3"""
+
+        big = ibis.literal(100) + 100
+        result = optimize(big, rules=['constant_folding'])
+        assert result.op().value == 200
+        assert result.type() == big.type()
+
+        cond = (ibis.literal(1) < 2) & (ibis.literal(2) < 1)
+        result = optimize(cond, rules=['constant_folding'])
+        assert result.op().value is False
+
+    def test_toggle_rules(self):
+        t = self.t.sort_by('f')
+        expr = t.group_by('g').aggregate([t.f.sum().name('total')])
+
+        with config.option_context('optimizer.redundant_sort', False):
+            assert optimize(expr) is expr
+
+        with config.option_context('optimizer.enabled', False):
+            assert optimize(expr) is expr
+
+        assert optimize(expr) is not expr
+
+    def test_stats(self):
+        t = self.t.sort_by('f')
+        expr = t.group_by('g').aggregate([t.f.sum().name('total')])
+
+        names = [rule.name for rule in get_rules()]
+        optimizer = Optimizer(rules=names)
+        optimizer.optimize(expr)
+
+        # A pass rewriting, and one finding nothing more to do
+        assert optimizer.passes == 2
+        assert optimizer.rewrites['redundant_sort'] == 1
+        assert optimizer.rewrites['limit_pushdown'] == 0
+        assert set(optimizer.seconds) == set(names)
+
+    def test_column_pruning(self):
+        t = self.t
+        mutated = t.mutate(x=t.a + t.b, y=t.f * 2)
+        proj = mutated[mutated.g, mutated.x, (mutated.y + 1).name('z')]
+        expr = proj[['g', 'x']].limit(5)
+
+        # Pruned at every level at once
+        result = to_sql(expr)
+        expected = """SELECT `g`, `a` + `b` AS `x`
+FROM alltypes
+LIMIT 5"""
+        assert result == expected
+
+        result = to_sql(mutated.x.sum())
+        expected = """SELECT sum(`x`) AS `tmp`
+FROM (
+  SELECT `a` + `b` AS `x`
+  FROM alltypes
+) t0"""
+        assert result == expected
+
+        with config.option_context('optimizer.column_pruning', False):
+            assert optimize(expr, rules=['column_pruning']) is not expr
+            assert optimize(expr) is expr
+
+    def test_column_pruning_join(self):
+        t = self.t
+        star1 = self.con.table('star1')
+        agg = t.group_by('g').aggregate([t.f.sum().name('total'),
+                                         t.d.max().name('top')])
+        joined = star1.inner_join(agg, [star1.foo_id == agg.g])[star1, agg]
+        expr = joined[joined.bar_id, joined.total]
+
+        result = to_sql(expr)
+        expected = """SELECT t0.`bar_id`, t1.`total`
+FROM star1 t0
+  INNER JOIN (
+    SELECT `g`, sum(`f`) AS `total`
+    FROM alltypes
+    GROUP BY 1
+  ) t1
+    ON t0.`foo_id` = t1.`g`"""
+        assert result == expected
+
+    def test_column_pruning_whole_table(self):
+        # Every column counts in a union
+        t = self.t
+        mutated = t.mutate(x=t.a + t.b)
+        expr = mutated.union(mutated)[['g']]
+        assert optimize(expr, rules=['column_pruning']) is expr
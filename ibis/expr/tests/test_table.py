@@ -448,20 +448,26 @@ class TestTableExprBasics(BasicTestCase, unittest.TestCase):
                 [table1, table2.b_name.name('b'), table3.c_name.name('c'),
                  table2.b_value])
 
+        # The predicates go on through the joins, to the table they refer to
         cases = [
-            (proj.a_value > 0, table1.a_value > 0),
-            (proj.b_value > 0, table2.b_value > 0)
+            (proj.a_value > 0, table1.a_value > 0, 'left'),
+            (proj.b_value > 0, table2.b_value > 0, 'right')
         ]
 
-        for higher_pred, lower_pred in cases:
+        for higher_pred, lower_pred, side in cases:
             result = proj.filter([higher_pred])
             op = result.op()
             assert isinstance(op, ops.Projection)
-            filter_op = op.table.op()
+            join_op = op.table.op().left.op()
+            assert isinstance(join_op, ops.InnerJoin)
+            filter_op = getattr(join_op, side).op()
             assert isinstance(filter_op, ops.Filter)
             new_pred = filter_op.predicates[0]
             assert_equal(new_pred, lower_pred)
 
+            # Columns of the unfiltered join are still valid in the result
+            result[proj.c, proj.b_value]
+
     def test_limit(self):
         limited = self.table.limit(10, offset=5)
         assert limited.op().n == 10
@@ -621,7 +627,18 @@ class TestAggregation(BasicTestCase, unittest.TestCase):
         assert_equal(filtered, expected)
 
     def test_filter_aggregate_partial_pushdown(self):
-        pass
+        pred = self.table.f > 0
+        metrics = [self.table.a.sum().name('total')]
+        agged = self.table.aggregate(metrics, by=['g'])
+        filtered = agged.filter([pred, agged.total > 10])
+
+        # The predicate on the aggregate's input goes below it, the one on
+        # its output stays above
+        pushed = self.table[pred].aggregate(metrics, by=['g'])
+        op = filtered.op()
+        assert isinstance(op, ops.Filter)
+        assert_equal(op.table, pushed)
+        assert_equal(op.predicates[0], pushed.total > 10)
 
     def test_aggregate_post_predicate(self):
         # Test invalid having clause
@@ -930,6 +947,36 @@ class TestJoinsUnions(BasicTestCase, unittest.TestCase):
         filtered = joined.filter([table1.value1 > 0])
         repr(filtered)
 
+    def test_filter_join_pushdown(self):
+        table1 = ibis.table({'key1': 'string', 'value1': 'double'})
+        table2 = ibis.table({'key3': 'string', 'value2': 'double'})
+
+        joined = table1.inner_join(table2, [table1.key1 == table2.key3])
+        preds = [table1.value1 > 0, table2.value2 < 5,
+                 table1.value1 > table2.value2]
+        filtered = joined.filter(preds)
+
+        # Each side takes the predicates referring to it alone
+        op = filtered.op()
+        assert isinstance(op, ops.Filter)
+        assert len(op.predicates) == 1
+        assert_equal(op.predicates[0], preds[2])
+
+        join_op = op.table.op()
+        assert isinstance(join_op, ops.InnerJoin)
+        assert_equal(join_op.left, table1[preds[0]])
+        assert_equal(join_op.right, table2[preds[1]])
+
+        joined = table1.cross_join(table2)
+        join_op = joined.filter(preds[:2]).op()
+        assert isinstance(join_op, ops.CrossJoin)
+        assert_equal(join_op.left, table1[preds[0]])
+
+        # Outer joins are left alone
+        joined = table1.left_join(table2, [table1.key1 == table2.key3])
+        filtered = joined.filter(preds[:1])
+        assert filtered.op().table.equals(joined)
+
     def test_filter_on_projected_field(self):
         # See #173. Impala and other SQL engines do not allow filtering on a
         # just-created alias in a projection
@@ -656,16 +656,32 @@ class TableExpr(Expr):
     def _get_type(self, name):
         return self._arg.get_type(name)
 
-    def materialize(self):
+    def materialize(self, temporary=False):
         """
         Force schema resolution for a joined table, selecting all fields from
         all tables.
+
+        Parameters
+        ----------
+        temporary : boolean, default False
+          Also have the table computed once into a temporary table (in
+          options.impala.temp_db) before executing a query that uses it,
+          rather than evaluated inline as a subquery wherever it is
+          referenced. The temporary table is dropped afterwards
+
+        Returns
+        -------
+        materialized : TableExpr
         """
         if self._is_materialized():
-            return self
+            result = self
         else:
             op = _ops().MaterializedJoin(self)
-            return TableExpr(op)
+            result = TableExpr(op)
+
+        if temporary:
+            result = TableExpr(_ops().MaterializedSubquery(result))
+        return result
 
     def get_columns(self, iterable):
         """
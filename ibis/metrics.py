@@ -0,0 +1,238 @@
+# Copyright 2014 Cloudera Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# In-process metrics for the task server: counters, gauges and histograms.
+# Snapshots are plain dicts (JSON-friendly), so that worker processes can
+# ship theirs to the daemon to be merged
+
+from contextlib import contextmanager
+import math
+import os
+import threading
+import time
+
+
+# Histogram bucket b counts values in [2 ** (b - BUCKET_OFFSET - 1),
+# 2 ** (b - BUCKET_OFFSET)); bucket 0 also takes zero and anything smaller.
+# Covers about a microsecond up to 2 ** 43 (seconds or bytes)
+BUCKET_OFFSET = 20
+NBUCKETS = 64
+
+
+def _bucket(value):
+    if value <= 0:
+        return 0
+    b = math.frexp(value)[1] + BUCKET_OFFSET
+    return min(max(b, 0), NBUCKETS - 1)
+
+
+def bucket_bound(b):
+    """
+    Upper bound of histogram bucket b
+    """
+    return 2. ** (b - BUCKET_OFFSET)
+
+
+class Histogram(object):
+
+    """
+    Distribution of observed values (e.g. latencies in seconds, or sizes in
+    bytes) in power-of-two buckets
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.max = 0
+        self.buckets = [0] * NBUCKETS
+
+    def observe(self, value):
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+        self.buckets[_bucket(value)] += 1
+
+    def snapshot(self):
+        return {'count': self.count, 'sum': self.total, 'max': self.max,
+                'buckets': list(self.buckets)}
+
+
+def percentile(hist, q):
+    """
+    Estimate a percentile of a histogram snapshot, from above: the upper
+    bound of the bucket it falls in, capped at the largest value seen
+
+    Parameters
+    ----------
+    hist : dict
+      From Histogram.snapshot
+    q : float
+      Between 0 and 100
+    """
+    if not hist['count']:
+        return 0
+
+    rank = q / 100. * hist['count']
+    seen = 0
+    for b, n in enumerate(hist['buckets']):
+        seen += n
+        if n and seen >= rank:
+            return min(bucket_bound(b), hist['max'])
+    return hist['max']
+
+
+class MetricsRegistry(object):
+
+    """
+    Named counters, gauges and histograms of one process. Safe to use from
+    several threads (e.g. a threaded worker)
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        """
+        Start over, e.g. in a freshly forked worker
+        """
+        with self._lock:
+            self.counters = {}
+            self.gauges = {}
+            self.histograms = {}
+            self.start_time = time.time()
+
+    def incr(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def set_gauge(self, name, value):
+        with self._lock:
+            self.gauges[name] = value
+
+    def observe(self, name, value):
+        with self._lock:
+            hist = self.histograms.get(name)
+            if hist is None:
+                hist = self.histograms[name] = Histogram()
+            hist.observe(value)
+
+    @contextmanager
+    def timer(self, name):
+        """
+        Observe the seconds spent in a with block
+        """
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - start)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'pid': os.getpid(),
+                'uptime': time.time() - self.start_time,
+                'counters': dict(self.counters),
+                'gauges': dict(self.gauges),
+                'histograms': dict((name, hist.snapshot())
+                                   for name, hist in self.histograms.items())
+            }
+
+
+def merge_snapshots(snapshots):
+    """
+    Combine snapshots of several processes (e.g. the daemon and its pool
+    workers): counters and histograms are added up, gauges summed too. The
+    pid and uptime are the first snapshot's
+    """
+    result = {'counters': {}, 'gauges': {}, 'histograms': {}}
+    for i, snap in enumerate(snapshots):
+        if i == 0:
+            result['pid'] = snap['pid']
+            result['uptime'] = snap['uptime']
+
+        for key in ('counters', 'gauges'):
+            merged = result[key]
+            for name, value in snap[key].items():
+                merged[name] = merged.get(name, 0) + value
+
+        for name, hist in snap['histograms'].items():
+            merged = result['histograms'].get(name)
+            if merged is None:
+                merged = result['histograms'][name] = {
+                    'count': 0, 'sum': 0, 'max': 0,
+                    'buckets': [0] * NBUCKETS}
+            merged['count'] += hist['count']
+            merged['sum'] += hist['sum']
+            merged['max'] = max(merged['max'], hist['max'])
+            merged['buckets'] = [a + b for a, b in
+                                 zip(merged['buckets'], hist['buckets'])]
+    return result
+
+
+def _format_value(name, value):
+    if name.endswith('_bytes'):
+        return '%d' % value
+    # Seconds
+    return '%.3fms' % (value * 1000)
+
+
+def format_metrics(snapshot):
+    """
+    Human-readable dump of a snapshot
+    """
+    lines = ['ibis metrics (pid %d, up %.1fs)'
+             % (snapshot['pid'], snapshot['uptime'])]
+
+    for key in ('counters', 'gauges'):
+        values = snapshot[key]
+        if not values:
+            continue
+        lines.append('%s:' % key)
+        for name in sorted(values):
+            value = values[name]
+            if isinstance(value, float):
+                value = '%.3f' % value
+            lines.append('  %-40s %s' % (name, value))
+
+    hists = snapshot['histograms']
+    if hists:
+        lines.append('histograms:')
+    for name in sorted(hists):
+        hist = hists[name]
+        if not hist['count']:
+            continue
+        mean = hist['sum'] / float(hist['count'])
+        lines.append('  %-40s count=%d mean=%s p50<=%s p99<=%s max=%s'
+                     % (name, hist['count'], _format_value(name, mean),
+                        _format_value(name, percentile(hist, 50)),
+                        _format_value(name, percentile(hist, 99)),
+                        _format_value(name, hist['max'])))
+
+    return '\n'.join(lines)
+
+
+_metrics = None
+
+
+def get_metrics():
+    """
+    The metrics registry of this process
+    """
+    global _metrics
+    if _metrics is None:
+        _metrics = MetricsRegistry()
+    return _metrics
@@ -18,8 +18,11 @@
 
 import argparse
 import errno
+import fcntl
+import json
 import numbers
 import os
+import resource
 import select
 import signal
 import socket
@@ -30,16 +33,256 @@ import threading
 import traceback
 
 
-from ibis.tasks import IbisTaskMessage, IbisTaskExecutor
+from ibis.metrics import format_metrics, get_metrics, merge_snapshots
+from ibis.tasks import (IbisTaskMessage, IbisTaskExecutor, get_agg_states,
+                        get_segment_pool, get_watchdog, metrics_snapshot,
+                        reclaim_segments, report_task_failure)
+from ibis.wire import FRAME_MAGIC, FrameReader, pack_frame
 
 
+# Wait for the rest of a partially received framed-protocol preamble
 SELECT_TIMEOUT = 0.25
 
+# Idle workers holding pooled shared memory or resident aggregation states
+# wake up this often (seconds) to reclaim them. Otherwise the event loops only
+# wake up for events
+RECLAIM_INTERVAL = 1.0
+
+# Connections accepted per listener readiness event, so that a burst of
+# clients cannot starve established connections
+ACCEPT_BATCH = 64
+
+# Imported by the daemon before forking pre-forked workers, so that they
+# start out warm
+PRELOAD_MODULES = ['numpy', 'pandas', 'ibis.comms']
+
+# Delay before forking again after a pool worker failed to start, doubling
+# with each consecutive failure
+POOL_RESPAWN_BACKOFF = 0.1
+POOL_RESPAWN_BACKOFF_MAX = 30
+
+# Pool workers send their metrics to the daemon at most this often (seconds),
+# after finishing a task
+METRICS_REPORT_INTERVAL = 1.0
+
+
+# Message types of the framed protocol (see ibis.wire). Replies carry the
+# request id of the request they answer
+MSG_OK = 0
+MSG_ERROR = 1
+
+# Payload: encoded IbisTaskMessage. Sent to a worker, or to a pre-fork daemon
+MSG_TASK = 2
+
+# Daemon only
+MSG_NEW_WORKER = 3
+MSG_KILL = 4  # payload: uint32 pid
+MSG_SHUTDOWN = 5
+
+# Payload: encoded IbisTaskMessage of a task submitted to a pre-fork daemon
+MSG_CANCEL = 6
+
+# Reply payload: JSON metrics snapshot (see ibis.metrics). Daemon or worker
+MSG_STATS = 7
+
+# Read size for framed connections
+RECV_SIZE = 65536
+
+
+class ServerError(Exception):
+    pass
+
 
 def pack_uint32(val):
     return struct.pack('I', val)
 
 
+def worker_unix_path(daemon_unix_path, pid):
+    """
+    Unix domain socket path of a worker, given its daemon's
+    """
+    return '%s.%d' % (daemon_unix_path, pid)
+
+
+def _send_frame(sock, msg):
+    # Length-prefixed messages on the daemon <-> pre-forked worker channel
+    sock.sendall(pack_uint32(len(msg)) + msg)
+
+
+def _recv_exactly(sock, nbytes):
+    chunks = []
+    while nbytes > 0:
+        try:
+            chunk = sock.recv(nbytes)
+        except socket.error as e:
+            if e.args[0] == errno.EINTR:
+                continue
+            raise
+
+        if not chunk:
+            return None
+        chunks.append(chunk)
+        nbytes -= len(chunk)
+    return ''.join(chunks)
+
+
+def _recv_frame(sock):
+    """
+    Returns None if the other end closed the connection
+    """
+    header = _recv_exactly(sock, 4)
+    if header is None:
+        return None
+    length, = struct.unpack('I', header)
+    return _recv_exactly(sock, length)
+
+
+def _max_rss_bytes():
+    # Peak resident set size; ru_maxrss is in kilobytes on Linux but bytes
+    # on OS X
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+class ServerConnection(object):
+
+    """
+    Persistent connection to a daemon or worker speaking the framed protocol.
+    Requests can be pipelined: send any number with send_request, then
+    collect the replies (in any order) with wait_reply.
+
+    Parameters
+    ----------
+    address : (host, port) tuple, or path of a Unix domain socket
+    """
+
+    def __init__(self, address):
+        if isinstance(address, basestring):
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        else:
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.connect(address)
+        self.sock.sendall(FRAME_MAGIC)
+
+        self._reader = FrameReader()
+        self._replies = {}
+        self._next_id = 0
+
+    def close(self):
+        self.sock.close()
+
+    def send_request(self, msg_type, payload=''):
+        """
+        Returns
+        -------
+        request_id : int
+        """
+        self._next_id = (self._next_id + 1) & 0xFFFFFFFF
+        self.sock.sendall(pack_frame(msg_type, self._next_id, payload))
+        return self._next_id
+
+    def wait_reply(self, request_id):
+        """
+        Returns the reply payload, raising ServerError if the request failed
+        """
+        while request_id not in self._replies:
+            data = self.sock.recv(RECV_SIZE)
+            if not data:
+                raise ServerError('Connection closed by server')
+
+            for msg_type, rid, payload in self._reader.feed(data):
+                self._replies[rid] = msg_type, payload
+
+        msg_type, payload = self._replies.pop(request_id)
+        if msg_type == MSG_ERROR:
+            raise ServerError(payload)
+        return payload
+
+    def request(self, msg_type, payload=''):
+        return self.wait_reply(self.send_request(msg_type, payload))
+
+    def submit_task(self, task_msg):
+        return self.request(MSG_TASK, task_msg.encode())
+
+    def new_worker(self):
+        return self.request(MSG_NEW_WORKER)
+
+    def kill_worker(self, pid):
+        return self.request(MSG_KILL, pack_uint32(pid))
+
+    def cancel_task(self, task_msg):
+        return self.request(MSG_CANCEL, task_msg.encode())
+
+    def stats(self):
+        """
+        Returns the server's metrics snapshot (see ibis.metrics)
+        """
+        return json.loads(self.request(MSG_STATS))
+
+    def shutdown(self):
+        return self.request(MSG_SHUTDOWN)
+
+
+class FramedConnection(object):
+
+    """
+    Server side of a ServerConnection
+    """
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.reader = FrameReader()
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def read_frames(self):
+        """
+        Returns None once the client has closed the connection
+        """
+        try:
+            data = self.sock.recv(RECV_SIZE)
+        except socket.error as e:
+            if e.args[0] == errno.EINTR:
+                return []
+            data = ''
+
+        if not data:
+            return None
+        return self.reader.feed(data)
+
+    def reply(self, request_id, msg_type, payload=''):
+        try:
+            self.sock.sendall(pack_frame(msg_type, request_id, payload))
+        except socket.error:
+            # Client went away; noticed on the next read
+            pass
+
+    def close(self):
+        self.sock.close()
+
+
+def _is_framed(sock):
+    # Framed connections open with FRAME_MAGIC; anything else is a one-shot
+    # legacy request. Only peek, so legacy handlers see the whole request
+    while True:
+        try:
+            data = sock.recv(len(FRAME_MAGIC), socket.MSG_PEEK)
+        except socket.error as e:
+            if e.args[0] == errno.EINTR:
+                continue
+            return False
+
+        if data == FRAME_MAGIC:
+            _recv_exactly(sock, len(FRAME_MAGIC))
+            return True
+        elif not data or not FRAME_MAGIC.startswith(data):
+            return False
+
+        # Only part of the preamble has arrived
+        select.select([sock], [], [], SELECT_TIMEOUT)
+
+
 class IbisTaskHandler(object):
 
     def __init__(self, sock):
@@ -57,6 +300,7 @@ class IbisTaskHandler(object):
             task_msg = IbisTaskMessage.decode(encoded_task)
         except:
             self.sock.send(traceback.format_exc())
+            return
         else:
             # Acknowledge successful receipt
             self.sock.send('ok')
@@ -84,26 +328,240 @@ def _eintr_retry(func, *args):
     while True:
         try:
             return func(*args)
-        except (OSError, select.error) as e:
+        except (OSError, IOError, select.error) as e:
             if e.args[0] != errno.EINTR:
                 raise
 
+
+def _set_nonblocking(fd):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+
+class EventLoop(object):
+
+    """
+    Readiness notification for the daemon and worker main loops: epoll where
+    available, select otherwise. Registered objects need a fileno() method,
+    and must be unregistered before they are closed
+    """
+
+    def __init__(self):
+        # object -> fd, and back
+        self._fds = {}
+        self._objects = {}
+
+        if hasattr(select, 'epoll'):
+            self._epoll = select.epoll()
+        else:
+            self._epoll = None
+
+    def register(self, obj):
+        fd = obj.fileno()
+        self._fds[obj] = fd
+        self._objects[fd] = obj
+        if self._epoll is not None:
+            self._epoll.register(fd, select.EPOLLIN)
+
+    def unregister(self, obj):
+        fd = self._fds.pop(obj, None)
+        if fd is None:
+            return
+
+        del self._objects[fd]
+        if self._epoll is not None:
+            try:
+                self._epoll.unregister(fd)
+            except (IOError, OSError):
+                pass
+
+    def watching(self, obj):
+        return obj in self._fds
+
+    def poll(self, timeout=None):
+        """
+        Wait until registered objects are ready for reading
+
+        Parameters
+        ----------
+        timeout : float, optional
+          In seconds; block indefinitely by default
+
+        Returns
+        -------
+        ready : list of registered objects
+        """
+        if self._epoll is not None:
+            events = _eintr_retry(self._epoll.poll,
+                                  -1 if timeout is None else timeout)
+            fds = [fd for fd, _ in events]
+        else:
+            fds = _eintr_retry(select.select, list(self._objects),
+                               [], [], timeout)[0]
+
+        return [self._objects[fd] for fd in fds if fd in self._objects]
+
+    def close(self):
+        # Leaves registrations alone: a forked child closing its copy of the
+        # epoll descriptor must not affect the parent's
+        if self._epoll is not None:
+            self._epoll.close()
+        self._fds.clear()
+        self._objects.clear()
+
+
+class Wakeup(object):
+
+    """
+    Self-pipe waking up an EventLoop from signal handlers and other threads
+    """
+
+    def __init__(self):
+        self._read_fd, self._write_fd = os.pipe()
+        _set_nonblocking(self._read_fd)
+        _set_nonblocking(self._write_fd)
+
+    def fileno(self):
+        return self._read_fd
+
+    def wake(self):
+        try:
+            os.write(self._write_fd, '\0')
+        except OSError:
+            # Pipe is full, so a wakeup is pending anyway
+            pass
+
+    def drain(self):
+        try:
+            while os.read(self._read_fd, 4096):
+                pass
+        except OSError:
+            pass
+
+    def close(self):
+        os.close(self._read_fd)
+        os.close(self._write_fd)
+
 # ---------------------------------------------------------------------
 # Daemon logic for spawning new child workers
 
 
+class PoolWorker(object):
+
+    """
+    Daemon-side handle for a pre-forked worker process
+    """
+
+    def __init__(self, pid, conn):
+        self.pid = pid
+        self.conn = conn
+        self.idle = False
+
+        # Set once the worker has reported in
+        self.started = False
+
+        # Encoded task message it is running, if any
+        self.task = None
+
+        # Metrics snapshot it last sent
+        self.metrics = None
+
+        # Start of the time not yet accounted for as busy or idle
+        self._since = time.time()
+
+    def fileno(self):
+        return self.conn.fileno()
+
+    def elapsed(self):
+        """
+        Returns seconds since the last call (or since forking)
+        """
+        now = time.time()
+        elapsed, self._since = now - self._since, now
+        return elapsed
+
+    def send(self, msg):
+        _send_frame(self.conn, msg)
+
+    def close(self):
+        self.conn.close()
+
+
 class IbisServerNode(object):
 
     """
     This can be a daemon (for launching subprocesses) or a worker
+
+    Both accept one-shot requests (e.g. 'new', or an encoded task for a
+    worker) as well as persistent framed-protocol connections (see
+    ServerConnection) on their TCP port, and on a Unix domain socket if
+    unix_path is given.
+
+    Parameters
+    ----------
+    server_port : int
+      Port of the Impala-side server to report daemon and worker ports to
+    daemon : boolean, default True
+    task_handler : class, default IbisTaskHandler
+    unix_path : string, optional
+      Also listen on a Unix domain socket at this path; workers listen at
+      worker_unix_path(unix_path, pid)
+    prefork : boolean, default False
+      Keep a pool of pre-forked, warmed up workers. The daemon hands tasks
+      sent to it with the 'task' command to idle pool workers, and 'new'
+      requests are served by detaching an idle pool worker when there is one
+    min_workers : int, default 2
+      Pool workers to keep alive (whether busy or idle)
+    max_workers : int, default 8
+      Upper limit on pool workers; tasks queue in the daemon beyond this
+    max_worker_tasks : int, optional
+      Recycle a pool worker after it has run this many tasks
+    max_worker_rss : int, optional
+      Recycle a pool worker once its peak resident memory exceeds this many
+      bytes
     """
 
     def __init__(self, server_port=17001, daemon=True,
-                 task_handler=IbisTaskHandler):
+                 task_handler=IbisTaskHandler, prefork=False, min_workers=2,
+                 max_workers=8, max_worker_tasks=None, max_worker_rss=None,
+                 unix_path=None):
         self.server_port = server_port
         self.task_handler = task_handler
 
+        # Open framed-protocol connections
+        self.connections = []
+
+        self.unix_path = unix_path
+        self.unix_sock = None
+
+        self.prefork = prefork
+        self.min_workers = min_workers
+        self.max_workers = max(max_workers, min_workers)
+        self.max_worker_tasks = max_worker_tasks
+        self.max_worker_rss = max_worker_rss
+
+        # pid -> PoolWorker
+        self.pool_workers = {}
+
+        # (encoded task message, time queued) waiting for an idle pool
+        # worker
+        self.task_queue = []
+
+        # Combined final metrics of pool workers that are gone
+        self._retired_metrics = None
+
+        # Consecutive pool workers that failed to start
+        self._spawn_failures = 0
+        self._next_spawn_time = 0
+
+        # EventLoop of the running main loop. Signal handlers and other
+        # threads interrupt it through the wakeup pipe
+        self._loop = None
+        self._wakeup = Wakeup()
+
         self.setup_server_socket()
+        if unix_path is not None:
+            self.setup_unix_socket(unix_path)
 
         # Can trigger shutdown to occur
         self._shutdown_request = False
@@ -128,20 +586,51 @@ class IbisServerNode(object):
         # Don't die on SIGHUP
         signal.signal(signal.SIGHUP, signal.SIG_IGN)
 
+        # Reap exited workers from the main loop; waitpid in the signal
+        # handler itself could deadlock
+        signal.signal(signal.SIGCHLD, self.handle_sigchld)
+        signal.siginterrupt(signal.SIGCHLD, False)
+
+        self._set_stats_signal_handler()
+
+    def _set_stats_signal_handler(self):
+        signal.signal(signal.SIGUSR2, self.handle_sigusr2)
+        signal.siginterrupt(signal.SIGUSR2, False)
+
     def handle_sigterm(self, *args):
         self.shutdown()
 
+    def handle_sigusr2(self, *args):
+        # Dump metrics
+        sys.stderr.write(format_metrics(self.metrics_snapshot()) + '\n')
+        sys.stderr.flush()
+
+    def handle_sigchld(self, *args):
+        self._wake()
+
     def sighup_worker(self, *args):
         self._shutdown_request = True
+        self._wake()
+
+    def _wake(self):
+        wakeup = self._wakeup
+        if wakeup is not None:
+            wakeup.wake()
 
     def sigint_worker(self, *args):
         # Terminate, with extreme prejudice
-        self.listen_sock.close()
+        self._close_listeners()
         self.shutdown()
         sys.exit(0)
 
+    def sigusr1_worker(self, *args):
+        # Cancel the running task, if any
+        get_watchdog().cancel()
+
     def set_worker_signal_handlers(self):
         signal.signal(signal.SIGHUP, self.sighup_worker)
+        signal.signal(signal.SIGUSR1, self.sigusr1_worker)
+        self._set_stats_signal_handler()
         signal.signal(signal.SIGCHLD, signal.SIG_DFL)
         signal.signal(signal.SIGTERM, signal.SIG_DFL)
 
@@ -159,90 +648,649 @@ class IbisServerNode(object):
             # Send SIGHUP to notify workers of shutdown
             os.kill(0, signal.SIGHUP)
         self._shutdown_request = True
+        self._wake()
+
+    def _watch(self, obj):
+        if self._loop is not None:
+            self._loop.register(obj)
+
+    def _unwatch(self, obj):
+        if self._loop is not None:
+            self._loop.unregister(obj)
+
+    def _start_loop(self):
+        self._loop = EventLoop()
+        self._loop.register(self._wakeup)
+        for listener in self._listeners():
+            self._loop.register(listener)
+
+    def _close_loop(self):
+        if self._loop is not None:
+            self._loop.close()
+            self._loop = None
+
+        wakeup, self._wakeup = self._wakeup, None
+        if wakeup is not None:
+            wakeup.close()
+
+    def _after_fork(self):
+        # In a forked child: the event loop and wakeup pipe are the parent's,
+        # so drop them without touching its registrations
+        self._close_loop()
+        self._wakeup = Wakeup()
+
+        # Count from zero; the daemon adds up its workers' metrics
+        get_metrics().clear()
+        self._retired_metrics = None
+
+    def _close_pool(self):
+        for worker in self.pool_workers.values():
+            self._unwatch(worker)
+            worker.close()
+        self.pool_workers.clear()
+
+    def _close_connections(self):
+        for conn in self.connections:
+            self._unwatch(conn)
+            conn.close()
+        self.connections = []
+
+    def _close_listeners(self, unlink=True):
+        """
+        unlink : boolean, default True
+          Remove the Unix domain socket file. Forked children pass False for
+          the sockets they inherited
+        """
+        for listener in self._listeners():
+            self._unwatch(listener)
+
+        self.listen_sock.close()
+
+        if self.unix_sock is not None:
+            self.unix_sock.close()
+            self.unix_sock = None
+            if unlink:
+                try:
+                    os.unlink(self.unix_listen_path)
+                except OSError:
+                    pass
+
+    def _listeners(self):
+        if self.unix_sock is None:
+            return [self.listen_sock]
+        return [self.listen_sock, self.unix_sock]
 
     def setup_server_socket(self):
         # Bind the daemon socket listener
         self.listen_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.listen_sock.bind(('127.0.0.1', 0))
         self.listen_sock.listen(socket.SOMAXCONN)
+        self.listen_sock.setblocking(0)
         _, self.listen_port = self.listen_sock.getsockname()
 
+    def setup_unix_socket(self, path):
+        if os.path.exists(path):
+            # Left over from a process that died
+            os.unlink(path)
+
+        self.unix_sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.unix_sock.bind(path)
+        self.unix_sock.listen(socket.SOMAXCONN)
+        self.unix_sock.setblocking(0)
+        self.unix_listen_path = path
+
     def report_daemon(self):
         print('Running daemon at port %d' % self.listen_port)
         self._server_send(pack_uint32(self.listen_port))
 
     def report_worker_info(self):
-        print('Running worker at port %d' % self.listen_port)
+        if self.unix_sock is not None:
+            print('Running worker at port %d and %s'
+                  % (self.listen_port, self.unix_listen_path))
+        else:
+            print('Running worker at port %d' % self.listen_port)
         # Port and process id (as uint32)
         msg = struct.pack('II', self.listen_port, os.getpid())
         self._server_send(msg)
 
     def _server_send(self, msg):
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.connect(('localhost', self.server_port))
-        sock.send(msg)
+        try:
+            sock.connect(('localhost', self.server_port))
+            sock.sendall(msg)
+
+            data = sock.recv(1024)
+        finally:
+            sock.close()
 
-        data = sock.recv(1024)
         if data != 'ok':
             raise Exception('Server said: %s' % data)
 
     def run_daemon(self):
         self.report_daemon()
 
-        while True:
-            if self._shutdown_request:
-                # shutdown was called
-                self.listen_sock.close()
-                self._is_shutdown.set()
+        self._start_loop()
+
+        if self.prefork:
+            self._preload_modules()
+            self._fill_pool()
+
+        # shutdown may be called from a signal handler or another thread
+        while not self._shutdown_request:
+            listeners = self._listeners()
+            for obj in self._loop.poll(self._daemon_timeout()):
+                if not self._loop.watching(obj):
+                    # Closed while handling an earlier event
+                    continue
+
+                if obj is self._wakeup:
+                    obj.drain()
+                    self.cleanup_zombies()
+                elif obj in listeners:
+                    self._accept(obj, self._handle_daemon_request)
+                elif isinstance(obj, PoolWorker):
+                    self._handle_pool_message(obj)
+                else:
+                    self._read_connection(obj, self._handle_daemon_frame)
+
+            if self.prefork:
+                # Catch up after a respawn backoff
+                self._fill_pool()
+                self._assign_tasks()
+
+        self._close_listeners()
+        self._close_pool()
+        self._close_connections()
+        self._close_loop()
+        self._is_shutdown.set()
+
+    def _daemon_timeout(self):
+        # Only a pool respawn backing off needs a timer
+        now = time.time()
+        if self.prefork and self._next_spawn_time > now:
+            return self._next_spawn_time - now
+        return None
+
+    def _accept(self, listener, handle_request):
+        # Take the whole backlog, up to ACCEPT_BATCH connections
+        for i in range(ACCEPT_BATCH):
+            try:
+                sock, _ = listener.accept()
+            except socket.error as e:
+                if e.args[0] in (errno.EINTR, errno.ECONNABORTED):
+                    continue
+                elif e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                raise
+
+            # Accepted sockets may inherit O_NONBLOCK on some platforms
+            sock.setblocking(1)
+
+            if not _is_framed(sock):
+                handle_request(sock)
+                if self._shutdown_request:
+                    return
+                continue
+
+            conn = FramedConnection(sock)
+            self.connections.append(conn)
+            self._watch(conn)
+
+    def _read_connection(self, conn, handle_frame):
+        frames = conn.read_frames()
+        if frames is None:
+            self._unwatch(conn)
+            conn.close()
+            self.connections.remove(conn)
+            return
+
+        for msg_type, request_id, payload in frames:
+            handle_frame(conn, msg_type, request_id, payload)
+
+    def _handle_daemon_request(self, sock):
+        # One-shot requests: new, task <encoded>, cancel <encoded>, stats,
+        # shutdown, kill <pid>
+        msg = sock.recv(1024)
+
+        if msg == 'new':
+            error = self._new_worker()
+            if error is None:
+                sock.send('ok')
+            else:
+                # Signal that the fork failed
+                sock.send(pack_uint32(error.errno))
+        elif msg.startswith('task'):
+            # e.g. task <encoded IbisTaskMessage>
+            error = self._dispatch_task(msg[4:])
+            sock.send('ok' if error is None else error)
+        elif msg.startswith('cancel'):
+            error = self._cancel_task(msg[6:])
+            sock.send('ok' if error is None else error)
+        elif msg == 'stats':
+            sock.sendall(json.dumps(self.metrics_snapshot()))
+        elif msg == 'shutdown':
+            self.shutdown()
+            sock.send('ok')
+        elif msg.startswith('kill'):
+            # e.g. kill 12345
+            self._kill_worker(int(msg[4:]))
+            sock.send('ok')
+
+        sock.close()
+
+    def _handle_daemon_frame(self, conn, msg_type, request_id, payload):
+        error = None
+
+        if msg_type == MSG_NEW_WORKER:
+            error = self._new_worker()
+            if error is not None:
+                error = 'fork failed: %s' % error
+        elif msg_type == MSG_TASK:
+            error = self._dispatch_task(payload)
+        elif msg_type == MSG_CANCEL:
+            error = self._cancel_task(payload)
+        elif msg_type == MSG_STATS:
+            conn.reply(request_id, MSG_OK,
+                       json.dumps(self.metrics_snapshot()))
+            return
+        elif msg_type == MSG_KILL:
+            self._kill_worker(struct.unpack('I', payload)[0])
+        elif msg_type == MSG_SHUTDOWN:
+            self.shutdown()
+        else:
+            error = 'Unknown message type %d' % msg_type
+
+        if error is None:
+            conn.reply(request_id, MSG_OK)
+        else:
+            conn.reply(request_id, MSG_ERROR, error)
+
+    def _new_worker(self):
+        """
+        Returns None if a worker was started, otherwise the OSError from
+        forking
+        """
+        if self.prefork and self._detach_idle_worker():
+            return None
+
+        try:
+            fork_ind = os.fork()
+        except OSError as e:
+            if e.errno in (errno.EAGAIN, errno.EINTR):
+                time.sleep(1)
+                fork_ind = os.fork()  # error here will shutdown daemon
+            else:
+                get_metrics().incr('fork_failures')
+                return e
+
+        if fork_ind == 0:
+            self._after_fork()
+            self._close_pool()
+            self._close_connections()
+            self.become_worker()
+
+            sys.stdout.flush()
+            os._exit(0)
+
+        get_metrics().incr('forks.worker')
+        return None
+
+    def _kill_worker(self, worker_pid):
+        print 'Killing %d' % worker_pid
+        try:
+            os.kill(worker_pid, signal.SIGINT)
+        except OSError:
+            pass  # process already died
+
+    # ------------------------------------------------------------------
+    # Pre-forked worker pool, daemon side
+
+    def _preload_modules(self):
+        for name in PRELOAD_MODULES:
+            try:
+                __import__(name)
+            except ImportError:
+                pass
+
+    def _fill_pool(self):
+        while len(self.pool_workers) < self.min_workers:
+            if self._fork_pool_worker() is None:
                 break
 
-            ready_fds = _eintr_retry(select.select, [self.listen_sock],
-                                     [], [], SELECT_TIMEOUT)[0]
+    def _fork_pool_worker(self):
+        """
+        Returns None if forking is backing off after failures or failed
+        """
+        if time.time() < self._next_spawn_time:
+            return None
 
-            # cleanup in signal handler will cause deadlock
-            self.cleanup_zombies()
+        daemon_conn, worker_conn = socket.socketpair()
 
-            if self.listen_sock not in ready_fds:
-                continue
+        try:
+            pid = os.fork()
+        except OSError:
+            traceback.print_exc()
+            daemon_conn.close()
+            worker_conn.close()
+            get_metrics().incr('fork_failures')
+            self._spawn_failed()
+            return None
+
+        if pid == 0:
+            self._after_fork()
+            daemon_conn.close()
+            try:
+                self.become_pool_worker(worker_conn)
+            finally:
+                os._exit(0)
+
+        worker_conn.close()
+        get_metrics().incr('forks.pool')
+        worker = PoolWorker(pid, daemon_conn)
+        self.pool_workers[pid] = worker
+        self._watch(worker)
+        return worker
+
+    def _idle_workers(self):
+        return [w for w in self.pool_workers.values() if w.idle]
+
+    def _detach_idle_worker(self):
+        # Hand over a warm worker as a dedicated (non-pool) worker
+        idle = self._idle_workers()
+        if not idle:
+            return False
+
+        worker = idle[0]
+        del self.pool_workers[worker.pid]
+        self._unwatch(worker)
+        self._retire_metrics(worker)
+        try:
+            worker.send('detach')
+        except socket.error:
+            # It died in the meantime; fall back on forking
+            worker.close()
+            return False
+        worker.close()
+        get_metrics().incr('pool.detached')
+
+        self._fill_pool()
+        return True
+
+    def _dispatch_task(self, encoded_task):
+        """
+        Returns None once the task is queued, otherwise an error message
+        """
+        try:
+            IbisTaskMessage.decode(encoded_task)
+        except:
+            return traceback.format_exc()
 
-            sock, _ = _eintr_retry(self.listen_sock.accept)
-            msg = sock.recv(1024)
+        if not self.prefork:
+            return 'Daemon was not started in pre-fork mode'
 
-            if msg == 'new':
-                try:
-                    fork_ind = os.fork()
-                except OSError as e:
-                    if e.errno in (errno.EAGAIN, errno.EINTR):
-                        time.sleep(1)
-                        fork_ind = os.fork()  # error here will shutdown daemon
-                    else:
-                        # Signal that the fork failed
-                        sock.send(pack_uint32(e.errno))
-                        sock.close()
-                        continue
-
-                # Fork succeeded
-                if fork_ind == 0:
-                    self.become_worker(sock)
-                else:
-                    # Daemon process
-                    sock.send('ok')
-                    sock.close()
-            elif msg == 'shutdown':
-                self.shutdown()
-                sock.send('ok')
-                sock.close()
-                continue
-            elif msg.startswith('kill'):
-                # e.g. kill 12345
-                worker_pid = int(msg[4:])
-                print 'Killing %d' % worker_pid
+        self.task_queue.append((encoded_task, time.time()))
+        get_metrics().incr('tasks_dispatched')
+        self._assign_tasks()
+        return None
+
+    def _cancel_task(self, encoded_task):
+        """
+        Drop a queued task, or interrupt the pool worker running it. Returns
+        None, or an error message if there is no such task
+        """
+        try:
+            task_msg = IbisTaskMessage.decode(encoded_task)
+        except:
+            return traceback.format_exc()
+
+        for i, (queued, _) in enumerate(self.task_queue):
+            queued_msg = IbisTaskMessage.decode(queued)
+            if queued_msg.same_task(task_msg):
+                del self.task_queue[i]
+                report_task_failure(queued_msg, 'Task was cancelled')
+                get_metrics().incr('tasks_cancelled')
+                return None
+
+        for worker in self.pool_workers.values():
+            if (worker.task is not None and
+                    IbisTaskMessage.decode(worker.task).same_task(task_msg)):
                 try:
-                    os.kill(worker_pid, signal.SIGINT)
+                    os.kill(worker.pid, signal.SIGUSR1)
                 except OSError:
-                    pass  # process already died
-                sock.send('ok')
-                sock.close()
+                    pass  # it died; its task is failed when we notice
+                get_metrics().incr('tasks_cancelled')
+                return None
+
+        return 'No such task (it may have finished)'
+
+    def _assign_tasks(self):
+        while self.task_queue:
+            idle = self._idle_workers()
+            if not idle:
+                starting = [w for w in self.pool_workers.values()
+                            if not w.started]
+                if (not starting and
+                        len(self.pool_workers) < self.max_workers):
+                    # It will ask for work once it's ready
+                    self._fork_pool_worker()
+                return
+
+            worker = idle[0]
+            task, queued_at = self.task_queue.pop(0)
+            try:
+                worker.send('task' + task)
+            except socket.error:
+                # Never got to the worker, so try another one
+                self.task_queue.insert(0, (task, queued_at))
+                self._remove_pool_worker(worker)
+            else:
+                get_metrics().observe('queue_wait', time.time() - queued_at)
+                self._set_worker_idle(worker, False)
+                worker.task = task
+
+    def _handle_pool_message(self, worker):
+        try:
+            msg = _recv_frame(worker.conn)
+        except socket.error:
+            msg = None
+
+        if msg is not None and msg.startswith('metrics'):
+            worker.metrics = json.loads(msg[7:])
+            return
+        elif msg in ('ready', 'done'):
+            if not worker.started:
+                worker.started = True
+                self._spawn_failures = 0
+                get_metrics().observe('pool.worker_startup',
+                                      worker.elapsed())
+            worker.task = None
+            self._set_worker_idle(worker, True)
+        elif msg in ('retire', 'killed'):
+            # Its task is settled either way
+            worker.task = None
+            get_metrics().incr('pool.%s' % msg)
+            self._remove_pool_worker(worker)
+        else:
+            # The worker died
+            get_metrics().incr('pool.died')
+            self._remove_pool_worker(worker)
+
+        self._fill_pool()
+        self._assign_tasks()
+
+    def _remove_pool_worker(self, worker):
+        self._unwatch(worker)
+        worker.close()
+        del self.pool_workers[worker.pid]
+        self._retire_metrics(worker)
+
+        if not worker.started:
+            self._spawn_failed()
+
+        if worker.task is not None:
+            # Don't leave the requesting process waiting forever
+            message = ('Worker %d died while running the task' % worker.pid)
+            try:
+                report_task_failure(IbisTaskMessage.decode(worker.task),
+                                    message)
+            except:
+                traceback.print_exc()
+
+    def _set_worker_idle(self, worker, idle):
+        # Account for the time spent in the current state first
+        self._account_worker_time(worker)
+        worker.idle = idle
+
+    def _account_worker_time(self, worker):
+        # Until it has started, the time goes to pool.worker_startup
+        if worker.started:
+            get_metrics().incr('pool.%s_seconds'
+                               % ('idle' if worker.idle else 'busy'),
+                               worker.elapsed())
+
+    def _retire_metrics(self, worker):
+        # Keep the counts of a worker that is leaving the pool
+        self._account_worker_time(worker)
+        if worker.metrics is None:
+            return
+
+        # What it held on to is gone (or no longer the pool's)
+        worker.metrics['gauges'] = {}
+        if self._retired_metrics is None:
+            self._retired_metrics = worker.metrics
+        else:
+            self._retired_metrics = merge_snapshots(
+                [self._retired_metrics, worker.metrics])
+        worker.metrics = None
+
+    def metrics_snapshot(self):
+        """
+        Snapshot of this process's metrics (see ibis.metrics). A pre-fork
+        daemon adds in those its pool workers last reported, as well as
+        queue depth and pool utilization gauges
+        """
+        if not (self.is_daemon and self.prefork):
+            return metrics_snapshot()
+
+        metrics = get_metrics()
+        for worker in self.pool_workers.values():
+            self._account_worker_time(worker)
+
+        metrics.set_gauge('queue_depth', len(self.task_queue))
+        metrics.set_gauge('pool.workers', len(self.pool_workers))
+        metrics.set_gauge('pool.idle_workers', len(self._idle_workers()))
+
+        snapshots = [metrics_snapshot()]
+        if self._retired_metrics is not None:
+            snapshots.append(self._retired_metrics)
+        snapshots.extend(w.metrics for w in self.pool_workers.values()
+                         if w.metrics is not None)
+        result = merge_snapshots(snapshots)
+
+        counters = result['counters']
+        busy = counters.get('pool.busy_seconds', 0)
+        total = busy + counters.get('pool.idle_seconds', 0)
+        result['gauges']['pool.utilization'] = busy / total if total else 0.
+        return result
+
+    def _spawn_failed(self):
+        self._spawn_failures += 1
+        delay = min(POOL_RESPAWN_BACKOFF * 2 ** (self._spawn_failures - 1),
+                    POOL_RESPAWN_BACKOFF_MAX)
+        self._next_spawn_time = time.time() + delay
+
+    # ------------------------------------------------------------------
+    # Pre-forked worker pool, worker side
+
+    def become_pool_worker(self, conn):
+        self._close_listeners(unlink=False)
+        self._close_pool()
+        self._close_connections()
+        self.task_queue = []
+
+        self.is_daemon = False
+        self.set_worker_signal_handlers()
+
+        tasks_run = 0
+        next_report = time.time() + METRICS_REPORT_INTERVAL
+        _send_frame(conn, 'ready')
+
+        loop = EventLoop()
+        loop.register(conn)
+        loop.register(self._wakeup)
+
+        while not self._shutdown_request:
+            ready = loop.poll(self._idle_timeout())
+            if not ready:
+                reclaim_segments()
+                continue
+
+            if self._wakeup in ready:
+                self._wakeup.drain()
+            if conn not in ready:
+                continue
+
+            try:
+                msg = _recv_frame(conn)
+            except socket.error:
+                # e.g. interrupted by SIGHUP
+                continue
+
+            if msg is None:
+                # Daemon went away
+                break
+            elif msg == 'detach':
+                loop.close()
+                conn.close()
+                self._setup_worker_sockets()
+                self.run_worker()
+                return
+            elif msg.startswith('task'):
+                self._run_pool_task(msg[4:], conn)
+                tasks_run += 1
+
+                retire = self._should_retire(tasks_run)
+                if retire or time.time() >= next_report:
+                    _send_frame(conn, 'metrics' +
+                                json.dumps(metrics_snapshot()))
+                    next_report = time.time() + METRICS_REPORT_INTERVAL
+
+                if retire:
+                    _send_frame(conn, 'retire')
+                    break
+                _send_frame(conn, 'done')
+
+        loop.close()
+        conn.close()
+
+    def _run_pool_task(self, encoded_task, conn):
+        def on_kill():
+            # The watchdog failed the task before exiting; the daemon must
+            # not do so again
+            _send_frame(conn, 'killed')
+
+        try:
+            task_msg = IbisTaskMessage.decode(encoded_task)
+
+            # We may retire right after handing control back; SEM_UNDO would
+            # then revert the handoff
+            IbisTaskExecutor(task_msg, lock_undo=False,
+                             on_kill=on_kill).execute()
+        except:
+            # Task failures are reported through shared memory; anything
+            # else can only be logged
+            traceback.print_exc()
+
+    def _should_retire(self, tasks_run):
+        if (self.max_worker_tasks is not None and
+                tasks_run >= self.max_worker_tasks):
+            return True
+
+        if (self.max_worker_rss is not None and
+                _max_rss_bytes() > self.max_worker_rss):
+            return True
+
+        return False
 
     def cleanup_zombies(self):
         try:
@@ -253,53 +1301,100 @@ class IbisServerNode(object):
         except:
             pass
 
-    def become_worker(self, sock):
-        """
-        sock :
-        """
-        # in child process, close the server socket
-        self.listen_sock.close()
+    def become_worker(self, sock=None):
+        # in child process, close the server sockets
+        self._close_listeners(unlink=False)
 
         self.is_daemon = False
 
         # Setup a new socket server on some available port
-        self.setup_server_socket()
+        self._setup_worker_sockets()
         self.set_worker_signal_handlers()
         self.run_worker()
 
+    def _setup_worker_sockets(self):
+        self.setup_server_socket()
+        if self.unix_path is not None:
+            self.setup_unix_socket(worker_unix_path(self.unix_path,
+                                                    os.getpid()))
+
     def run_worker(self):
         self.report_worker_info()
+        self._start_loop()
 
-        while True:
-            if self._shutdown_request:
-                # Triggered by SIGHUP
-                self.listen_sock.close()
-                self._is_shutdown.set()
-                break
-
+        # Until SIGHUP
+        while not self._shutdown_request:
             # Await instructions
-            ready_fds = _eintr_retry(select.select, [self.listen_sock],
-                                     [], [], SELECT_TIMEOUT)[0]
-            if not ready_fds:
+            listeners = self._listeners()
+            ready = self._loop.poll(self._idle_timeout())
+            if not ready:
+                reclaim_segments()
                 continue
 
-            sock, _ = _eintr_retry(self.listen_sock.accept)
+            for obj in ready:
+                if not self._loop.watching(obj):
+                    continue
 
-            task = self.task_handler(sock)
+                if obj is self._wakeup:
+                    obj.drain()
+                elif obj in listeners:
+                    self._accept(obj, self._handle_worker_request)
+                else:
+                    self._read_connection(obj, self._handle_worker_frame)
+
+        self._close_listeners()
+        self._close_connections()
+        self._close_loop()
+        self._is_shutdown.set()
+
+    def _idle_timeout(self):
+        # Pooled shared memory and resident aggregation states are all there
+        # is to look after between tasks
+        if len(get_segment_pool()) or len(get_agg_states()):
+            return RECLAIM_INTERVAL
+        return None
+
+    def _handle_worker_request(self, sock):
+        # One-shot request: an encoded task
+        task = self.task_handler(sock)
+        self._run_in_worker(task.run)
+
+    def _handle_worker_frame(self, conn, msg_type, request_id, payload):
+        if msg_type == MSG_STATS:
+            conn.reply(request_id, MSG_OK,
+                       json.dumps(self.metrics_snapshot()))
+            return
+        elif msg_type != MSG_TASK:
+            conn.reply(request_id, MSG_ERROR,
+                       'Unknown message type %d' % msg_type)
+            return
 
-            if self.threaded_worker:
-                # Spawn task in a daemon. These threads should not stay alive
-                # if main worker thread exits. Revisit this at some point.
-                t = threading.Thread(target=task.run)
-                t.daemon = True
-                t.start()
-            else:
-                # Run the task synchronously
-                try:
-                    task.run()
-                except:
-                    # Exception reporting is the task's job
-                    pass
+        try:
+            task_msg = IbisTaskMessage.decode(payload)
+        except:
+            conn.reply(request_id, MSG_ERROR, traceback.format_exc())
+            return
+
+        # Acknowledge successful receipt
+        conn.reply(request_id, MSG_OK)
+
+        handler = self.task_handler(None)
+        self._run_in_worker(lambda: handler.execute(task_msg))
+
+    def _run_in_worker(self, func):
+        if self.threaded_worker:
+            # Spawn task in a daemon. These threads should not stay alive
+            # if main worker thread exits. Revisit this at some point.
+            t = threading.Thread(target=func)
+            t.daemon = True
+            t.start()
+        else:
+            # Run the task synchronously
+            try:
+                func()
+            except:
+                # Exception reporting is the task's job
+                pass
 
 
 def parse_cl_args():
@@ -311,6 +1406,23 @@ def parse_cl_args():
     parser.add_argument('-p', '--port', type=int, dest='impala_port',
                         default=17001, action='store')
 
+    parser.add_argument('--unix-path', dest='unix_path', default=None,
+                        action='store',
+                        help='Also listen on a Unix domain socket')
+
+    parser.add_argument('--prefork', dest='prefork', default=False,
+                        action='store_true')
+    parser.add_argument('--min-workers', type=int, dest='min_workers',
+                        default=2, action='store')
+    parser.add_argument('--max-workers', type=int, dest='max_workers',
+                        default=8, action='store')
+    parser.add_argument('--max-worker-tasks', type=int,
+                        dest='max_worker_tasks', default=None,
+                        action='store')
+    parser.add_argument('--max-worker-rss', type=int, dest='max_worker_rss',
+                        default=None, action='store',
+                        help='Peak resident memory in bytes')
+
     return parser.parse_known_args()[0]
 
 
@@ -318,7 +1430,12 @@ if __name__ == '__main__':
     args = parse_cl_args()
 
     if args.is_daemon:
-        node = IbisServerNode(args.impala_port)
+        node = IbisServerNode(args.impala_port, prefork=args.prefork,
+                              min_workers=args.min_workers,
+                              max_workers=args.max_workers,
+                              max_worker_tasks=args.max_worker_tasks,
+                              max_worker_rss=args.max_worker_rss,
+                              unix_path=args.unix_path)
         try:
             node.run_daemon()
         except SystemExit:
@@ -14,6 +14,8 @@
 
 from collections import defaultdict
 
+from ibis.config import options
+from ibis.expr.optimize import optimize
 import ibis.common as com
 import ibis.expr.analysis as L
 import ibis.expr.operations as ops
@@ -26,6 +28,10 @@ import ibis.util as util
 
 
 def build_ast(expr, context=None):
+    if context is None:
+        # Not for nested queries, which are parts of an optimized expression
+        expr = optimize(expr)
+
     builder = QueryBuilder(expr, context=context)
     return builder.get_result()
 
@@ -48,10 +54,16 @@ def to_sql(expr, context=None):
 
 class QueryAST(object):
 
-    def __init__(self, context, queries):
+    def __init__(self, context, queries, setup_queries=None,
+                 teardown_queries=None):
         self.context = context
         self.queries = queries
 
+        # DDL statements to execute before and after the queries, e.g. to
+        # create and drop temporary tables they refer to
+        self.setup_queries = setup_queries or []
+        self.teardown_queries = teardown_queries or []
+
 
 class QueryBuilder(object):
 
@@ -66,23 +78,33 @@ class QueryBuilder(object):
     def get_result(self):
         op = self.expr.op()
 
-        # TODO: any setup / teardown DDL statements will need to be done prior
-        # to building the result set-generating statements.
+        self.setup_queries = []
+        self.teardown_queries = []
         if isinstance(op, ops.Union):
             query = self._make_union()
         else:
             query = self._make_select()
 
-        return QueryAST(self.context, [query])
+        return QueryAST(self.context, [query],
+                        setup_queries=self.setup_queries,
+                        teardown_queries=self.teardown_queries)
 
     def _make_union(self):
+        # Setup / teardown DDL statements are done prior to building the
+        # result set-generating statements
+        self.setup_queries, self.teardown_queries = \
+            _materialization_queries(self.expr, self.context)
+
         op = self.expr.op()
         return ddl.Union(op.left, op.right, distinct=op.distinct,
                          context=self.context)
 
     def _make_select(self):
         builder = SelectBuilder(self.expr, self.context)
-        return builder.get_result()
+        query = builder.get_result()
+        self.setup_queries = builder.setup_queries
+        self.teardown_queries = builder.teardown_queries
+        return query
 
 
 class SelectBuilder(object):
@@ -106,6 +128,8 @@ class SelectBuilder(object):
 
         self.context = context
         self.queries = []
+        self.setup_queries = []
+        self.teardown_queries = []
 
         self.table_set = None
         self.select_set = None
@@ -134,6 +158,9 @@ class SelectBuilder(object):
 
         select_query = self._build_result_query()
 
+        self.setup_queries = setup_queries
+        self.teardown_queries = teardown_queries
+
         self.queries.extend(setup_queries)
         self.queries.append(select_query)
         self.queries.extend(teardown_queries)
@@ -141,10 +168,14 @@ class SelectBuilder(object):
         return select_query
 
     def _generate_setup_queries(self):
-        return []
+        # Computes subqueries into temporary tables; the context records them
+        # for the select statement(s) built afterwards
+        setup_queries, self._drop_queries = \
+            _materialization_queries(self.query_expr, self.context)
+        return setup_queries
 
     def _generate_teardown_queries(self):
-        return []
+        return self._drop_queries
 
     def _build_result_query(self):
         self._collect_elements()
@@ -416,7 +447,8 @@ class SelectBuilder(object):
         if hasattr(self, method):
             f = getattr(self, method)
             f(expr, toplevel=toplevel)
-        elif isinstance(op, (ops.PhysicalTable, ops.SQLQueryResult)):
+        elif isinstance(op, (ops.PhysicalTable, ops.SQLQueryResult,
+                             ops.MaterializedSubquery)):
             self._collect_PhysicalTable(expr, toplevel=toplevel)
         elif isinstance(op, ops.Join):
             self._collect_Join(expr, toplevel=toplevel)
@@ -632,6 +664,10 @@ class _ExtractSubqueries(object):
         return expr in self.observed_exprs
 
     def visit(self, expr):
+        if self._is_materialized(expr):
+            # Refer to a temporary table; nothing to extract
+            return
+
         node = expr.op()
         method = '_visit_{0}'.format(type(node).__name__)
 
@@ -650,6 +686,10 @@ class _ExtractSubqueries(object):
         else:
             raise NotImplementedError(type(node))
 
+    def _is_materialized(self, expr):
+        return (isinstance(expr, ir.TableExpr) and
+                self.query.context.is_materialized(expr))
+
     def _visit_join(self, expr):
         node = expr.op()
         self.visit(node.left)
@@ -658,6 +698,7 @@ class _ExtractSubqueries(object):
     _visit_physical_table = _extract_noop
     _visit_ExistsSubquery = _extract_noop
     _visit_NotExistsSubquery = _extract_noop
+    _visit_MaterializedSubquery = _extract_noop
 
     def _visit_Aggregation(self, expr):
         self.observe(expr)
@@ -695,6 +736,222 @@ class _ExtractSubqueries(object):
         self.visit(expr.op().table)
 
 
+# ---------------------------------------------------------------------
+# Materialization of subqueries into temporary tables
+
+
+def _materialization_queries(expr, context):
+    """
+    Pick the subqueries of a query to compute into temporary tables first:
+    those marked with TableExpr.materialize(temporary=True) and, if
+    options.impala.materialize_subqueries is set, expensive ones (see
+    _is_expensive) referenced more than once. Records the tables in the
+    context, so that the query refers to them rather than to the subqueries.
+
+    Returns
+    -------
+    setup_queries, teardown_queries : lists of CTAS / DROP TABLE statements
+    """
+    # Only the outermost query picks. Nested queries (built from its
+    # context) see the temporary tables through the context
+    if context.parent is not None:
+        return [], []
+
+    finder = _FindMaterializations(
+        expr, repeated=options.impala.materialize_subqueries)
+
+    database = options.impala.temp_db
+    setup_queries = []
+    teardown_queries = []
+
+    # Inner subqueries come first, so that their tables exist by the time
+    # the subqueries using them are computed
+    for sub_expr in finder.get_result():
+        table_name = 'ibis_tmp_{0}'.format(util.guid())
+        context.set_materialized(sub_expr,
+                                 '{0}.{1}'.format(database, table_name))
+
+        op = sub_expr.op()
+        if isinstance(op, ops.MaterializedSubquery):
+            sub_expr = op.table
+
+        select = build_ast(sub_expr, context.subcontext()).queries[0]
+        setup_queries.append(ddl.CTAS(table_name, select, database=database))
+        teardown_queries.append(ddl.DropTable(table_name, database=database,
+                                              must_exist=False))
+
+    return setup_queries, teardown_queries
+
+
+class _FindMaterializations(_ExtractSubqueries):
+
+    # Walks a whole expression, subqueries in predicates and select sets
+    # included, counting the references to each subquery. Unlike in a WITH
+    # clause, a temporary table can serve nested queries too
+
+    def __init__(self, expr, repeated=False):
+        _ExtractSubqueries.__init__(self, None)
+        self.expr = expr
+        self.repeated = repeated
+
+        # ids of the table nodes walked
+        self.walked = set()
+
+    def get_result(self):
+        self.visit(self.expr)
+
+        to_materialize = []
+        for expr, key in zip(self.observed_exprs.keys,
+                             self.observed_exprs.values):
+            if isinstance(expr.op(), ops.MaterializedSubquery):
+                to_materialize.append(expr)
+            elif (self.repeated and self.expr_counts[key] > 1 and
+                  _is_expensive(expr)):
+                to_materialize.append(expr)
+
+        return _dependency_order(to_materialize)
+
+    def _is_materialized(self, expr):
+        return False
+
+    def visit(self, expr):
+        if isinstance(expr, ir.TableExpr):
+            # A further reference to a subquery, which need not be walked
+            # again
+            if self._has_been_observed(expr):
+                self.observe(expr)
+                return
+            self.walked.add(id(expr.op()))
+
+        _ExtractSubqueries.visit(self, expr)
+
+    def _visit_values(self, table, exprs):
+        # Expressions of a table node reading the indicated table (walked
+        # already). Skipping tables in select sets, which are not references
+        # of their own
+        scope = set(id(x.op()) for x in _local_tables(table))
+        for expr in exprs:
+            if isinstance(expr, ir.ValueExpr):
+                self._visit_value(expr, scope)
+
+    def _visit_value(self, expr, scope=None):
+        # Referring to a table in scope, e.g. with a column or count(), is no
+        # reference of its own. Other tables are subqueries, e.g. in an IN
+        # predicate. Without a scope, tables are walked once
+        for arg in expr.op().flat_args():
+            if isinstance(arg, ir.TableExpr):
+                key = id(arg.op())
+                if scope is None:
+                    if key not in self.walked:
+                        self.visit(arg)
+                elif key not in scope:
+                    self.visit(arg)
+            elif isinstance(arg, ir.Expr):
+                self._visit_value(arg, scope=scope)
+
+    def _visit_join(self, expr):
+        node = expr.op()
+        self.visit(node.left)
+        self.visit(node.right)
+        self._visit_values(expr, node.predicates)
+
+    def _visit_Aggregation(self, expr):
+        node = expr.op()
+        self.observe(expr)
+        self.visit(node.table)
+        self._visit_values(node.table,
+                           node.by + node.agg_exprs + node.having)
+
+    def _visit_Distinct(self, expr):
+        self.observe(expr)
+        self.visit(expr.op().table)
+
+    def _visit_Filter(self, expr):
+        node = expr.op()
+        self.visit(node.table)
+        self._visit_values(node.table, node.predicates)
+
+    def _visit_Projection(self, expr):
+        node = expr.op()
+        self.observe(expr)
+        self.visit(node.table)
+        self._visit_values(node.table, node.selections)
+
+    def _visit_Union(self, expr):
+        node = expr.op()
+        self.observe(expr)
+        self.visit(node.left)
+        self.visit(node.right)
+
+    def _visit_ExpressionList(self, expr):
+        for value in expr.exprs():
+            self._visit_value(value)
+
+    def _visit_MaterializedJoin(self, expr):
+        self.visit(expr.op().join)
+
+    def _visit_MaterializedSubquery(self, expr):
+        self.observe(expr)
+        self.visit(expr.op().table)
+
+
+def _dependency_order(exprs):
+    # Tables first, then the tables computed from them (which may be observed
+    # earlier, e.g. on the left of a join)
+    beneath = dict((id(expr), _ops_beneath(expr)) for expr in exprs)
+
+    ordered = []
+    remaining = list(exprs)
+    while remaining:
+        for expr in remaining:
+            if not any(id(other.op()) in beneath[id(expr)]
+                       for other in remaining if other is not expr):
+                break
+        remaining.remove(expr)
+        ordered.append(expr)
+    return ordered
+
+
+def _ops_beneath(expr):
+    # ids of the nodes an expression is computed from
+    seen = set()
+    stack = [expr]
+    while stack:
+        for arg in stack.pop().op().flat_args():
+            if isinstance(arg, ir.Expr) and id(arg.op()) not in seen:
+                seen.add(id(arg.op()))
+                stack.append(arg)
+    return seen
+
+
+def _local_tables(expr):
+    # A table and the tables it reads from without a subquery: through
+    # filters, sorts and joins
+    tables = [expr]
+    op = expr.op()
+    if isinstance(op, ops.Join):
+        tables.extend(_local_tables(op.left))
+        tables.extend(_local_tables(op.right))
+    elif isinstance(op, (ops.Filter, ops.SortBy, ops.Limit)):
+        tables.extend(_local_tables(op.table))
+    elif isinstance(op, ops.MaterializedJoin):
+        tables.extend(_local_tables(op.join))
+    return tables
+
+
+def _is_expensive(expr):
+    # Aggregates, deduplicates or joins somewhere, or is SQL of unknown cost
+    op = expr.op()
+    if isinstance(op, (ops.Aggregation, ops.Distinct, ops.Union, ops.Join,
+                       ops.MaterializedJoin, ops.SQLQueryResult)):
+        return True
+    elif isinstance(op, ops.PhysicalTable):
+        return False
+
+    return any(_is_expensive(arg) for arg in op.flat_args()
+               if isinstance(arg, ir.TableExpr))
+
+
 def _foreign_ref_check(query, expr):
     checker = _CorrelatedRefCheck(query, expr)
     return checker.get_result()
@@ -747,6 +1004,11 @@ class _CorrelatedRefCheck(object):
     def _visit_table(self, expr, in_subquery=False):
         node = expr.op()
 
+        if self.ctx.is_materialized(expr):
+            # Stored by a setup query and referenced like a physical table
+            self._ref_check(node, in_subquery=in_subquery)
+            return
+
         if isinstance(node, (ops.PhysicalTable, ops.SelfReference)):
             self._ref_check(node, in_subquery=in_subquery)
 
@@ -36,6 +36,9 @@ class QueryContext(object):
 
         self.always_alias = False
 
+        # table key -> name of the temporary table it is computed into
+        self.materialized_tables = {}
+
         self.query = None
 
         self._table_key_memo = {}
@@ -71,6 +74,24 @@ class QueryContext(object):
         self.extracted_subexprs.add(key)
         self.make_alias(expr)
 
+    def is_materialized(self, expr):
+        materialized = self.top_context.materialized_tables
+        if not materialized:
+            return False
+        return self._get_table_key(expr) in materialized
+
+    def set_materialized(self, expr, table_name):
+        """
+        Refer to a subquery by the (fully qualified) temporary table it is
+        computed into, from here and any nested query
+        """
+        key = self._get_table_key(expr)
+        self.top_context.materialized_tables[key] = table_name
+
+    def get_materialized(self, expr):
+        key = self._get_table_key(expr)
+        return self.top_context.materialized_tables.get(key)
+
     def get_formatted_query(self, expr):
         from ibis.sql.compiler import to_sql
 
@@ -417,6 +417,10 @@ def _format_table(ctx, expr, indent=2):
                                     .format(expr))
         result = quote_identifier(name)
         is_subquery = False
+    elif ctx.is_materialized(ref_expr):
+        # Computed into a temporary table by a setup query
+        result = ctx.get_materialized(ref_expr)
+        is_subquery = False
     else:
         # A subquery
         if ctx.is_extracted(ref_expr):
@@ -0,0 +1,199 @@
+# Copyright 2015 Cloudera Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Execution of the statements of a compiled query (QueryAST) in stages:
+# setup (e.g. computing subqueries into temporary tables), the queries
+# producing the result, and teardown (dropping the tables again)
+
+import sys
+import threading
+import time
+
+import six
+
+from ibis.metrics import get_metrics
+import ibis.sql.ddl as ddl
+
+
+class QueryPipeline(object):
+
+    """
+    Runs a QueryAST's setup statements, then its queries, then its teardown
+    statements, the latter even if anything before them failed.
+
+    Setup statements not reading each other's tables run concurrently, each
+    on a connection of the client's pool, and so do the teardown statements.
+
+    Parameters
+    ----------
+    client : SQLClient
+    ast : QueryAST
+    max_concurrent : int, default 4
+      Most statements to run at once
+    """
+
+    def __init__(self, client, ast, max_concurrent=4):
+        self.client = client
+        self.ast = ast
+        self.max_concurrent = max_concurrent
+
+        # (stage, seconds) for each stage run
+        self.timings = []
+
+    def execute(self, main=None):
+        """
+        Parameters
+        ----------
+        main : function, optional
+          Runs the statement(s) producing the result, once setup is done. By
+          default, the AST's queries
+
+        Returns
+        -------
+        result : what main returns; by default the result of the last
+          SELECT query
+        """
+        if main is None:
+            main = self._run_queries
+
+        try:
+            self._run_stage('setup', self._run_setup)
+            result = self._run_stage('query', main)
+        except:
+            exc_info = sys.exc_info()
+            try:
+                self._run_stage('teardown', self._run_teardown)
+            except Exception:
+                # The original error is the one to report
+                pass
+            six.reraise(*exc_info)
+
+        self._run_stage('teardown', self._run_teardown)
+        return result
+
+    def format_timings(self):
+        return ', '.join('{0} {1:.3f}s'.format(stage, seconds)
+                         for stage, seconds in self.timings)
+
+    def _run_stage(self, stage, func):
+        start = time.time()
+        try:
+            return func()
+        finally:
+            elapsed = time.time() - start
+            self.timings.append((stage, elapsed))
+            get_metrics().observe('pipeline.{0}'.format(stage), elapsed)
+
+    def _run_setup(self):
+        statements = self.ast.setup_queries
+        if not statements:
+            return
+
+        self.client._ensure_temp_db_exists()
+
+        sql_strings = [stmt.compile() for stmt in statements]
+        depends = _setup_dependencies(statements, sql_strings)
+        self._run_concurrently(sql_strings, depends)
+
+    def _run_queries(self):
+        output = None
+        for query in self.ast.queries:
+            result = self.client._execute_query(query)
+            if isinstance(query, ddl.Select):
+                output = result
+        return output
+
+    def _run_teardown(self):
+        sql_strings = [stmt.compile() for stmt in self.ast.teardown_queries]
+        depends = [set() for x in sql_strings]
+        self._run_concurrently(sql_strings, depends, keep_going=True)
+
+    def _run_concurrently(self, statements, depends, keep_going=False):
+        """
+        Execute each statement once those it depends on are done, at most
+        max_concurrent at a time. After an error, starts no more statements
+        unless keep_going, and raises the first error once the statements
+        running are done
+
+        Parameters
+        ----------
+        statements : list of strings
+        depends : list of sets
+          Indices of the statements each depends on
+        keep_going : boolean, default False
+        """
+        if len(statements) < 2 or self.max_concurrent < 2:
+            errors = []
+            for stmt in statements:
+                try:
+                    self.client._execute(stmt)
+                except Exception:
+                    if not keep_going:
+                        raise
+                    errors.append(sys.exc_info())
+            if errors:
+                six.reraise(*errors[0])
+            return
+
+        cond = threading.Condition()
+        pending = list(range(len(statements)))
+        running = set()
+        done = set()
+        errors = []
+
+        def run(i):
+            try:
+                self.client._execute(statements[i])
+            except Exception:
+                with cond:
+                    errors.append(sys.exc_info())
+            finally:
+                with cond:
+                    running.discard(i)
+                    done.add(i)
+                    cond.notify()
+
+        with cond:
+            while True:
+                if keep_going or not errors:
+                    ready = [i for i in pending if depends[i] <= done]
+                    free = self.max_concurrent - len(running)
+                    for i in ready[:free]:
+                        pending.remove(i)
+                        running.add(i)
+                        thread = threading.Thread(target=run, args=(i,))
+                        thread.daemon = True
+                        thread.start()
+
+                if not running:
+                    break
+                cond.wait()
+
+        if errors:
+            six.reraise(*errors[0])
+
+
+def _setup_dependencies(statements, sql_strings):
+    # A statement depends on the earlier ones creating tables it mentions.
+    # The temporary tables have unique names, so looking for them in the SQL
+    # is enough (at worst, a statement waits for one it need not)
+    depends = [set() for x in statements]
+    for i, stmt in enumerate(statements):
+        name = getattr(stmt, 'table_name', None)
+        if name is None:
+            continue
+        for j in range(i + 1, len(statements)):
+            if name in sql_strings[j]:
+                depends[j].add(i)
+    return depends
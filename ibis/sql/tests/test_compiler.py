@@ -506,7 +506,7 @@ FROM (
       ON t2.`key1` = t3.`key1`
 ) t0
   INNER JOIN (
-    SELECT t2.*, t3.`value4`
+    SELECT t2.`key2`, t2.`value3`, t3.`value4`
     FROM third t2
       INNER JOIN fourth t3
         ON t2.`key3` = t3.`key3`
@@ -973,7 +973,7 @@ WHERE `f` > 0 AND
         result = to_sql(agged)
         expected = """SELECT `g`, sum(`foo`) AS `foo total`
 FROM (
-  SELECT *, `a` + `b` AS `foo`
+  SELECT `g`, `a` + `b` AS `foo`
   FROM alltypes
   WHERE `f` > 0 AND
         `g` = 'bar'
@@ -987,7 +987,7 @@ GROUP BY 1"""
         result = to_sql(agged2)
         expected = """SELECT t0.`g`, sum(t0.`foo`) AS `foo total`
 FROM (
-  SELECT *, `a` + `b` AS `foo`
+  SELECT `g`, `a` + `b` AS `foo`
   FROM alltypes
   WHERE `f` > 0
 ) t0
@@ -1059,7 +1059,7 @@ GROUP BY 1"""
         result = to_sql(what)
         expected = """SELECT `foo_id`, sum(`value1`) AS `total`
 FROM (
-  SELECT t1.*, t2.`value1`
+  SELECT t1.`foo_id`, t2.`value1`
   FROM star1 t1
     INNER JOIN star2 t2
       ON t1.`foo_id` = t2.`foo_id`
@@ -2036,6 +2036,143 @@ WHERE NOT EXISTS (
         assert result == expected
 
 
+
+class TestMaterializedSubqueries(unittest.TestCase):
+
+    def setUp(self):
+        self.con = MockConnection()
+        self.t = t = self.con.table('alltypes')
+        self.agg = t.group_by(['g', 'a', 'b']).aggregate(
+            [t.f.sum().name('total')])
+
+    def _check_wrapped(self, ast):
+        # One CTAS per temporary table, dropped again afterwards
+        names = [q.table_name for q in ast.setup_queries]
+        assert len(names) == 1
+        assert names[0].startswith('ibis_tmp_')
+
+        create, = ast.setup_queries
+        assert isinstance(create, ddl.CTAS)
+        assert create.database == '__ibis_tmp'
+
+        drop, = ast.teardown_queries
+        assert isinstance(drop, ddl.DropTable)
+        assert drop.table_name == names[0]
+        assert not drop.must_exist
+        return '__ibis_tmp.{0}'.format(names[0])
+
+    def test_materialize_marker(self):
+        m = self.agg.materialize(temporary=True)
+        expr = m[m.total > 0]
+
+        ast = build_ast(expr)
+        name = self._check_wrapped(ast)
+
+        result = ast.setup_queries[0].select.compile()
+        expected = """SELECT `g`, `a`, `b`, sum(`f`) AS `total`
+FROM alltypes
+GROUP BY 1, 2, 3"""
+        assert result == expected
+
+        result = ast.queries[0].compile()
+        expected = """SELECT *
+FROM {0}
+WHERE `total` > 0""".format(name)
+        assert result == expected
+
+    def test_materialize_executed_in_order(self):
+        m = self.agg.materialize(temporary=True)
+        self.con.execute(m.total.sum())
+
+        create, query, drop = self.con.executed_queries
+        assert create.startswith('CREATE TABLE')
+        assert query.startswith('SELECT sum(`total`)')
+        assert drop.startswith('DROP TABLE IF EXISTS')
+
+    def test_materialize_nested_order(self):
+        t = self.t
+        agg = self.agg.materialize(temporary=True)
+        top = t.group_by('g').aggregate([t.d.max().name('top')])
+        top = top.materialize(temporary=True)
+        maxes = agg.group_by('g').aggregate([agg.total.max().name('total')])
+        maxes = maxes.materialize(temporary=True)
+
+        # The table maxes is computed from comes first, though agg is seen
+        # first in the query
+        expr = (agg.inner_join(top, [agg.g == top.g])
+                .inner_join(maxes, [agg.g == maxes.g])
+                [agg, top.top, maxes.total.name('max_total')])
+        ast = build_ast(expr)
+
+        names = [q.table_name for q in ast.setup_queries]
+        assert len(names) == 3
+        last = ast.setup_queries[2].compile()
+        assert 'max(`total`)' in last
+        assert names[0] in last
+
+    def test_repeated_subquery_policy(self):
+        agg = self.agg
+        left = agg[agg.a < 5]
+        right = left.view()
+        joined = left.inner_join(right, [left.b == right.b])
+        expr = joined[left.g, (left.total - right.total).name('diff')]
+
+        # Off by default: factored into a WITH clause as before
+        ast = build_ast(expr)
+        assert ast.setup_queries == []
+        assert ast.teardown_queries == []
+        assert ast.queries[0].compile().startswith('WITH t0 AS')
+
+        with ibis.config.option_context('impala.materialize_subqueries',
+                                        True):
+            ast = build_ast(expr)
+
+        name = self._check_wrapped(ast)
+        result = ast.queries[0].compile()
+        expected = """SELECT t0.`g`, t0.`total` - t1.`total` AS `diff`
+FROM {0} t0
+  INNER JOIN (
+    SELECT *
+    FROM {0}
+    WHERE `a` < 5
+  ) t1
+    ON t0.`b` = t1.`b`
+WHERE t0.`a` < 5""".format(name)
+        assert result == expected
+
+    def test_repeated_in_subquery(self):
+        t = self.con.table('star1')
+        sub = t.group_by('foo_id').aggregate([t.count().name('n')])
+        expr = t[t.foo_id.isin(sub.foo_id) & t.bar_id.isin(sub.foo_id)]
+
+        with ibis.config.option_context('impala.materialize_subqueries',
+                                        True):
+            ast = build_ast(expr)
+
+        name = self._check_wrapped(ast)
+        result = ast.queries[0].compile()
+        expected = """SELECT *
+FROM star1
+WHERE `foo_id` IN (
+  SELECT `foo_id`
+  FROM {0}
+) AND `bar_id` IN (
+  SELECT `foo_id`
+  FROM {0}
+)""".format(name)
+        assert result == expected
+
+    def test_single_use_not_materialized(self):
+        agg = self.agg
+        expr = agg[agg.total > 0]
+
+        with ibis.config.option_context('impala.materialize_subqueries',
+                                        True):
+            ast = build_ast(expr)
+
+        assert ast.setup_queries == []
+        assert ast.teardown_queries == []
+
 class TestUDFStatements(unittest.TestCase):
 
     def setUp(self):
@@ -0,0 +1,162 @@
+# Copyright 2015 Cloudera Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+import time
+
+from ibis.compat import unittest
+from ibis.expr.tests.mocks import MockConnection
+from ibis.sql.compiler import build_ast
+from ibis.sql.pipeline import QueryPipeline
+
+
+class RecordingClient(object):
+
+    """
+    Records the statements executed, with the number running at the time
+    """
+
+    def __init__(self, delay=0.05, fail_on=None):
+        self.delay = delay
+        self.fail_on = fail_on
+
+        self.lock = threading.Lock()
+        self.running = 0
+        self.max_running = 0
+        self.started = []
+        self.finished = []
+        self.events = []
+
+    def _ensure_temp_db_exists(self):
+        pass
+
+    def _execute(self, stmt):
+        with self.lock:
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+            self.started.append(stmt)
+            self.events.append(('start', stmt))
+        try:
+            time.sleep(self.delay)
+            if self.fail_on is not None and self.fail_on in stmt:
+                raise ValueError(stmt)
+        finally:
+            with self.lock:
+                self.running -= 1
+                self.finished.append(stmt)
+                self.events.append(('end', stmt))
+
+    def _execute_query(self, query):
+        self._execute(query.compile())
+        return 'result'
+
+
+class TestQueryPipeline(unittest.TestCase):
+
+    def setUp(self):
+        con = MockConnection()
+        t = con.table('alltypes')
+
+        self.totals = t.group_by('g').aggregate([t.f.sum().name('total')])
+        self.totals = self.totals.materialize(temporary=True)
+        self.tops = t.group_by('g').aggregate([t.d.max().name('top')])
+        self.tops = self.tops.materialize(temporary=True)
+
+        a, b = self.totals, self.tops
+        self.expr = a.inner_join(b, [a.g == b.g])[a, b.top]
+
+    def _nested_expr(self):
+        # A temporary table computed from another
+        a = self.totals
+        maxes = a.group_by('g').aggregate([a.total.max().name('total')])
+        maxes = maxes.materialize(temporary=True)
+        return a.inner_join(maxes, [a.g == maxes.g])[a, maxes.total.name('m')]
+
+    def _names(self, ast):
+        return [q.table_name for q in ast.setup_queries]
+
+    def test_independent_setup_concurrent(self):
+        ast = build_ast(self.expr)
+        client = RecordingClient()
+
+        pipeline = QueryPipeline(client, ast)
+        assert pipeline.execute() == 'result'
+
+        # Both CTAS at once; the query after them; both drops at once
+        assert client.max_running == 2
+        create1, create2, query, drop1, drop2 = client.started
+        assert create1.startswith('CREATE TABLE')
+        assert create2.startswith('CREATE TABLE')
+        assert query.startswith('SELECT')
+        assert set(client.finished[:2]) == set([create1, create2])
+        assert drop1.startswith('DROP TABLE')
+        assert drop2.startswith('DROP TABLE')
+
+        stages = [stage for stage, seconds in pipeline.timings]
+        assert stages == ['setup', 'query', 'teardown']
+        assert all(seconds >= 0.05 for stage, seconds in pipeline.timings)
+
+    def test_dependent_setup_sequential(self):
+        ast = build_ast(self._nested_expr())
+        client = RecordingClient()
+        QueryPipeline(client, ast).execute()
+
+        inner, outer = self._names(ast)
+        events = [(event, inner in stmt, outer in stmt)
+                  for event, stmt in client.events[:4]]
+        assert events == [('start', True, False), ('end', True, False),
+                          ('start', True, True), ('end', True, True)]
+
+    def test_max_concurrent(self):
+        ast = build_ast(self.expr)
+        client = RecordingClient(delay=0)
+        QueryPipeline(client, ast, max_concurrent=1).execute()
+        assert client.max_running == 1
+        assert len(client.finished) == 5
+
+    def test_teardown_after_query_failure(self):
+        ast = build_ast(self.expr)
+        client = RecordingClient(fail_on='SELECT t0.*')
+
+        pipeline = QueryPipeline(client, ast)
+        self.assertRaises(ValueError, pipeline.execute)
+
+        drops = [x for x in client.finished if x.startswith('DROP')]
+        assert len(drops) == 2
+        stages = [stage for stage, seconds in pipeline.timings]
+        assert stages == ['setup', 'query', 'teardown']
+
+    def test_teardown_after_setup_failure(self):
+        ast = build_ast(self._nested_expr())
+        inner, outer = self._names(ast)
+        client = RecordingClient(fail_on='sum(`f`)')
+
+        self.assertRaises(ValueError, QueryPipeline(client, ast).execute)
+
+        # Nothing depending on the failed statement runs, but everything is
+        # dropped
+        assert not any(outer in x for x in client.started
+                       if x.startswith('CREATE'))
+        assert not any(x.startswith('SELECT') for x in client.started)
+        drops = [x for x in client.finished if x.startswith('DROP')]
+        assert len(drops) == 2
+
+    def test_main_statement(self):
+        ast = build_ast(self.expr)
+        client = RecordingClient(delay=0)
+
+        result = QueryPipeline(client, ast).execute(
+            lambda: client._execute('INSERT'))
+        assert result is None
+        assert client.started[2] == 'INSERT'
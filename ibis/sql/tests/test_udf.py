@@ -202,6 +202,35 @@ class UDFTest(unittest.TestCase):
         expr = _func(1, 1.0, 'a', True, ibis.timestamp('1961-04-10'))
         assert issubclass(type(expr), ir.ScalarExpr)
 
+    def test_python_udf(self):
+        @ibis.python_udf(['double', 'int32'], 'double')
+        def scaled(x, factor):
+            return x * factor
+
+        assert scaled.name == 'scaled'
+        assert scaled.inputs == ['double', 'int32']
+        assert scaled(2.0, 3) == 6.0
+
+        op = scaled.to_operation()
+        assert issubclass(op, ValueOp)
+        udf.add_impala_operation(op, 'scaled', 'udf_testing')
+
+        expr = op(self.d, self.i32).to_expr()
+        assert isinstance(expr, ir.DoubleArray)
+
+    def test_python_udf_task_header(self):
+        info = udf.PythonUDFInfo(len, ['string'], 'int64')
+        header = info.task_header()
+        short_header = info.task_header(include_function=False)
+
+        assert 'udf-scalar' in header
+        assert info.func_pickled in header
+        assert info.func_pickled not in short_header
+
+    def test_python_udf_unsupported_output(self):
+        self.assertRaises(IbisTypeError, udf.PythonUDFInfo, len,
+                          ['string'], 'string')
+
     def _udf_registration_single_input(self, inputs, output, name):
         op = self._udf_registration([inputs], output, name)
 
@@ -21,6 +21,9 @@ from ibis.expr.types import (
     TimestampValue, DecimalValue,
 )
 from ibis.common import IbisTypeError
+from ibis.cloudpickle import dumps as pickle_dump
+from ibis.tasks import write_class_ref
+from ibis.wire import PackedMessageWriter
 
 import ibis.expr.types as ir
 import ibis.expr.operations as _ops
@@ -114,6 +117,88 @@ class UDACreator(UDFCreatorParent):
                                   output_type, name=name)
 
 
+class PythonUDFInfo(UDFInfo):
+
+    """
+    A Python scalar function evaluated by Ibis workers over batches of rows
+    (the udf-scalar task). It is called once per batch, with one NumPy array
+    per input column, and returns an array of the output type.
+    """
+
+    def __init__(self, func, input_type, output_type, name=None):
+        inputs = [ir._validate_type(x) for x in input_type]
+        output = ir._validate_type(output_type)
+        if output not in _python_udf_outputs:
+            raise IbisTypeError('Python UDFs cannot return {0}'
+                                .format(output))
+
+        if not name:
+            name = func.__name__
+
+        UDFInfo.__init__(self, inputs, output, name)
+        self.func = func
+        self.func_pickled = pickle_dump(func)
+
+    def __call__(self, *args):
+        # Apply to column arrays in-process, e.g. for testing
+        return self.func(*args)
+
+    def to_operation(self, name=None):
+        """
+        Creates and returns an operator class for use in expressions
+        """
+        return scalar_function(self.inputs, self.output,
+                               name=name or self.name)
+
+    def task_header(self, include_function=True):
+        """
+        Task message up to the input table, for a udf-scalar task
+
+        Parameters
+        ----------
+        include_function : boolean, default True
+          Leave out the pickled function when the worker has it cached
+
+        Returns
+        -------
+        header : bytes
+        """
+        writer = PackedMessageWriter()
+        writer.string('udf-scalar')
+        write_class_ref(writer, self.func_pickled,
+                        include_pickle=include_function)
+        writer.string(self.output)
+        return writer.get_result()
+
+
+def python_udf(inputs, output, name=None):
+    """
+    Decorator registering a Python function as a vectorized scalar UDF
+
+    Parameters
+    ----------
+    inputs : list of strings
+      Ibis types of the arguments
+    output : string
+      Ibis type of the result
+    name : string, optional
+      Defaults to the function's name
+
+    Examples
+    --------
+    @python_udf(['double', 'double'], 'double')
+    def hypot(x, y):
+        return np.sqrt(x ** 2 + y ** 2)
+
+    Returns
+    -------
+    decorator returning a PythonUDFInfo
+    """
+    def decorator(func):
+        return PythonUDFInfo(func, inputs, output, name=name)
+    return decorator
+
+
 def _validate_impala_type(t):
     if t in _impala_to_ibis.keys():
         return t
@@ -185,6 +270,10 @@ _conversion_types = {
     'timestamp': (TimestampValue),
 }
 
+# Types Python UDF results can be written as (see comms.masked_from_pandas)
+_python_udf_outputs = set(['boolean', 'int8', 'int16', 'int32', 'int64',
+                           'float', 'double'])
+
 _impala_to_ibis = {
     'tinyint': 'int8',
     'smallint': 'int16',
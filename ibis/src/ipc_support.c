@@ -21,6 +21,15 @@
 #include <sys/shm.h>
 #include <sys/sem.h>
 
+#if __linux__
+#include <linux/futex.h>
+#include <sys/syscall.h>
+#include <unistd.h>
+#define HAVE_FUTEX 1
+#else
+#define HAVE_FUTEX 0
+#endif
+
 /* This union is not defined in sys/sem.h on some systems */
 #if (!__APPLE__) && (!defined(__GNU_LIBRARY__) || defined(_SEM_SEMUN_UNDEFINED))
 union semun {
@@ -63,22 +72,166 @@ int semarray_delete(int sem_id) {
   return semctl(sem_id, 0, IPC_RMID, NULL);
 }
 
-int semarray_lock(int sem_id, int i, struct timespec *timeout) {
+/* semop is never restarted after a signal handler, even with SA_RESTART
+   (e.g. the daemon's SIGCHLD handler) */
+static int semop_retry(int sem_id, struct sembuf *buf,
+                       struct timespec *timeout) {
+  int ret;
+  do {
+    ret = semtimedop(sem_id, buf, 1, timeout);
+  } while (ret == -1 && errno == EINTR);
+  return ret;
+}
+
+int semarray_lock(int sem_id, int i, struct timespec *timeout, int undo) {
   struct sembuf buf;
 
   /* Decrement is locking */
   buf.sem_op = -1;
   buf.sem_num = i;
-  buf.sem_flg = SEM_UNDO;
-  return semtimedop(sem_id, &buf, 1, timeout);
+  buf.sem_flg = undo ? SEM_UNDO : 0;
+  return semop_retry(sem_id, &buf, timeout);
 }
 
-int semarray_unlock(int sem_id, int i, struct timespec *timeout) {
+int semarray_unlock(int sem_id, int i, struct timespec *timeout, int undo) {
   struct sembuf buf;
 
   /* Increment is unlocking */
   buf.sem_op = 1;
   buf.sem_num = i;
-  buf.sem_flg = SEM_UNDO;
-  return semtimedop(sem_id, &buf, 1, timeout);
+  buf.sem_flg = undo ? SEM_UNDO : 0;
+  return semop_retry(sem_id, &buf, timeout);
+}
+
+/* ---------------------------------------------------------------------- */
+/* Shared memory flags (spin, then futex wait) */
+
+#define SHMFLAG_LOCKED 0
+#define SHMFLAG_AVAILABLE 1
+#define SHMFLAG_SLEEPING 2
+
+#if defined(__i386__) || defined(__x86_64__)
+#define cpu_relax() __asm__ __volatile__("pause" ::: "memory")
+#else
+#define cpu_relax() __asm__ __volatile__("" ::: "memory")
+#endif
+
+static inline int shmflag_try_take(uint32_t* flag) {
+  uint32_t expected = SHMFLAG_AVAILABLE;
+  return __atomic_compare_exchange_n(flag, &expected, SHMFLAG_LOCKED, 0,
+                                     __ATOMIC_ACQUIRE, __ATOMIC_RELAXED);
+}
+
+#if HAVE_FUTEX
+
+/*
+  The flags are shared between processes, so we must not use the
+  FUTEX_PRIVATE_FLAG variants here.
+ */
+static int futex_wait(uint32_t* addr, uint32_t val, struct timespec* timeout) {
+  return syscall(SYS_futex, addr, FUTEX_WAIT, val, timeout, NULL, 0);
+}
+
+static int futex_wake(uint32_t* addr, int nwake) {
+  return syscall(SYS_futex, addr, FUTEX_WAKE, nwake, NULL, NULL, 0);
+}
+
+/* Set remaining = deadline - now, returns 0 if the deadline has passed */
+static int time_remaining(struct timespec* deadline,
+                          struct timespec* remaining) {
+  struct timespec now;
+  clock_gettime(CLOCK_MONOTONIC, &now);
+
+  remaining->tv_sec = deadline->tv_sec - now.tv_sec;
+  remaining->tv_nsec = deadline->tv_nsec - now.tv_nsec;
+  if (remaining->tv_nsec < 0) {
+    remaining->tv_sec -= 1;
+    remaining->tv_nsec += 1000000000L;
+  }
+  return remaining->tv_sec >= 0;
+}
+
+#endif
+
+int shmflag_supported(void) {
+  return HAVE_FUTEX;
+}
+
+void shmflag_init(uint32_t* flag, uint32_t value) {
+  __atomic_store_n(flag, value, __ATOMIC_SEQ_CST);
+}
+
+int shmflag_lock(uint32_t* flag, int spin_count, struct timespec* timeout) {
+#if HAVE_FUTEX
+  struct timespec deadline, remaining;
+  uint32_t expected;
+  int i, ret;
+
+  for (i = 0; i < spin_count; ++i) {
+    if (shmflag_try_take(flag)) {
+      return 0;
+    }
+    cpu_relax();
+  }
+
+  if (timeout != NULL) {
+    clock_gettime(CLOCK_MONOTONIC, &deadline);
+    deadline.tv_sec += timeout->tv_sec;
+    deadline.tv_nsec += timeout->tv_nsec;
+    if (deadline.tv_nsec >= 1000000000L) {
+      deadline.tv_sec += 1;
+      deadline.tv_nsec -= 1000000000L;
+    }
+  }
+
+  while (1) {
+    if (shmflag_try_take(flag)) {
+      return 0;
+    }
+
+    /* Announce that we are going to sleep so the releaser wakes us */
+    expected = SHMFLAG_LOCKED;
+    __atomic_compare_exchange_n(flag, &expected, SHMFLAG_SLEEPING, 0,
+                                __ATOMIC_ACQUIRE, __ATOMIC_RELAXED);
+
+    if (timeout == NULL) {
+      ret = futex_wait(flag, SHMFLAG_SLEEPING, NULL);
+    } else {
+      if (!time_remaining(&deadline, &remaining)) {
+        errno = EAGAIN;
+        return -1;
+      }
+      ret = futex_wait(flag, SHMFLAG_SLEEPING, &remaining);
+    }
+
+    if (ret == -1) {
+      if (errno == ETIMEDOUT) {
+        /* The flag may have been released just as we timed out */
+        if (shmflag_try_take(flag)) {
+          return 0;
+        }
+        errno = EAGAIN;
+        return -1;
+      } else if (errno != EAGAIN && errno != EINTR) {
+        return -1;
+      }
+    }
+  }
+#else
+  errno = ENOSYS;
+  return -1;
+#endif
+}
+
+int shmflag_unlock(uint32_t* flag) {
+#if HAVE_FUTEX
+  if (__atomic_exchange_n(flag, SHMFLAG_AVAILABLE, __ATOMIC_RELEASE) ==
+      SHMFLAG_SLEEPING) {
+    return futex_wake(flag, 1) == -1 ? -1 : 0;
+  }
+  return 0;
+#else
+  errno = ENOSYS;
+  return -1;
+#endif
 }
@@ -14,8 +14,15 @@
    limitations under the License.
 */
 
+#include <stdint.h>
+#include <sys/mman.h>
 #include <time.h>
 
+/* Linux-only mmap flag; prefaulting is just skipped elsewhere */
+#ifndef MAP_POPULATE
+#define MAP_POPULATE 0
+#endif
+
 /*
    Create an array of semaphores (e.g., 2) which can be used to coordinate IPC
    between two processes. Initializing with zeros indicates a locked state.
@@ -38,8 +45,38 @@ int semarray_delete(int sem_id);
 
   TODO: semtimedop may not be supported on all systems,
 
+  If undo is nonzero the operation is made with SEM_UNDO, so the kernel reverts
+  it when the calling process exits.
+
   Returns -1 if the operation fails or times out (errno is EAGAIN in the latter
   case)
  */
-int semarray_lock(int sem_id, int i, struct timespec *timeout);
-int semarray_unlock(int sem_id, int i, struct timespec *timeout);
+int semarray_lock(int sem_id, int i, struct timespec *timeout, int undo);
+int semarray_unlock(int sem_id, int i, struct timespec *timeout, int undo);
+
+/*
+  Spin-then-block handoff flags living in shared memory (e.g. a memory map
+  visible to both processes). Each flag is a single aligned uint32_t:
+
+    0 : not available
+    1 : available
+    2 : not available, and the other process is sleeping on it
+
+  Acquiring spins for up to spin_count iterations trying to atomically take the
+  flag before going to sleep with a futex wait. Releasing only makes a system
+  call if the other side is asleep, so an uncontended handoff never leaves
+  user space.
+
+  Futexes are Linux-only; on other systems shmflag_supported returns 0 and the
+  SysV semaphore functions above should be used instead.
+ */
+int shmflag_supported(void);
+
+void shmflag_init(uint32_t* flag, uint32_t value);
+
+/*
+  Returns -1 if the operation fails or times out (errno is EAGAIN in the latter
+  case). A NULL timeout blocks until the flag is acquired.
+ */
+int shmflag_lock(uint32_t* flag, int spin_count, struct timespec* timeout);
+int shmflag_unlock(uint32_t* flag);
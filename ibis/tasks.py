@@ -12,12 +12,23 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from collections import OrderedDict
+from contextlib import contextmanager
+import ctypes
+import hashlib
+import os
+import struct
+import threading
+import time
 import traceback
 
+import numpy as np
+
 from cPickle import loads as pickle_load
 from ibis.cloudpickle import dumps as pickle_dump
 
-from ibis.wire import PackedMessageReader, PackedMessageWriter
+from ibis.metrics import get_metrics
+from ibis.wire import BufferReader, BufferWriter
 import ibis.wire as wire
 
 try:
@@ -26,6 +37,30 @@ except ImportError:
     pass
 
 
+# An encoded IbisTaskMessage is packed or unpacked in at most three calls:
+# the head gives the length of the shared memory name, which fixes the
+# layout of the body
+_TASK_MSG_HEAD = struct.Struct('=II')
+_TASK_MSG_TIMEOUT = struct.Struct('=I')
+_TASK_MSG_OPTIONS = struct.Struct('=II')
+
+# IbisTaskMessage flags: the requesting process drains responses too large
+# for the shared memory in parts (see read_response)
+TASK_FLAG_STREAM = 1
+
+# name length -> body struct. Names are mostly of a few lengths
+_task_msg_bodies = {}
+
+
+def _task_msg_body(name_len):
+    body = _task_msg_bodies.get(name_len)
+    if body is None:
+        body = struct.Struct('=%dsQQ' % name_len)
+        if len(_task_msg_bodies) < 64:
+            _task_msg_bodies[name_len] = body
+    return body
+
+
 class IbisTaskMessage(object):
 
     """
@@ -36,13 +71,29 @@ class IbisTaskMessage(object):
     char* shmem_name
     uint64_t shmem_offset
     uint64_t shmem_size
+    uint32_t timeout_ms (optional, only present with a timeout or flags;
+                         0 for no timeout)
+    uint32_t flags (optional, TASK_FLAG_*)
+
+    Parameters
+    ----------
+    timeout : float, optional
+      Seconds the task may take, including the wait for the requesting
+      process to hand over control
+    stream : boolean, default False
+      The requesting process reads the response with read_response, so a
+      response too large for the shared memory can be streamed in parts
+      rather than failing
     """
 
-    def __init__(self, semaphore_id, shmem_name, shmem_offset, shmem_size):
+    def __init__(self, semaphore_id, shmem_name, shmem_offset, shmem_size,
+                 timeout=None, stream=False):
         self.semaphore_id = semaphore_id
         self.shmem_name = shmem_name
         self.shmem_offset = shmem_offset
         self.shmem_size = shmem_size
+        self.timeout = timeout
+        self.stream = stream
 
     @classmethod
     def decode(self, message):
@@ -51,18 +102,27 @@ class IbisTaskMessage(object):
 
         Parameters
         ----------
-        message : bytes
+        message : bytes, or any other buffer (e.g. a memoryview)
 
         Returns
         -------
         message : IbisTaskMessage
         """
-        buf = PackedMessageReader(message)
-        sem_id = buf.uint32()
-        shmem_name = buf.string()
-        shmem_offset = buf.uint64()
-        shmem_size = buf.uint64()
-        return IbisTaskMessage(sem_id, shmem_name, shmem_offset, shmem_size)
+        sem_id, name_len = _TASK_MSG_HEAD.unpack_from(message)
+        body = _task_msg_body(name_len)
+        shmem_name, shmem_offset, shmem_size = body.unpack_from(
+            message, _TASK_MSG_HEAD.size)
+
+        timeout_ms = flags = 0
+        end = _TASK_MSG_HEAD.size + body.size
+        if len(message) >= end + _TASK_MSG_OPTIONS.size:
+            timeout_ms, flags = _TASK_MSG_OPTIONS.unpack_from(message, end)
+        elif len(message) > end:
+            timeout_ms, = _TASK_MSG_TIMEOUT.unpack_from(message, end)
+
+        return IbisTaskMessage(sem_id, shmem_name, shmem_offset, shmem_size,
+                               timeout=timeout_ms / 1000. or None,
+                               stream=bool(flags & TASK_FLAG_STREAM))
 
     def encode(self):
         """
@@ -74,12 +134,54 @@ class IbisTaskMessage(object):
         encoded : bytes
 
         """
-        buf = PackedMessageWriter()
-        buf.uint32(self.semaphore_id)
-        buf.string(self.shmem_name)
-        buf.uint64(self.shmem_offset)
-        buf.uint64(self.shmem_size)
-        return buf.get_result()
+        name_len = len(self.shmem_name)
+        encoded = (_TASK_MSG_HEAD.pack(self.semaphore_id, name_len) +
+                   _task_msg_body(name_len).pack(self.shmem_name,
+                                                 self.shmem_offset,
+                                                 self.shmem_size))
+        options = self._options()
+        if options is not None:
+            encoded += options[0].pack(*options[1:])
+        return encoded
+
+    def encode_into(self, buf, offset=0):
+        """
+        Write the encoded message into a writable buffer (e.g. shared
+        memory) in place
+
+        Returns
+        -------
+        end : int
+          Offset just past the message
+        """
+        name_len = len(self.shmem_name)
+        writer = BufferWriter(buf, offset)
+        writer.pack(_TASK_MSG_HEAD, self.semaphore_id, name_len)
+        writer.pack(_task_msg_body(name_len), self.shmem_name,
+                    self.shmem_offset, self.shmem_size)
+        options = self._options()
+        if options is not None:
+            writer.pack(*options)
+        return writer.tell()
+
+    def _options(self):
+        # The trailing optional fields, as (struct, values...), or None
+        timeout_ms = 0
+        if self.timeout is not None:
+            timeout_ms = int(round(self.timeout * 1000))
+
+        if self.stream:
+            return _TASK_MSG_OPTIONS, timeout_ms, TASK_FLAG_STREAM
+        elif timeout_ms:
+            return _TASK_MSG_TIMEOUT, timeout_ms
+        return None
+
+    def same_task(self, other):
+        """
+        Whether other describes the same task (e.g. a cancellation request)
+        """
+        return ((self.semaphore_id, self.shmem_name, self.shmem_offset) ==
+                (other.semaphore_id, other.shmem_name, other.shmem_offset))
 
 
 class Task(object):
@@ -94,6 +196,53 @@ class Task(object):
         self.shmem = shmem
         self.complete = False
 
+        # Shared memory read and written, and seconds spent decoding input
+        # and encoding output within run, for metrics (see IbisTaskExecutor)
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.phase_times = {}
+
+        # Pieces of a response too large for the shared memory, left for
+        # IbisTaskExecutor to stream
+        self.oversized_response = None
+
+    @contextmanager
+    def _phase(self, name):
+        # 'decode' or 'encode'
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.phase_times[name] = (self.phase_times.get(name, 0) +
+                                      time.time() - start)
+
+    @contextmanager
+    def _header(self):
+        """
+        Zero-copy reader (see BufferReader) for the task header, at the
+        current position in shared memory, which is moved past the header
+        afterwards
+        """
+        reader = BufferReader(self.shmem, self.shmem.tell())
+        yield reader
+        self.shmem.seek(reader.tell())
+
+    def _respond(self, *pieces):
+        """
+        Write the response, status byte first, from buffers (e.g. bytes)
+        laid end to end. A response that does not fit in the shared memory is
+        left for the executor to stream in parts (see read_response)
+        """
+        nbytes = sum(len(piece) for piece in pieces)
+        self.bytes_out = nbytes
+        if nbytes > len(self.shmem):
+            self.oversized_response = pieces
+            return
+
+        writer = BufferWriter(self.shmem)
+        for piece in pieces:
+            writer.write(piece)
+
     def mark_success(self):
         wire.write_uint8(self.shmem, 1)
 
@@ -124,20 +273,638 @@ def register_task(kind, task_class, override=False):
     _task_registry[kind] = task_class
 
 
+_segment_pool = None
+
+
+def get_segment_pool():
+    """
+    Shared memory mappings are kept open across tasks in each worker process
+    """
+    global _segment_pool
+    if _segment_pool is None:
+        _segment_pool = comms.SegmentPool()
+    return _segment_pool
+
+
+def reclaim_segments():
+    """
+    Close pooled shared memory mappings that have been idle too long or whose
+    segments are gone, and evict stale aggregation states. Workers call this
+    while waiting for tasks
+    """
+    if _segment_pool is not None:
+        _segment_pool.reclaim()
+    if _agg_states is not None:
+        _agg_states.evict()
+
+
+class AggregationStateTable(object):
+
+    """
+    Aggregator instances kept resident in a worker between tasks, so that
+    their state need not be pickled and shipped on every update. Keyed by a
+    handle chosen by the caller (e.g. query and fragment id).
+
+    Parameters
+    ----------
+    ttl : float, default 600
+      Evict states that have not been used for this many seconds
+    """
+
+    def __init__(self, ttl=600):
+        self.ttl = ttl
+
+        # handle -> [state, last used]
+        self._states = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._states)
+
+    def __contains__(self, handle):
+        return handle in self._states
+
+    def get(self, handle):
+        """
+        Raises KeyError if there is no (live) state for the handle
+        """
+        with self._lock:
+            try:
+                entry = self._states[handle]
+            except KeyError:
+                raise KeyError('No aggregation state for handle %r (never '
+                               'created, released or expired)' % handle)
+            entry[1] = time.time()
+            return entry[0]
+
+    def put(self, handle, state):
+        with self._lock:
+            self._states[handle] = [state, time.time()]
+
+    def pop(self, handle):
+        state = self.get(handle)
+        with self._lock:
+            self._states.pop(handle, None)
+        return state
+
+    def evict(self, ttl=None):
+        """
+        Drop states not used in ttl seconds (defaults to the table setting)
+
+        Returns
+        -------
+        nevicted : int
+        """
+        if ttl is None:
+            ttl = self.ttl
+
+        now = time.time()
+        with self._lock:
+            stale = [handle for handle, (_, used) in self._states.items()
+                     if now - used > ttl]
+            for handle in stale:
+                del self._states[handle]
+        return len(stale)
+
+    def clear(self):
+        with self._lock:
+            self._states.clear()
+
+
+_agg_states = None
+
+
+# Response status written in place of success/failure when a task refers to
+# a class (by digest) that the worker has not cached; followed by the digest.
+# The requester resends the task with the class pickle included
+TASK_CLASS_MISSING = 2
+
+# Response status of each part of a response streamed through shared memory
+# too small for it, followed by the rest of _RESPONSE_PART: whether it is
+# the last part, the length of the whole response, and of this part. The
+# parts make up the response as it would have been written in place
+TASK_RESPONSE_PART = 3
+_RESPONSE_PART = struct.Struct('=bBQI')
+
+_STATUS_SUCCESS = wire.UINT8.pack(1)
+_STATUS_FAILURE = wire.UINT8.pack(0)
+
+# Failure status byte and message length prefix
+_FAILURE_OVERHEAD = 5
+
+
+class ClassCacheMiss(Exception):
+
+    def __init__(self, digest):
+        Exception.__init__(self, 'Class %s is not cached' % digest)
+        self.digest = digest
+
+
+def class_digest(pickled):
+    """
+    Content hash identifying a pickled class in task messages
+    """
+    return hashlib.sha1(pickled).hexdigest()
+
+
+class ClassCache(object):
+
+    """
+    Unpickled classes (e.g. UDAs) and functions (scalar UDFs) keyed by the
+    class_digest of their pickle, so that code sent repeatedly is shipped and
+    unpickled once per worker.
+    The least recently used classes are dropped beyond max_entries
+    """
+
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self._classes = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._classes)
+
+    def __contains__(self, digest):
+        return digest in self._classes
+
+    def get(self, digest, pickled=None):
+        """
+        Returns the cached class, unpickling and caching pickled on a miss.
+        Raises ClassCacheMiss on a miss without pickled
+        """
+        with self._lock:
+            klass = self._classes.pop(digest, None)
+            if klass is not None:
+                self._classes[digest] = klass
+                get_metrics().incr('class_cache.hits')
+                return klass
+
+        get_metrics().incr('class_cache.misses')
+        if not pickled:
+            raise ClassCacheMiss(digest)
+
+        if class_digest(pickled) != digest:
+            raise ValueError('Class pickle does not match digest %s'
+                             % digest)
+
+        klass = _load_pickle(pickled)
+        with self._lock:
+            self._classes[digest] = klass
+            while len(self._classes) > self.max_entries:
+                self._classes.popitem(last=False)
+        return klass
+
+    def clear(self):
+        with self._lock:
+            self._classes.clear()
+
+
+_class_cache = None
+
+
+def get_class_cache():
+    """
+    Classes cached by this worker process
+    """
+    global _class_cache
+    if _class_cache is None:
+        _class_cache = ClassCache()
+    return _class_cache
+
+
+def write_class_ref(writer, pickled, include_pickle=True):
+    """
+    Refer to a pickled class in a task header: its digest, then the pickle
+    itself, or an empty string if the worker is expected to have it cached
+
+    Parameters
+    ----------
+    writer : PackedMessageWriter
+    pickled : bytes
+    include_pickle : boolean, default True
+    """
+    writer.string(class_digest(pickled))
+    writer.string(pickled if include_pickle else '')
+
+
+def read_class_ref(reader):
+    """
+    Read a reference written by write_class_ref, returning the class
+    """
+    digest = reader.string()
+    pickled = reader.string()
+    return get_class_cache().get(digest, pickled)
+
+
+def _load_pickle(data):
+    get_metrics().observe('pickle_in_bytes', len(data))
+    return pickle_load(data)
+
+
+def _dump_pickle(obj):
+    data = pickle_dump(obj)
+    get_metrics().observe('pickle_out_bytes', len(data))
+    return data
+
+
+# ---------------------------------------------------------------------
+# Aggregation state serialization
+#
+# An aggregator class can declare its state as named NumPy arrays and
+# scalars, listing the instance attributes holding them in state_fields:
+#
+#     class Histogram(object):
+#         state_fields = ('counts', 'total')
+#
+# Such states are written as raw array memory rather than pickled, and read
+# back as views on a single copy of the message. Any other state, or one
+# holding something else (e.g. object arrays or strings), is pickled.
+#
+# Layout of a native state
+# - STATE_MAGIC
+# - class reference (see write_class_ref)
+# - number of fields (uint32)
+# - for each field: name, kind (STATE_FIELD_*), dtype string, ndim (uint8),
+#   shape (uint64 each), data length (uint64), zero padding to an 8-byte
+#   boundary from the start of the state, data
+
+# Pickles (protocol 2) start with '\x80'
+STATE_MAGIC = 'IBST'
+
+STATE_FIELD_ARRAY = 0
+STATE_FIELD_SCALAR = 1
+STATE_FIELD_NUMPY_SCALAR = 2
+
+_STATE_ALIGNMENT = 8
+
+# class -> pickled class, on the side writing states
+_state_class_pickles = {}
+
+
+def dump_state(state):
+    """
+    Serialize an aggregation state: natively if its class declares
+    state_fields, pickled otherwise
+
+    Returns
+    -------
+    data : bytes
+    """
+    return ''.join(piece if isinstance(piece, bytes) else piece.tobytes()
+                   for piece in _state_pieces(state))
+
+
+def load_state(data):
+    """
+    Deserialize a state written by dump_state
+
+    Parameters
+    ----------
+    data : buffer
+      e.g. bytes, or a memoryview on shared memory
+    """
+    view = memoryview(data)
+    if view[:len(STATE_MAGIC)].tobytes() == STATE_MAGIC:
+        return _load_native_state(view)
+    return _load_pickle(view.tobytes())
+
+
+def _state_pieces(state):
+    # Buffers laid end to end, so that arrays can be written to shared
+    # memory straight from their own memory
+    fields = _native_fields(state)
+    if fields is None:
+        return [_dump_pickle(state)]
+
+    klass = type(state)
+    pickled = _state_class_pickles.get(klass)
+    if pickled is None:
+        pickled = _state_class_pickles[klass] = pickle_dump(klass)
+
+    header = wire.PackedMessageWriter()
+    header.string(class_digest(pickled))
+    header.string(pickled)
+    header.uint32(len(fields))
+
+    pieces = [STATE_MAGIC]
+    pos = len(STATE_MAGIC)
+    for name, kind, arr in fields:
+        header.string(name)
+        header.uint8(kind)
+        header.string(arr.dtype.str)
+        header.uint8(arr.ndim)
+        for dim in arr.shape:
+            header.uint64(dim)
+        header.uint64(arr.nbytes)
+
+        # Field headers go in the piece ahead of the data
+        pos += header.buf.tell()
+        padding = -pos % _STATE_ALIGNMENT
+        pos += padding + arr.nbytes
+
+        pieces.append(header.get_result() + '\0' * padding)
+        pieces.append(memoryview(arr.reshape(-1).view(np.uint8)))
+        header = wire.PackedMessageWriter()
+
+    nbytes = pos - len(STATE_MAGIC)
+    get_metrics().observe('state_out_bytes', nbytes)
+    return pieces
+
+
+def _native_fields(state):
+    names = getattr(type(state), 'state_fields', None)
+    if names is None:
+        return None
+
+    fields = []
+    for name in names:
+        value = getattr(state, name)
+        if isinstance(value, np.ndarray):
+            kind = STATE_FIELD_ARRAY
+        elif isinstance(value, np.generic):
+            kind = STATE_FIELD_NUMPY_SCALAR
+        elif isinstance(value, (bool, int, float)):
+            kind = STATE_FIELD_SCALAR
+        else:
+            return None
+
+        # Not ascontiguousarray, which makes scalars one-dimensional
+        arr = np.asarray(value)
+        if not arr.flags.c_contiguous:
+            arr = arr.copy()
+        if arr.dtype.hasobject or arr.dtype.fields is not None:
+            return None
+        fields.append((name, kind, arr))
+    return fields
+
+
+def _load_native_state(view):
+    # One copy, so that the arrays are writable views on memory of their own
+    # rather than on shared memory about to be reused
+    buf = bytearray(view)
+    get_metrics().observe('state_in_bytes', len(buf))
+
+    reader = BufferReader(buf, len(STATE_MAGIC))
+    klass = read_class_ref(reader)
+
+    state = klass.__new__(klass)
+    for i in range(reader.uint32()):
+        name = reader.string()
+        kind = reader.uint8()
+        dtype = np.dtype(reader.string())
+        shape = tuple(reader.uint64() for j in range(reader.uint8()))
+        nbytes = reader.uint64()
+
+        reader.read_view(-reader.tell() % _STATE_ALIGNMENT)
+        offset = reader.tell()
+        reader.read_view(nbytes)
+
+        arr = np.frombuffer(buf, dtype=dtype, count=nbytes // dtype.itemsize,
+                            offset=offset).reshape(shape)
+        if kind == STATE_FIELD_SCALAR:
+            value = arr.item()
+        elif kind == STATE_FIELD_NUMPY_SCALAR:
+            value = arr[()]
+        else:
+            value = arr
+        setattr(state, name, value)
+    return state
+
+
+def get_agg_states():
+    """
+    Resident aggregation states of this worker process
+    """
+    global _agg_states
+    if _agg_states is None:
+        _agg_states = AggregationStateTable()
+    return _agg_states
+
+
+# Seconds a task without a deadline waits for the requesting process to
+# drain each part of a streamed response
+RESPONSE_DRAIN_TIMEOUT = 60
+
+# Waits for the requesting process to hand over control are made in slices
+# of this many milliseconds, so that deadlines and cancellation are noticed
+LOCK_WAIT_MS = 100
+
+# Seconds an interrupted task may keep running (e.g. stuck in C code) before
+# the watchdog reports its failure and exits the process
+TASK_KILL_GRACE = 5
+
+
+class TaskInterrupted(Exception):
+
+    """
+    Raised in a task's thread when it is cancelled or over its deadline
+    """
+    pass
+
+
+def _set_async_exc(thread_id, exc_type):
+    # Raise exc_type in another thread once it next runs Python code. None
+    # withdraws a pending exception
+    ctypes.pythonapi.PyThreadState_SetAsyncExc(
+        ctypes.c_long(thread_id),
+        None if exc_type is None else ctypes.py_object(exc_type))
+
+
+class _WatchedTask(object):
+
+    def __init__(self, task_msg, deadline, on_kill):
+        self.task_msg = task_msg
+        self.deadline = deadline
+        self.on_kill = on_kill
+        self.thread_id = threading.current_thread().ident
+
+        # Set once it has control of the shared memory; only then can it be
+        # interrupted
+        self.running = False
+
+        self.reason = None
+        self.kill_time = None
+
+
+class TaskWatchdog(object):
+
+    """
+    Enforces the deadline of the task being executed in this process, and
+    cancels it on request. An interrupted task gets TaskInterrupted raised in
+    its thread. If it is still running TASK_KILL_GRACE seconds later (stuck
+    in C code, or it swallowed the exception), its failure is reported on its
+    behalf and the process exits.
+    """
+
+    def __init__(self):
+        self._reset()
+
+    def _reset(self):
+        self._cond = threading.Condition()
+        self._task = None
+        self._thread = None
+        self._pid = os.getpid()
+
+    def _ensure_thread(self):
+        if self._pid != os.getpid():
+            # Forked: the thread stayed behind in the parent
+            self._reset()
+
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run,
+                                            name='TaskWatchdog')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def begin(self, task_msg, deadline=None, on_kill=None):
+        """
+        Watch a task from the calling thread
+
+        Parameters
+        ----------
+        task_msg : IbisTaskMessage
+        deadline : float, optional
+          time.time() by which it must have finished
+        on_kill : callable, optional
+          Called before exiting the process if the task won't stop
+        """
+        self._ensure_thread()
+        with self._cond:
+            self._task = _WatchedTask(task_msg, deadline, on_kill)
+            self._cond.notify()
+
+    def running(self):
+        """
+        The task has been handed control, and may now be interrupted
+        """
+        with self._cond:
+            task = self._task
+            task.running = True
+            if task.reason is not None:
+                # Cancelled while waiting
+                self._interrupt(task, task.reason)
+            self._cond.notify()
+
+    def end(self):
+        """
+        Returns why the task was interrupted, if it was
+        """
+        # An interrupt may land while finishing up; finish anyway
+        while True:
+            try:
+                with self._cond:
+                    task, self._task = self._task, None
+                    if task is None:
+                        return None
+                    if task.running:
+                        _set_async_exc(task.thread_id, None)
+                    self._cond.notify()
+                    return task.reason
+            except TaskInterrupted:
+                pass
+
+    def interrupt_reason(self):
+        """
+        Why the current task was interrupted, if it was
+        """
+        task = self._task
+        return None if task is None else task.reason
+
+    def cancel(self):
+        """
+        Returns True if there was a task to cancel
+        """
+        with self._cond:
+            task = self._task
+            if task is None:
+                return False
+            self._interrupt(task, 'Task was cancelled')
+            self._cond.notify()
+            return True
+
+    def _interrupt(self, task, reason):
+        if task.reason is None:
+            task.reason = reason
+
+        if task.running and task.kill_time is None:
+            _set_async_exc(task.thread_id, TaskInterrupted)
+            task.kill_time = time.time() + TASK_KILL_GRACE
+
+    def _run(self):
+        with self._cond:
+            while True:
+                task = self._task
+                timeout = None
+
+                if task is not None and task.running:
+                    now = time.time()
+                    if task.kill_time is not None:
+                        if now >= task.kill_time:
+                            self._kill(task)
+                        timeout = task.kill_time - now
+                    elif task.deadline is not None:
+                        if now >= task.deadline:
+                            self._interrupt(task, 'Task exceeded its '
+                                            'deadline')
+                            continue
+                        timeout = task.deadline - now
+
+                self._cond.wait(timeout)
+
+    def _kill(self, task):
+        message = '%s, and was killed as it did not stop' % task.reason
+        try:
+            report_task_failure(task.task_msg, message)
+            if task.on_kill is not None:
+                task.on_kill()
+        except:
+            traceback.print_exc()
+        finally:
+            os._exit(1)
+
+
+_watchdog = None
+
+
+def get_watchdog():
+    global _watchdog
+    if _watchdog is None:
+        _watchdog = TaskWatchdog()
+    return _watchdog
+
+
 class IbisTaskExecutor(object):
 
     """
     Runs the requested task and handles locking, exception reporting, and so
     forth.
+
+    Parameters
+    ----------
+    task_msg : IbisTaskMessage
+    lock_undo : boolean, default True
+      Passed on as IPCLock's undo; processes that may exit right after
+      handing control back (e.g. recycled pool workers) must pass False
+    on_kill : callable, optional
+      Called if the task has to be killed (see TaskWatchdog)
     """
 
-    def __init__(self, task_msg):
+    def __init__(self, task_msg, lock_undo=True, on_kill=None):
         self.task_msg = task_msg
+        self.on_kill = on_kill
 
-        self.lock = comms.IPCLock(self.task_msg.semaphore_id)
-        self.shmem = comms.SharedMmap(self.task_msg.shmem_name,
-                                      self.task_msg.shmem_size,
-                                      offset=self.task_msg.shmem_offset)
+        self.lock = comms.IPCLock(self.task_msg.semaphore_id,
+                                  lock_timeout_ms=LOCK_WAIT_MS,
+                                  undo=lock_undo)
+        self.shmem = get_segment_pool().get(self.task_msg.shmem_name,
+                                            self.task_msg.shmem_size,
+                                            offset=self.task_msg.shmem_offset)
+
+        # Whether it is our turn with the shared memory. Streaming a
+        # response hands it back and forth
+        self._has_control = False
+        self._watchdog = None
+        self._deadline = None
 
     def _cycle_ipc_lock(self):
         # TODO: I put this here as a failsafe in case the task needs to bail
@@ -147,32 +914,280 @@ class IbisTaskExecutor(object):
         self.lock.release()
 
     def execute(self):
-        # TODO: Timeout concerns
-        self.lock.acquire()
-
+        deadline = None
+        if self.task_msg.timeout is not None:
+            deadline = time.time() + self.task_msg.timeout
+
+        metrics = get_metrics()
+        watchdog = get_watchdog()
+        watchdog.begin(self.task_msg, deadline, self.on_kill)
+        self._watchdog = watchdog
+        self._deadline = deadline
+
+        start = time.time()
+        if not self._acquire(watchdog, deadline):
+            # Never got control, so the memory is not ours to write
+            watchdog.end()
+            get_segment_pool().release(self.shmem)
+            metrics.incr('tasks_abandoned')
+            return
+
+        self._has_control = True
+        acquired = time.time()
+        metrics.observe('lock_wait', acquired - start)
+
+        reason = None
+        try:
+            try:
+                watchdog.running()
+                self._run_task()
+            finally:
+                reason = watchdog.end()
+        except TaskInterrupted:
+            metrics.incr('tasks_interrupted')
+            self._fail(reason or 'Task was interrupted')
+        finally:
+            get_segment_pool().release(self.shmem)
+            if self._has_control:
+                self.lock.release()
+            metrics.incr('busy_seconds', time.time() - acquired)
+
+    def _acquire(self, watchdog, deadline):
+        # Returns False if the deadline passed or the task was cancelled
+        # first
+        while not self.lock.acquire(block=False):
+            if deadline is not None and time.time() > deadline:
+                return False
+            if watchdog.interrupt_reason() is not None:
+                return False
+        return True
+
+    def _run_task(self):
         # TODO: this can break in various ways on bad input
         task_type = wire.read_string(self.shmem)
 
+        metrics = get_metrics()
+        label = task_type if task_type in _task_registry else 'unknown'
+        metrics.incr('tasks.%s' % label)
+
         try:
+            start = time.time()
             klass = _task_registry[task_type]
             task = klass(self.shmem)
+
+            # Task headers are read on construction
+            header_time = time.time() - start
+            task.bytes_in += self.shmem.tell()
+
             task.run()
-        except:
+            if task.oversized_response is not None:
+                self._stream_response(task.oversized_response)
+            _record_task(metrics, label, task, header_time,
+                         time.time() - start)
+        except TaskInterrupted:
+            raise
+        except ClassCacheMiss as e:
+            # Ask for the class to be sent along
+            metrics.incr('tasks_class_missing.%s' % label)
             self.shmem.seek(0)
+            wire.write_uint8(self.shmem, TASK_CLASS_MISSING)
+            wire.write_string(self.shmem, e.digest)
+        except:
+            metrics.incr('task_failures.%s' % label)
+            self._fail(traceback.format_exc())
+
+    def _fail(self, message):
+        if not self._has_control:
+            # Gave up waiting for a streamed response to be drained
+            return
+
+        if (self.task_msg.stream and
+                len(message) + _FAILURE_OVERHEAD > len(self.shmem)):
+            # The whole traceback, rather than what fits
+            self._stream_response([_STATUS_FAILURE,
+                                   wire.UINT32.pack(len(message)), message])
+        else:
+            _write_failure(self.shmem, message)
+
+    def _stream_response(self, pieces):
+        """
+        Hand a response too large for the shared memory to the requesting
+        process part by part, waiting for each part to be drained (see
+        read_response). The last part is left for the usual handoff
+        """
+        total = sum(len(piece) for piece in pieces)
+        if not self.task_msg.stream:
+            raise ValueError('Response of %d bytes does not fit in %d bytes '
+                             'of shared memory' % (total, len(self.shmem)))
+
+        capacity = len(self.shmem) - _RESPONSE_PART.size
+        if capacity <= 0:
+            raise ValueError('Shared memory is too small to stream a '
+                             'response')
+
+        metrics = get_metrics()
+        metrics.incr('responses_streamed')
+
+        sent = 0
+        for part in _split_buffers(pieces, capacity):
+            nbytes = sum(len(view) for view in part)
+            sent += nbytes
+            last = sent == total
+
+            writer = BufferWriter(self.shmem)
+            writer.pack(_RESPONSE_PART, TASK_RESPONSE_PART, last, total,
+                        nbytes)
+            for view in part:
+                writer.write(view)
+            metrics.incr('response_parts')
+
+            if last:
+                return
+
+            # Hand the part over, and wait for our turn to come back
+            self._has_control = False
+            self.lock.release()
+
+            deadline = self._deadline
+            if deadline is None:
+                deadline = time.time() + RESPONSE_DRAIN_TIMEOUT
+            if not self._acquire(self._watchdog, deadline):
+                metrics.incr('responses_abandoned')
+                return
+            self._has_control = True
+
+
+def _split_buffers(pieces, capacity):
+    # Split buffers laid end to end into parts of up to capacity bytes, each
+    # a list of memoryviews
+    part, room = [], capacity
+    for piece in pieces:
+        view = memoryview(piece)
+        pos = 0
+        while pos < len(view):
+            chunk = view[pos:pos + room]
+            part.append(chunk)
+            pos += len(chunk)
+            room -= len(chunk)
+            if not room:
+                yield part
+                part, room = [], capacity
+    if part:
+        yield part
+
+
+def read_response(shmem, lock):
+    """
+    Read a task response in the requesting process, once control of the
+    shared memory has come back (lock acquired). A response streamed in parts
+    (for a task sent with stream=True) is drained part by part, handing
+    control back to the task for each further part, and reassembled.
+
+    Parameters
+    ----------
+    shmem : SharedMmap
+    lock : IPCLock
+      The requesting process's side
+
+    Returns
+    -------
+    response : BufferLike
+      Positioned at the status byte: shmem itself, or a RAMBuffer holding a
+      streamed response
+    """
+    result = None
+    pos = 0
+    while True:
+        shmem.seek(0)
+        status, last, total, nbytes = _read_part_header(shmem)
+        if status != TASK_RESPONSE_PART:
+            # Not streamed, or the stream was cut off by a failure reported
+            # for the task (e.g. the worker died)
+            shmem.seek(0)
+            return shmem
+
+        if result is None:
+            result = comms.RAMBuffer(total)
+
+        start = _RESPONSE_PART.size
+        memoryview(result)[pos:pos + nbytes] = shmem[start:start + nbytes]
+        pos += nbytes
 
-            # XXX: Failure indicator
-            wire.write_uint8(self.shmem, 0)
+        if last:
+            result.seek(0)
+            return result
 
-            tb = traceback.format_exc()
+        lock.release()
+        lock.acquire()
 
-            # HACK: Traceback string must be truncated so it will fit in the
-            # shared memory (along with the uint32 length prefix)
-            if len(tb) + 5 > len(self.shmem):
-                tb = tb[:len(self.shmem) - 5]
 
-            wire.write_string(self.shmem, tb)
+def _read_part_header(shmem):
+    if len(shmem) < _RESPONSE_PART.size:
+        return wire.UINT8.unpack_from(shmem)[0], None, None, None
+    return _RESPONSE_PART.unpack_from(shmem)
+
+
+def _record_task(metrics, label, task, header_time, elapsed):
+    decode = header_time + task.phase_times.get('decode', 0)
+    encode = task.phase_times.get('encode', 0)
+
+    metrics.observe('decode.%s' % label, decode)
+    metrics.observe('execute.%s' % label, elapsed - decode - encode)
+    metrics.observe('encode.%s' % label, encode)
+    metrics.incr('shmem_in_bytes', task.bytes_in)
+    # Tasks writing their response directly leave the position at its end
+    metrics.incr('shmem_out_bytes', task.bytes_out or task.shmem.tell())
+
+
+def metrics_snapshot():
+    """
+    Snapshot of this process's metrics (see ibis.metrics), including what it
+    holds on to between tasks
+    """
+    metrics = get_metrics()
+    metrics.set_gauge('pooled_segments',
+                      len(_segment_pool) if _segment_pool is not None else 0)
+    metrics.set_gauge('resident_agg_states',
+                      len(_agg_states) if _agg_states is not None else 0)
+    metrics.set_gauge('cached_classes',
+                      len(_class_cache) if _class_cache is not None else 0)
+    return metrics.snapshot()
+
+
+def _write_failure(shmem, message):
+    shmem.seek(0)
+
+    # XXX: Failure indicator
+    wire.write_uint8(shmem, 0)
+
+    # HACK: Message string must be truncated so it will fit in the shared
+    # memory (along with the uint32 length prefix)
+    if len(message) + _FAILURE_OVERHEAD > len(shmem):
+        message = message[:len(shmem) - _FAILURE_OVERHEAD]
+
+    wire.write_string(shmem, message)
+
+
+def report_task_failure(task_msg, message):
+    """
+    Fail a task on behalf of a worker that can no longer run it (e.g. it
+    died), writing the message where the task's result would go and handing
+    control back to the requesting process.
+    """
+    lock = comms.IPCLock(task_msg.semaphore_id, undo=False)
+
+    # Take the worker's turn if it never did
+    lock.acquire(block=False)
+
+    try:
+        shmem = comms.SharedMmap(task_msg.shmem_name, task_msg.shmem_size,
+                                 offset=task_msg.shmem_offset)
+        try:
+            _write_failure(shmem, message)
         finally:
-            self.lock.release()
+            shmem.close()
+    finally:
+        lock.release()
 
 
 # ---------------------------------------------------------------------
@@ -193,25 +1208,40 @@ register_task('ping', PingPongTask)
 # Aggregation execution tasks
 
 
+# State flags in aggregation task headers: no state, a pickled state, or the
+# handle of a state resident in the worker (see AggregationStateTable)
+AGG_STATE_NONE = 0
+AGG_STATE_PICKLED = 1
+AGG_STATE_HANDLE = 2
+
+
 class AggregationTask(Task):
 
     def _write_response(self, agg_inst):
+        with self._phase('encode'):
+            pieces = _state_pieces(agg_inst)
+            nbytes = sum(len(piece) for piece in pieces)
+            self._respond(_STATUS_SUCCESS, wire.UINT32.pack(nbytes), *pieces)
+
+    def _write_handle_response(self, handle):
+        # The state stays in the worker; only its handle goes back
         self.shmem.seek(0)
         self.mark_success()
-
-        serialized_inst = pickle_dump(agg_inst)
-        wire.write_string(self.shmem, serialized_inst)
+        wire.write_string(self.shmem, handle)
+        self.bytes_out = self.shmem.tell()
 
 
 class AggregationUpdateTask(AggregationTask):
 
     """
     Task header layout
-    - serialized agg class
-    - prior state flag 1/0
-    - (optional) serialized prior state
+    - agg class reference (see write_class_ref)
+    - state flag (AGG_STATE_*)
+    - (optional) serialized prior state, or resident state handle
     - serialized table fragment
 
+    With a handle, the state is created from the class on first use and
+    stays resident; the response is the handle rather than the state
     """
 
     def __init__(self, shmem):
@@ -220,27 +1250,45 @@ class AggregationUpdateTask(AggregationTask):
         self._read_header()
 
     def _read_header(self):
-        reader = wire.PackedMessageReader(self.shmem)
-
         # Unpack header
-        self.agg_class_pickled = reader.string()
-        has_prior_state = reader.uint8() != 0
+        with self._header() as reader:
+            self.agg_class = read_class_ref(reader)
+            state_flag = reader.uint8()
 
-        if has_prior_state:
-            self.prior_state = pickle_load(reader.string())
-        else:
             self.prior_state = None
+            self.handle = None
+            if state_flag == AGG_STATE_PICKLED:
+                self.prior_state = load_state(reader.string_view())
+            elif state_flag == AGG_STATE_HANDLE:
+                self.handle = reader.string()
+            elif state_flag != AGG_STATE_NONE:
+                raise ValueError('Unknown state flag %d' % state_flag)
 
     def run(self):
-        if self.prior_state is not None:
+        if self.handle is not None:
+            agg_inst = self._resident_state()
+        elif self.prior_state is not None:
             agg_inst = self.prior_state
         else:
-            klass = pickle_load(self.agg_class_pickled)
-            agg_inst = klass()
+            agg_inst = self.agg_class()
 
-        args = self._deserialize_args()
+        with self._phase('decode'):
+            args = self._deserialize_args()
         agg_inst.update(*args)
-        self._write_response(agg_inst)
+
+        if self.handle is not None:
+            self._write_handle_response(self.handle)
+        else:
+            self._write_response(agg_inst)
+
+    def _resident_state(self):
+        states = get_agg_states()
+        try:
+            return states.get(self.handle)
+        except KeyError:
+            agg_inst = self.agg_class()
+            states.put(self.handle, agg_inst)
+            return agg_inst
 
     def _deserialize_args(self):
         # TODO: we need some mechanism to indicate how the data should be
@@ -249,6 +1297,7 @@ class AggregationUpdateTask(AggregationTask):
 
         # Deserialize data fragment
         table_reader = comms.IbisTableReader(self.shmem)
+        self.bytes_in += table_reader.nbytes
 
         args = []
         for i in range(table_reader.ncolumns):
@@ -265,13 +1314,12 @@ class AggregationMergeTask(AggregationTask):
     def __init__(self, shmem):
         AggregationTask.__init__(self, shmem)
 
-        reader = wire.PackedMessageReader(shmem)
-
-        # TODO: may wish to merge more than 2 at a time?
+        # See agg-merge-many to merge more than 2 at a time
 
         # Unpack header
-        self.left_inst = pickle_load(reader.string())
-        self.right_inst = pickle_load(reader.string())
+        with self._header() as reader:
+            self.left_inst = load_state(reader.string_view())
+            self.right_inst = load_state(reader.string_view())
 
     def run(self):
         # Objects to merge stored in length-prefixed strings in shared memory
@@ -279,13 +1327,199 @@ class AggregationMergeTask(AggregationTask):
         self._write_response(merged)
 
 
+class AggregationMergeManyTask(AggregationTask):
+
+    """
+    Merge a batch of states in one task (see merge_states and tree_merge).
+    Task header layout
+    - number of states (uint32)
+    - that many serialized states
+    """
+
+    def __init__(self, shmem):
+        AggregationTask.__init__(self, shmem)
+
+        with self._header() as reader:
+            count = reader.uint32()
+            if not count:
+                raise ValueError('No states to merge')
+            self.states = [load_state(reader.string_view())
+                           for i in range(count)]
+
+    def run(self):
+        self._write_response(merge_states(self.states))
+
+
+def merge_states(states):
+    """
+    Merge a list of aggregation states into one. If the aggregator class has
+    a merge_many method, it is called once on the first state with a list of
+    the others (e.g. to combine them with vectorized NumPy operations), and
+    returns the merged state like merge does.
+
+    Otherwise the states are merged pairwise in a balanced tree rather than
+    folded into the first one, so that merges whose cost grows with the size
+    of the state (sets, sketches) do not redo the work of earlier ones
+    """
+    if not states:
+        raise ValueError('No states to merge')
+
+    first = states[0]
+    if len(states) == 1:
+        return first
+
+    merge_many = getattr(first, 'merge_many', None)
+    if merge_many is not None:
+        return merge_many(states[1:])
+
+    while len(states) > 1:
+        merged = [left.merge(right)
+                  for left, right in zip(states[::2], states[1::2])]
+        if len(states) % 2:
+            merged.append(states[-1])
+        states = merged
+    return states[0]
+
+
+# Most states merged by one agg-merge-many task in tree_merge
+AGG_MERGE_FANOUT = 16
+
+
+def tree_merge(states, merge_batch, fanout=AGG_MERGE_FANOUT, map=map):
+    """
+    Merge many serialized aggregation states (e.g. one per query fragment)
+    with a tree reduction. Each level merges batches of up to fanout states
+    with agg-merge-many tasks, which can run at the same time in different
+    worker processes, so N states take about log(N) / log(fanout) levels
+    instead of a chain of N - 1 agg-merge tasks.
+
+    Parameters
+    ----------
+    states : list of bytes
+      Serialized states
+    merge_batch : function
+      Runs an agg-merge-many task on a list of serialized states, returning
+      the serialized result
+    fanout : int, default AGG_MERGE_FANOUT
+    map : function, default map
+      Applies merge_batch to the batches of a level; pass e.g. a thread
+      pool's map to run them concurrently
+
+    Returns
+    -------
+    merged : bytes
+    """
+    if fanout < 2:
+        raise ValueError('fanout must be at least 2')
+    if not states:
+        raise ValueError('No states to merge')
+
+    states = list(states)
+    while len(states) > 1:
+        batches = [states[i:i + fanout]
+                   for i in range(0, len(states), fanout)]
+
+        # A state left over on its own moves up a level as it is
+        leftover = []
+        if len(batches[-1]) == 1:
+            leftover = batches.pop()
+
+        states = list(map(merge_batch, batches)) + leftover
+    return states[0]
+
+
+class ResidentMergeTask(AggregationTask):
+
+    """
+    Merge into a resident state. Task header layout
+    - target state handle
+    - state flag of the other state (AGG_STATE_PICKLED or AGG_STATE_HANDLE)
+    - serialized state (e.g. from another host), or resident state handle
+
+    A resident state merged into the target is released. The response is the
+    target handle
+    """
+
+    def __init__(self, shmem):
+        AggregationTask.__init__(self, shmem)
+
+        with self._header() as reader:
+            self.handle = reader.string()
+
+            state_flag = reader.uint8()
+            if state_flag == AGG_STATE_PICKLED:
+                self.other_state = load_state(reader.string_view())
+                self.other_handle = None
+            elif state_flag == AGG_STATE_HANDLE:
+                self.other_state = None
+                self.other_handle = reader.string()
+            else:
+                raise ValueError('Unknown state flag %d' % state_flag)
+
+    def run(self):
+        states = get_agg_states()
+        target = states.get(self.handle)
+
+        if self.other_handle is not None:
+            other = states.pop(self.other_handle)
+        else:
+            other = self.other_state
+
+        # merge may return a new object rather than update in place
+        states.put(self.handle, target.merge(other))
+        self._write_handle_response(self.handle)
+
+
+class ResidentFinalizeTask(AggregationTask):
+
+    """
+    Finalize a resident state and release its handle. Task header layout
+    - state handle
+    """
+
+    def __init__(self, shmem):
+        AggregationTask.__init__(self, shmem)
+
+        with self._header() as reader:
+            self.handle = reader.string()
+
+    def run(self):
+        result = get_agg_states().pop(self.handle).finalize()
+        self._write_response(result)
+
+
+class ResidentExportTask(AggregationTask):
+
+    """
+    Serialize a resident state, e.g. to merge it on another host. Task
+    header layout
+    - state handle
+    - release flag 1/0: drop the resident state afterwards
+    """
+
+    def __init__(self, shmem):
+        AggregationTask.__init__(self, shmem)
+
+        with self._header() as reader:
+            self.handle = reader.string()
+            self.release = reader.uint8() != 0
+
+    def run(self):
+        states = get_agg_states()
+        if self.release:
+            state = states.pop(self.handle)
+        else:
+            state = states.get(self.handle)
+        self._write_response(state)
+
+
 class AggregationFinalizeTask(AggregationTask):
 
     def __init__(self, shmem):
         AggregationTask.__init__(self, shmem)
 
-        reader = wire.PackedMessageReader(shmem)
-        self.state = pickle_load(reader.string())
+        with self._header() as reader:
+            self.state = load_state(reader.string_view())
 
     def run(self):
         # Single length-prefixed string to finalize
@@ -295,4 +1529,69 @@ class AggregationFinalizeTask(AggregationTask):
 
 register_task('agg-update', AggregationUpdateTask)
 register_task('agg-merge', AggregationMergeTask)
+register_task('agg-merge-many', AggregationMergeManyTask)
 register_task('agg-finalize', AggregationFinalizeTask)
+register_task('agg-merge-resident', ResidentMergeTask)
+register_task('agg-finalize-resident', ResidentFinalizeTask)
+register_task('agg-export-resident', ResidentExportTask)
+
+
+# ---------------------------------------------------------------------
+# Scalar UDF execution
+
+
+class ScalarUDFTask(Task):
+
+    """
+    Evaluate a Python function over a batch of rows, calling it once with one
+    NumPy array per input column (see MaskedColumn.to_numpy_for_pandas)
+    rather than once per row. It returns an array of the same length, with
+    nulls as NaN or None or masked.
+
+    Task header layout
+    - function reference (see write_class_ref)
+    - output type name, e.g. 'double'
+    - serialized table of input columns
+
+    The response, written over the input, is the success flag followed by a
+    one-column table holding the output
+    """
+
+    def __init__(self, shmem):
+        Task.__init__(self, shmem)
+
+        with self._header() as reader:
+            self.func = read_class_ref(reader)
+            self.output_type = reader.string()
+
+    def run(self):
+        with self._phase('decode'):
+            table = comms.IbisTableReader(self.shmem)
+            self.bytes_in += table.nbytes
+            args = [table.get_column(i).to_numpy_for_pandas()
+                    for i in range(table.ncolumns)]
+
+        result = self.func(*args)
+        if len(result) != table.length:
+            raise ValueError('UDF returned %d values for %d rows'
+                             % (len(result), table.length))
+
+        with self._phase('encode'):
+            # Copies the result, which may alias the input columns
+            column = comms.masked_from_pandas(result, self.output_type)
+            writer = comms.IbisTableWriter([column])
+
+            if writer.total_size() + 1 > len(self.shmem):
+                # Stream it (see read_response)
+                table = comms.RAMBuffer(writer.total_size())
+                writer.write(table)
+                self._respond(_STATUS_SUCCESS, table)
+                return
+
+            self.shmem.seek(0)
+            self.mark_success()
+            writer.write(self.shmem)
+            self.bytes_out = writer.total_size() + 1
+
+
+register_task('udf-scalar', ScalarUDFTask)
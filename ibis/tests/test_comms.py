@@ -13,15 +13,19 @@
 # limitations under the License.
 
 import os
+import struct
 import sys
 import threading
 
 import pytest
 
 import numpy as np
+import pandas as pd
 
 from ibis.util import guid
 from ibis.compat import unittest
+import ibis.wire as wire
+import ibis
 
 try:
     import ibis.comms as comms
@@ -102,6 +106,59 @@ class TestIPCLock(unittest.TestCase):
         assert results == ex_results
 
 
+class TestSharedMemoryLock(TestIPCLock):
+
+    def setUp(self):
+        if not comms.HAVE_SHARED_MEMORY_LOCK:
+            raise unittest.SkipTest
+
+        self.timeout = 1
+        self.buf = comms.RAMBuffer(64)
+        self.master = comms.SharedMemoryLock(self.buf, offset=8, is_slave=0,
+                                             lock_timeout_ms=self.timeout)
+        self.slave = comms.SharedMemoryLock(self.buf, offset=8,
+                                            lock_timeout_ms=self.timeout)
+
+    def test_cleanup_semaphore_arrays(self):
+        raise unittest.SkipTest('SharedMemoryLock uses no semaphores')
+
+    def test_bad_offsets(self):
+        self.assertRaises(ValueError, comms.SharedMemoryLock, self.buf,
+                          offset=60)
+        self.assertRaises(ValueError, comms.SharedMemoryLock, self.buf,
+                          offset=2)
+
+    def test_handoff_across_processes(self):
+        path = guid()
+        try:
+            mm = SharedMmap(path, 64, create=True)
+            master = comms.SharedMemoryLock(mm, is_slave=0)
+
+            pid = os.fork()
+            if pid == 0:
+                slave = comms.SharedMemoryLock(SharedMmap(path, 64))
+                for i in range(100):
+                    with slave:
+                        pass
+                os._exit(0)
+
+            for i in range(100):
+                with master:
+                    pass
+
+            _, status = os.waitpid(pid, 0)
+            assert status == 0
+        finally:
+            _nuke(path)
+
+    def test_make_ipc_lock(self):
+        lock = comms.make_ipc_lock(self.buf, is_slave=0)
+        assert isinstance(lock, comms.SharedMemoryLock)
+
+        lock = comms.make_ipc_lock(is_slave=0)
+        assert isinstance(lock, comms.IPCLock)
+
+
 class TestSharedMmap(unittest.TestCase):
 
     def setUp(self):
@@ -188,6 +245,249 @@ class TestSharedMmap(unittest.TestCase):
         result = mm2.read()
         self.assertEqual(result, data)
 
+    def test_buffer_protocol(self):
+        path = guid()
+        self.to_nuke.append(path)
+
+        mm = SharedMmap(path, 16, create=True)
+        mm.write(struct.pack('IIQ', 1, 2, 3))
+
+        assert struct.unpack_from('IIQ', mm) == (1, 2, 3)
+        assert struct.unpack_from('Q', mm, 8) == (3,)
+
+        # Writes through a NumPy view are visible in the mapping
+        arr = np.asarray(mm).view(np.uint32)
+        arr[1] = 5
+        mm.seek(4)
+        assert mm.read(4) == struct.pack('I', 5)
+
+        view = memoryview(mm)
+        assert len(view) == 16
+        assert view.tobytes() == mm[:].tobytes()
+        assert mm[4:8].tobytes() == struct.pack('I', 5)
+
+        # Can't unmap memory that is still being viewed
+        self.assertRaises(BufferError, mm.close)
+        del view
+        self.assertRaises(BufferError, mm.close)
+        assert arr[1] == 5
+
+        del arr
+        mm.close()
+        self.assertRaises(IOError, memoryview, mm)
+
+    def test_read_view_and_readinto(self):
+        data = guid()
+
+        buf = comms.RAMBuffer(len(data))
+        buf.write(data)
+        buf.seek(0)
+
+        view = buf.read_view(8)
+        assert isinstance(view, memoryview)
+        assert view.tobytes() == data[:8]
+
+        out = bytearray(8)
+        assert buf.readinto(out) == 8
+        assert bytes(out) == data[8:16]
+
+        out = np.zeros(100, dtype=np.uint8)
+        assert buf.readinto(out) == len(data) - 16
+        assert out[:len(data) - 16].tostring() == data[16:]
+
+
+class TestBufferReaderWriter(unittest.TestCase):
+
+    def setUp(self):
+        self.to_nuke = []
+
+    def tearDown(self):
+        for path in self.to_nuke:
+            _nuke(path)
+
+    def test_shared_memory_in_place(self):
+        path = guid()
+        self.to_nuke.append(path)
+        mm = SharedMmap(path, 64, create=True)
+
+        header = struct.Struct('=IQ')
+        writer = wire.BufferWriter(mm, 4)
+        writer.pack(header, 7, 2 ** 40).string('foo').uint8(1)
+        end = writer.tell()
+        del writer
+
+        # Same bytes as the stream-based writer produces
+        expected = wire.PackedMessageWriter()
+        expected.uint32(7).uint64(2 ** 40)
+        expected.string('foo')
+        expected.uint8(1)
+        mm.seek(4)
+        assert mm.read(end - 4) == expected.get_result()
+
+        reader = wire.BufferReader(mm, 4)
+        assert reader.unpack(header) == (7, 2 ** 40)
+        view = reader.string_view()
+        assert isinstance(view, memoryview) and view.tobytes() == 'foo'
+        assert reader.uint8() == 1
+        assert reader.tell() == end
+        assert reader.remaining() == 64 - end
+
+        # No copies: the reader's views keep the mapping alive
+        self.assertRaises(BufferError, mm.close)
+        del view, reader
+        mm.close()
+
+    def test_bounds(self):
+        reader = wire.BufferReader(struct.pack('I', 100) + 'abc')
+        self.assertRaises(ValueError, reader.string)
+
+        reader = wire.BufferReader('ab')
+        self.assertRaises(struct.error, reader.uint32)
+
+        writer = wire.BufferWriter(bytearray(6))
+        self.assertRaises(ValueError, writer.string, 'abc')
+        assert writer.tell() == 0
+
+    def test_seek_to_end(self):
+        buf = comms.RAMBuffer(8)
+        buf.seek(8)
+        assert buf.read() == ''
+        self.assertRaises(IOError, buf.seek, 9)
+
+
+class TestSegmentPool(unittest.TestCase):
+
+    def setUp(self):
+        self.to_nuke = []
+        self.shm_to_unlink = []
+        self.pool = comms.SegmentPool()
+
+    def tearDown(self):
+        self.pool.clear()
+        for path in self.to_nuke:
+            _nuke(path)
+        for name in self.shm_to_unlink:
+            try:
+                comms.unlink_shm(name)
+            except OSError:
+                pass
+
+    def _shm_name(self):
+        name = '/ibis-test-%s' % guid()
+        self.shm_to_unlink.append(name)
+        return name
+
+    def test_shared_mmap_shm(self):
+        name = self._shm_name()
+        self.assertRaises(IOError, SharedMmap, name, 1024, shm=True)
+
+        mm = SharedMmap(name, 1024, create=True, shm=True, populate=True)
+        mm.advise('sequential')
+        mm.write('foobar')
+
+        mm2 = SharedMmap(name, 1024, shm=True)
+        assert mm2.read(6) == 'foobar'
+        mm.close()
+        mm2.close()
+
+        comms.unlink_shm(name)
+        self.assertRaises(IOError, SharedMmap, name, 1024, shm=True)
+
+    def test_reuse_mapping(self):
+        name = self._shm_name()
+
+        mm = self.pool.get(name, 1024, create=True)
+        mm.write('foo')
+        self.pool.release(mm)
+
+        # Same segment comes back, positioned at the start
+        mm2 = self.pool.get(name, 1024)
+        assert mm2 is mm
+        assert mm2.tell() == 0
+        assert mm2.read(3) == 'foo'
+        assert self.pool.hits == 1
+
+        # In use, so a different size or a second request maps anew
+        mm3 = self.pool.get(name, 1024)
+        assert mm3 is not mm2
+        mm4 = self.pool.get(name, 512)
+        assert mm4 is not mm2
+        assert self.pool.misses == 3
+
+        for x in [mm2, mm3, mm4]:
+            self.pool.release(x)
+        assert len(self.pool) == 3
+
+        self.assertRaises(ValueError, self.pool.release, mm2)
+
+    def test_files(self):
+        path = guid()
+        self.to_nuke.append(path)
+
+        mm = self.pool.get(path, 1024, create=True)
+        assert not mm.shm
+        self.pool.release(mm)
+        assert self.pool.get(path, 1024) is mm
+
+    def test_recreated_segment_not_reused(self):
+        path = guid()
+        self.to_nuke.append(path)
+
+        mm = self.pool.get(path, 64, create=True)
+        self.pool.release(mm)
+
+        os.remove(path)
+        with open(path, 'wb') as f:
+            f.write('x' * 64)
+
+        mm2 = self.pool.get(path, 64)
+        assert mm2 is not mm
+        assert mm.closed
+        assert mm2.read(1) == 'x'
+
+    def test_unlinked_segments_closed(self):
+        # Released after the producer unlinked it
+        name = self._shm_name()
+        mm = self.pool.get(name, 64, create=True)
+        comms.unlink_shm(name)
+        self.pool.release(mm)
+        assert mm.closed
+        assert len(self.pool) == 0
+
+        # Unlinked while idle
+        name = self._shm_name()
+        mm = self.pool.get(name, 64, create=True)
+        self.pool.release(mm)
+        assert not mm.closed
+
+        comms.unlink_shm(name)
+        self.pool.reclaim()
+        assert mm.closed
+        assert len(self.pool) == 0
+
+    def test_reclaim_idle(self):
+        pool = comms.SegmentPool(max_idle_segments=2)
+
+        mappings = [pool.get(self._shm_name(), 64, create=True)
+                    for i in range(4)]
+        for mm in mappings:
+            pool.release(mm)
+
+        # Oldest closed first
+        assert [mm.closed for mm in mappings] == [True, True, False, False]
+        assert len(pool) == 2
+
+        in_use = pool.get(mappings[3].location, 64)
+        pool.reclaim(max_idle=-1)
+        assert mappings[2].closed
+        assert not in_use.closed
+        assert len(pool) == 1
+
+        pool.release(in_use)
+        pool.clear()
+        assert in_use.closed
+        assert len(pool) == 0
+
 
 def rand_bool(N):
     return np.random.randint(0, 2, size=N).astype(np.uint8)
@@ -231,8 +531,8 @@ class TestImpalaMaskedFormat(unittest.TestCase):
     """
     N = 1000
 
-    def _check_roundtrip(self, columns):
-        writer = IbisTableWriter(columns)
+    def _check_roundtrip(self, columns, **kwargs):
+        writer = IbisTableWriter(columns, **kwargs)
 
         table_size = writer.total_size()
 
@@ -246,6 +546,129 @@ class TestImpalaMaskedFormat(unittest.TestCase):
 
             assert result.equals(expected)
 
+        return reader
+
+    def _write_table(self, columns, **kwargs):
+        writer = IbisTableWriter(columns, **kwargs)
+        buf = comms.RAMBuffer(writer.total_size())
+        writer.write(buf)
+        buf.seek(0)
+        return buf
+
+    def test_version1_roundtrip(self):
+        columns = [double_ex(self.N), int_ex(self.N, IbisType.INT)]
+        reader = self._check_roundtrip(columns, version=1)
+        assert reader.version == 1
+        assert reader.names == [None, None]
+
+        # Still the default, for workers that only read version 1
+        assert self._check_roundtrip(columns).version == 1
+
+        self.assertRaises(ValueError, IbisTableWriter, columns,
+                          names=['a', 'b'], version=1)
+
+    def test_column_names(self):
+        columns = [double_ex(self.N), int_ex(self.N, IbisType.INT),
+                   bool_ex(self.N)]
+        names = ['foo', u'b\xe4r', 'a_much_longer_column_name']
+        reader = self._check_roundtrip(columns, names=names, version=2)
+
+        assert reader.version == 2
+        assert reader.names == names
+        assert reader.get_column('foo').equals(columns[0])
+        assert reader.get_column(u'b\xe4r').equals(columns[1])
+        self.assertRaises(KeyError, reader.get_column, 'baz')
+        self.assertRaises(IndexError, reader.get_column, 3)
+
+        info = reader.column_info('a_much_longer_column_name')
+        assert info['dtype'] == IbisType.BOOLEAN
+        assert info['encoding'] == comms.ENCODING_PLAIN
+
+    def test_skip_unknown_columns(self):
+        columns = [double_ex(self.N), int_ex(self.N, IbisType.INT)]
+        buf = self._write_table(columns, names=['a', 'b'], version=2)
+
+        # Give the first column an encoding this reader doesn't know about
+        memoryview(buf)[32 + 1:32 + 2] = b'\x7f'
+
+        reader = IbisTableReader(buf)
+        assert reader.column_info(0)['encoding'] == 0x7f
+        self.assertRaises(NotImplementedError, reader.get_column, 'a')
+        assert reader.get_column('b').equals(columns[1])
+
+    def test_decimal_metadata(self):
+        mask = rand_bool(self.N)
+        values = np.random.randn(self.N)
+        col = comms.masked_from_numpy(values, mask, IbisType.DECIMAL,
+                                      precision=12, scale=2)
+        buf = self._write_table([col], version=2)
+
+        result = IbisTableReader(buf).get_column(0)
+        assert result.precision == 12
+        assert result.scale == 2
+
+        self.assertRaises(ValueError, IbisTableWriter, [col], version=1)
+
+    def test_decimal_from_dataframe(self):
+        df = pd.DataFrame({'a': [1.5, np.nan, 2.25]})
+        buf = comms.write_dataframe(df, [('a', 'decimal(12,2)')], version=2)
+
+        info = IbisTableReader(buf).column_info('a')
+        assert info['dtype'] == IbisType.DECIMAL
+        assert (info['precision'], info['scale']) == (12, 2)
+
+    def test_newer_versions(self):
+        buf = self._write_table([double_ex(self.N)], version=2)
+
+        # Additive changes bump the version but not the oldest reader that
+        # can read the table
+        memoryview(buf)[4:6] = struct.pack('H', 99)
+        assert IbisTableReader(buf).version == 99
+
+        memoryview(buf)[6:8] = struct.pack('H', 3)
+        self.assertRaises(ValueError, IbisTableReader, buf)
+
+    def test_appended_header_fields(self):
+        # A newer writer extended the fixed header and the descriptors; an
+        # older reader must skip what it does not know
+        columns = [double_ex(self.N), int_ex(self.N, IbisType.INT)]
+        buf = self._write_table(columns, names=['a', 'b'], version=2)
+        old = buf.read()
+
+        fixed, ncols, header_size = 32, 2, struct.unpack_from('I', old, 24)[0]
+        offsets_start = fixed + 8 * ncols
+        descriptors = [old[fixed + 8 * i:fixed + 8 * (i + 1)] + b'\xff' * 8
+                       for i in range(ncols)]
+        header = (old[:fixed] + b'\xee' * 16 + b''.join(descriptors) +
+                  old[offsets_start:header_size] + b'\x00' * 32)
+        header = (header[:10] + struct.pack('H', 16) + header[12:24] +
+                  struct.pack('II', len(header), fixed + 16) + header[32:])
+        data = header + old[header_size:]
+
+        new_buf = comms.RAMBuffer(len(data))
+        new_buf.write(data)
+        new_buf.seek(0)
+
+        reader = IbisTableReader(new_buf)
+        assert reader.names == ['a', 'b']
+        for i, col in enumerate(columns):
+            assert reader.get_column(i).equals(col)
+
+    def test_truncated_header(self):
+        buf = self._write_table([double_ex(self.N)], version=2)
+        for size in (2, 20):
+            truncated = comms.RAMBuffer(size)
+            truncated.write(buf.read(size))
+            truncated.seek(0)
+            buf.seek(0)
+            self.assertRaises(ValueError, IbisTableReader, truncated)
+
+    def test_data_is_aligned(self):
+        buf = self._write_table([double_ex(self.N)], names=['abc'],
+                                version=2)
+        header_size = struct.unpack_from('I', buf, 24)[0]
+        assert header_size % 8 == 0
+
     def test_basic_diverse_table(self):
         columns = [
             bool_ex(self.N),
@@ -349,6 +772,130 @@ class TestImpalaMaskedFormat(unittest.TestCase):
         ex_mask = col.mask().view(np.bool_)
         assert np.array_equal(mask, ex_mask)
 
+    def test_from_dataframe(self):
+        df = pd.DataFrame({
+            'a': rand_bool(self.N).astype(bool),
+            'b': np.random.randn(self.N),
+            'c': rand_int_span(np.int32, self.N),
+            'd': rand_int_span(np.int16, self.N).astype(np.float64)
+        })
+        df.loc[df.index[::7], 'b'] = np.nan
+        df.loc[df.index[::3], 'd'] = np.nan
+
+        schema = [('a', 'boolean'), ('b', 'double'), ('c', 'int32'),
+                  ('d', 'int16')]
+
+        buf = comms.write_dataframe(df, schema)
+        writer = IbisTableWriter.from_dataframe(df, schema)
+        assert len(buf) == writer.total_size()
+
+        buf.seek(0)
+        reader = IbisTableReader(buf)
+        assert reader.ncolumns == 4
+        assert reader.length == self.N
+
+        for i, (name, _) in enumerate(schema):
+            col = reader.get_column(i)
+            ex_mask = df[name].isnull().values
+            assert np.array_equal(col.mask().view(np.bool_), ex_mask)
+
+            result = pd.Series(col.to_numpy_for_pandas())
+            assert result.equals(df[name])
+
+    def test_from_dataframe_schema_order(self):
+        # Schema columns in a different order than the frame, and a subset
+        df = pd.DataFrame({'a': [1., np.nan, 3.], 'b': [np.nan, 5., 6.],
+                           'c': [np.nan, np.nan, 9.]})
+        schema = [('b', 'double'), ('a', 'double')]
+
+        buf = comms.write_dataframe(df, schema)
+        buf.seek(0)
+        reader = IbisTableReader(buf)
+
+        for i, (name, _) in enumerate(schema):
+            col = reader.get_column(i)
+            assert np.array_equal(col.mask().view(np.bool_),
+                                  df[name].isnull().values)
+
+            result = pd.Series(col.to_numpy_for_pandas())
+            assert result.equals(df[name].reset_index(drop=True))
+
+    def test_from_dataframe_shared_mmap(self):
+        df = pd.DataFrame({'a': np.random.randn(self.N),
+                           'b': rand_int_span(np.int64, self.N)})
+        schema = ibis.schema([('a', 'double'), ('b', 'int64')])
+
+        path = guid()
+        try:
+            writer = IbisTableWriter.from_dataframe(df, schema)
+            mm = SharedMmap(path, writer.total_size(), create=True)
+            comms.write_dataframe(df, schema, out=mm)
+
+            mm.seek(0)
+            reader = IbisTableReader(mm)
+            result = reader.get_column(1).to_numpy_for_pandas()
+            assert np.array_equal(result, df['b'].values)
+        finally:
+            _nuke(path)
+
+    def test_to_pandas(self):
+        df = pd.DataFrame(dict(('c%d' % i, np.random.randn(self.N))
+                               for i in range(20)))
+        df['ints'] = rand_int_span(np.int32, self.N)
+        df['nullable_ints'] = rand_int_span(np.int16, self.N).astype('f8')
+        df['bools'] = rand_bool(self.N).astype(bool)
+        df.loc[df.index[::5], 'c3'] = np.nan
+        df.loc[df.index[::4], 'nullable_ints'] = np.nan
+
+        schema = [(name, 'double') for name in df.columns[:20]]
+        schema += [('ints', 'int32'), ('nullable_ints', 'int16'),
+                   ('bools', 'boolean')]
+        buf = comms.write_dataframe(df, schema, version=2)
+
+        buf.seek(0)
+        reader = IbisTableReader(buf)
+        result = reader.to_pandas()
+        result_threaded = reader.to_pandas(nthreads=4)
+
+        ex_names = [name for name, _ in schema]
+        assert list(result.columns) == ex_names
+        assert result.equals(df[ex_names])
+        assert result_threaded.equals(result)
+
+        # Results do not reference the buffer
+        memoryview(buf)[:] = b'\x00' * len(buf)
+        assert result_threaded.equals(df[ex_names])
+
+    def test_to_pandas_version1(self):
+        columns = [double_ex(self.N), int_ex(self.N, IbisType.INT)]
+        buf = self._write_table(columns, version=1)
+
+        result = IbisTableReader(buf).to_pandas(nthreads=2)
+        assert list(result.columns) == [0, 1]
+        assert np.array_equal(result[1].isnull().values,
+                              columns[1].mask().view(np.bool_))
+
+    def test_to_pandas_unnamed_and_duplicate_names(self):
+        columns = [double_ex(self.N), double_ex(self.N),
+                   int_ex(self.N, IbisType.INT)]
+        expected = [col.to_numpy_for_pandas() for col in columns]
+
+        for names in [None, ['a', 'a', '']]:
+            buf = self._write_table(columns, names=names, version=2)
+            for nthreads in [1, 2]:
+                result = IbisTableReader(buf).to_pandas(nthreads=nthreads)
+                assert len(result.columns) == 3
+                for i, ex in enumerate(expected):
+                    assert pd.Series(ex).equals(result.iloc[:, i])
+
+        assert list(result.columns) == ['a', 'a', 2]
+
+    def test_from_dataframe_unsupported_type(self):
+        df = pd.DataFrame({'a': ['foo', 'bar']})
+        self.assertRaises(NotImplementedError,
+                          IbisTableWriter.from_dataframe, df,
+                          [('a', 'string')])
+
     def test_string_pyobject(self):
         # pandas handles strings in object-type (NPY_OBJECT) arrays and uses
         # either None or NaN for nulls. For the time being we'll be consistent
@@ -0,0 +1,98 @@
+# Copyright 2014 Cloudera Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+
+from ibis.compat import unittest
+from ibis.metrics import (Histogram, MetricsRegistry, format_metrics,
+                          merge_snapshots, percentile)
+
+
+class TestHistogram(unittest.TestCase):
+
+    def test_percentiles(self):
+        hist = Histogram()
+        for i in range(99):
+            hist.observe(0.001)
+        hist.observe(1.5)
+
+        snap = hist.snapshot()
+        assert snap['count'] == 100
+        assert snap['max'] == 1.5
+
+        # Upper bound of the bucket, within a factor of two
+        assert 0.001 <= percentile(snap, 50) < 0.002
+        assert 0.001 <= percentile(snap, 99) < 0.002
+        assert percentile(snap, 100) == 1.5
+
+    def test_zero_and_empty(self):
+        hist = Histogram()
+        assert percentile(hist.snapshot(), 50) == 0
+
+        hist.observe(0)
+        assert hist.snapshot()['buckets'][0] == 1
+
+
+class TestMetricsRegistry(unittest.TestCase):
+
+    def setUp(self):
+        self.metrics = MetricsRegistry()
+
+    def test_counters_gauges_histograms(self):
+        self.metrics.incr('tasks.ping')
+        self.metrics.incr('tasks.ping', 2)
+        self.metrics.set_gauge('queue_depth', 5)
+        with self.metrics.timer('execute.ping'):
+            pass
+
+        snap = self.metrics.snapshot()
+        assert snap['counters'] == {'tasks.ping': 3}
+        assert snap['gauges'] == {'queue_depth': 5}
+        assert snap['histograms']['execute.ping']['count'] == 1
+
+        # Snapshots travel as JSON
+        assert json.loads(json.dumps(snap)) == snap
+
+        self.metrics.clear()
+        assert self.metrics.snapshot()['counters'] == {}
+
+    def test_merge_snapshots(self):
+        other = MetricsRegistry()
+
+        self.metrics.incr('tasks.ping')
+        self.metrics.observe('pickle_in_bytes', 100)
+        other.incr('tasks.ping')
+        other.incr('forks.pool')
+        other.observe('pickle_in_bytes', 5000)
+
+        merged = merge_snapshots([self.metrics.snapshot(),
+                                  other.snapshot()])
+        assert merged['counters'] == {'tasks.ping': 2, 'forks.pool': 1}
+
+        hist = merged['histograms']['pickle_in_bytes']
+        assert hist['count'] == 2
+        assert hist['sum'] == 5100
+        assert hist['max'] == 5000
+        assert sum(hist['buckets']) == 2
+
+    def test_format(self):
+        self.metrics.incr('tasks.ping')
+        self.metrics.observe('execute.ping', 0.002)
+        self.metrics.observe('pickle_in_bytes', 100)
+
+        text = format_metrics(self.metrics.snapshot())
+        assert 'tasks.ping' in text
+        assert 'execute.ping' in text and 'count=1' in text
+        assert 'max=2.000ms' in text
+        assert 'max=100' in text
@@ -16,12 +16,21 @@ import pytest
 
 import os
 import psutil
+import shutil
+import signal
 import socket
 import struct
+import sys
+import tempfile
 import threading
+import time
 
 from ibis.compat import unittest
-from ibis.server import IbisServerNode
+from ibis.server import (IbisServerNode, ServerConnection, ServerError,
+                         EventLoop, Wakeup, worker_unix_path, MSG_TASK,
+                         ACCEPT_BATCH)
+from ibis.tasks import IbisTaskMessage
+from ibis.wire import BytesIO, FrameReader, pack_frame
 
 
 # non-POSIX system (e.g. Windows)
@@ -108,12 +117,49 @@ class TestDaemon(unittest.TestCase, ImpalaServerFixture):
         self.assertEqual(len(exceptions), 1)
 
 
+def recv_all(sock):
+    chunks = []
+    while True:
+        chunk = sock.recv(4096)
+        if not chunk:
+            return ''.join(chunks)
+        chunks.append(chunk)
+
+
+def wait_until(predicate, timeout=10):
+    start = time.time()
+    while not predicate():
+        if time.time() - start > timeout:
+            raise AssertionError('Timed out')
+        time.sleep(0.01)
+
+
+def process_status(proc):
+    # A property in older psutil versions, a method in newer ones
+    status = proc.status
+    if callable(status):
+        status = status()
+    return status
+
+
+def process_is_dead(pid):
+    try:
+        # The daemon reaps its children on its own schedule
+        return process_status(psutil.Process(pid)) == psutil.STATUS_ZOMBIE
+    except psutil.NoSuchProcess:
+        return True
+
+
 class WorkerTestFixture(ImpalaServerFixture):
 
+    # Passed on to IbisServerNode
+    daemon_kwargs = {}
+
     def setUp(self):
         ImpalaServerFixture.setUp(self)
 
-        self.daemon = IbisServerNode(server_port=self.server_port)
+        self.daemon = IbisServerNode(server_port=self.server_port,
+                                     **self.daemon_kwargs)
 
         self.daemon_t = threading.Thread(target=self.daemon.run_daemon)
         self.daemon_t.start()
@@ -134,24 +180,24 @@ class WorkerTestFixture(ImpalaServerFixture):
         sock.connect(('localhost', port))
         return sock
 
-    def _spawn_worker(self):
-        sock = self._connect()
+    def _spawn_worker(self, conn=None):
+        if conn is None:
+            sock = self._connect()
 
-        # Ask to create a worker; reply OK on successful fork
-        sock.send('new')
-        reply = sock.recv(1024)
-        assert reply == 'ok'
-        sock.close()
+            # Ask to create a worker; reply OK on successful fork
+            sock.send('new')
+            reply = sock.recv(1024)
+            assert reply == 'ok'
+            sock.close()
+        else:
+            conn.new_worker()
 
         # Acknowledge the worker's existence
-        sock, _ = self.server_sock.accept()
-        msg = sock.recv(1024)
-        sock.send('ok')
-        sock.close()
+        msg = self._acknowledge_process()
 
         worker_port, worker_pid = struct.unpack('II', msg)
         proc = psutil.Process(worker_pid)
-        assert proc.status != ('running', 'sleeping')
+        assert process_status(proc) != ('running', 'sleeping')
         return worker_port, worker_pid
 
 
@@ -170,11 +216,27 @@ class TestWorkerManagement(WorkerTestFixture, unittest.TestCase):
         os.waitpid(worker_pid, 0)
 
         with pytest.raises(psutil.NoSuchProcess):
-            psutil.Process(worker_pid).status()
+            process_status(psutil.Process(worker_pid))
 
         # Check that the worker port is now closed
         assert port_is_closed(worker_port)
 
+    def test_exited_worker_reaped(self):
+        worker_port, worker_pid = self._spawn_worker()
+
+        sock = self._connect()
+        sock.send('kill %d' % worker_pid)
+        assert sock.recv(1024) == 'ok'
+
+        # Reaped on SIGCHLD, so it does not linger as a zombie
+        wait_until(lambda: not psutil.pid_exists(worker_pid))
+
+    def test_task_requires_prefork(self):
+        sock = self._connect()
+        sock.send('task' + IbisTaskMessage(0, 'foo', 0, 0).encode())
+        reply = sock.recv(1024)
+        assert reply != 'ok'
+
     def test_daemon_request_shutdown(self):
         worker_port, worker_pid = self._spawn_worker()
         worker_port2, worker_pid2 = self._spawn_worker()
@@ -191,7 +253,7 @@ class TestWorkerManagement(WorkerTestFixture, unittest.TestCase):
         os.waitpid(worker_pid, 0)
         os.waitpid(worker_pid2, 0)
         with pytest.raises(psutil.NoSuchProcess):
-            psutil.Process(worker_pid).status()
+            process_status(psutil.Process(worker_pid))
 
         # Check that the worker port is now closed
         assert port_is_closed(worker_port)
@@ -199,3 +261,205 @@ class TestWorkerManagement(WorkerTestFixture, unittest.TestCase):
 
         self.daemon_t.join()
         assert not self.daemon_t.isAlive()
+
+
+class TestWorkerPool(WorkerTestFixture, unittest.TestCase):
+
+    daemon_kwargs = dict(prefork=True, min_workers=2, max_workers=3)
+
+    def _idle_pids(self):
+        return set(pid for pid, worker in self.daemon.pool_workers.items()
+                   if worker.idle)
+
+    def _wait_for_idle_pool(self):
+        wait_until(lambda: len(self._idle_pids()) == 2)
+        return self._idle_pids()
+
+    def test_prefork_min_workers(self):
+        pids = self._wait_for_idle_pool()
+
+        for pid in pids:
+            assert not process_is_dead(pid)
+
+    def test_new_detaches_idle_worker(self):
+        pool_pids = self._wait_for_idle_pool()
+
+        worker_port, worker_pid = self._spawn_worker()
+        assert worker_pid in pool_pids
+        assert not port_is_closed(worker_port)
+
+        # The pool is topped back up with a fresh worker
+        pids = self._wait_for_idle_pool()
+        assert worker_pid not in pids
+
+    def test_shutdown_stops_pool(self):
+        pids = self._wait_for_idle_pool()
+
+        sock = self._connect()
+        sock.send('shutdown')
+        reply = sock.recv(1024)
+        assert reply == 'ok'
+        self.daemon_t.join()
+
+        for pid in pids:
+            wait_until(lambda: process_is_dead(pid))
+
+
+class TestFraming(unittest.TestCase):
+
+    def test_frames_split_anywhere(self):
+        frames = [(2, 1, 'foo'), (0, 7, ''), (1, 2 ** 32 - 1, 'x' * 5000)]
+        stream = ''.join(pack_frame(*frame) for frame in frames)
+
+        for chunk_size in [1, 3, 100, len(stream)]:
+            reader = FrameReader()
+            result = []
+            for i in range(0, len(stream), chunk_size):
+                result.extend(reader.feed(stream[i:i + chunk_size]))
+            assert result == frames
+
+
+class TestEventLoop(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = EventLoop()
+
+    def tearDown(self):
+        self.loop.close()
+
+    def test_poll_ready_objects(self):
+        a, b = socket.socketpair()
+        try:
+            self.loop.register(a)
+            assert self.loop.poll(0) == []
+
+            b.send('x')
+            assert self.loop.poll(1) == [a]
+
+            self.loop.unregister(a)
+            assert not self.loop.watching(a)
+            assert self.loop.poll(0) == []
+        finally:
+            a.close()
+            b.close()
+
+    def test_wakeup_from_other_thread(self):
+        wakeup = Wakeup()
+        try:
+            self.loop.register(wakeup)
+
+            t = threading.Timer(0.05, wakeup.wake)
+            t.start()
+            start = time.time()
+            assert self.loop.poll(10) == [wakeup]
+            assert time.time() - start < 5
+            t.join()
+
+            wakeup.drain()
+            assert self.loop.poll(0) == []
+        finally:
+            wakeup.close()
+
+
+class TestFramedDaemon(WorkerTestFixture, unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.unix_path = os.path.join(self.tmpdir, 'daemon.sock')
+        self.daemon_kwargs = dict(unix_path=self.unix_path)
+        WorkerTestFixture.setUp(self)
+
+    def tearDown(self):
+        WorkerTestFixture.tearDown(self)
+        shutil.rmtree(self.tmpdir)
+
+    def _framed(self, unix=False):
+        if unix:
+            return ServerConnection(self.unix_path)
+        return ServerConnection(('localhost', self.daemon.listen_port))
+
+    def test_spawn_and_kill_worker(self):
+        for unix in [False, True]:
+            conn = self._framed(unix)
+
+            # Several requests on one connection
+            worker_port, worker_pid = self._spawn_worker(conn)
+            assert os.path.exists(worker_unix_path(self.unix_path,
+                                                   worker_pid))
+            conn.kill_worker(worker_pid)
+            wait_until(lambda: port_is_closed(worker_port))
+            conn.close()
+
+    def test_pipelined_requests(self):
+        conn = self._framed()
+
+        # Unknown message type, bad task, bad task again
+        ids = [conn.send_request(99),
+               conn.send_request(MSG_TASK, 'garbage'),
+               conn.send_request(MSG_TASK, 'x' * 5000)]
+
+        # Replies can be collected in any order
+        for request_id in reversed(ids):
+            self.assertRaises(ServerError, conn.wait_reply, request_id)
+
+    def test_connection_burst(self):
+        # More connections than one accept batch, all opened up front
+        conns = [self._framed(unix=i % 2 == 0)
+                 for i in range(ACCEPT_BATCH * 2)]
+        try:
+            ids = [conn.send_request(99) for conn in conns]
+            for conn, request_id in zip(conns, ids):
+                self.assertRaises(ServerError, conn.wait_reply, request_id)
+        finally:
+            for conn in conns:
+                conn.close()
+
+    def test_cancel_unknown_task(self):
+        conn = self._framed()
+        task_msg = IbisTaskMessage(0, 'foo', 0, 0)
+        self.assertRaises(ServerError, conn.cancel_task, task_msg)
+
+    def test_stats(self):
+        conn = self._framed()
+        worker_port, worker_pid = self._spawn_worker(conn)
+
+        stats = conn.stats()
+        assert stats['pid'] == os.getpid()
+        assert stats['counters']['forks.worker'] >= 1
+
+        # Workers answer for themselves
+        worker_conn = ServerConnection(('localhost', worker_port))
+        assert worker_conn.stats()['pid'] == worker_pid
+        worker_conn.close()
+
+        conn.kill_worker(worker_pid)
+        wait_until(lambda: port_is_closed(worker_port))
+
+        # And as a one-shot request
+        sock = self._connect()
+        sock.send('stats')
+        assert 'forks.worker' in recv_all(sock)
+        sock.close()
+
+        # Text dump on SIGUSR2
+        stderr, sys.stderr = sys.stderr, BytesIO()
+        try:
+            os.kill(os.getpid(), signal.SIGUSR2)
+            wait_until(lambda: 'forks.worker' in sys.stderr.getvalue())
+            dump = sys.stderr.getvalue()
+        finally:
+            sys.stderr = stderr
+        assert 'ibis metrics (pid %d' % os.getpid() in dump
+        assert 'forks.worker' in dump
+
+    def test_legacy_requests_still_work(self):
+        # One-shot requests and a persistent connection at the same time
+        conn = self._framed()
+        worker_port, worker_pid = self._spawn_worker()
+        conn.kill_worker(worker_pid)
+        wait_until(lambda: port_is_closed(worker_port))
+
+    def test_shutdown_removes_unix_socket(self):
+        self._framed(unix=True).shutdown()
+        self.daemon_t.join()
+        assert not os.path.exists(self.unix_path)
@@ -14,24 +14,42 @@
 
 import os
 import pytest
+import shutil
+import struct
+import tempfile
+import threading
+import time
 
+import numpy as np
 import pandas as pd
 
 from cPickle import loads as pickle_load
 from ibis.cloudpickle import dumps as pickle_dump
 
-from test_comms import double_ex
-
-from ibis.tasks import IbisTaskMessage, IbisTaskExecutor
+from test_comms import bool_ex, double_ex
+
+import ibis.tasks as tasks
+from ibis.tasks import (IbisTaskMessage, IbisTaskExecutor, Task,
+                        AggregationStateTable, get_agg_states,
+                        ClassCache, get_class_cache, get_segment_pool,
+                        get_watchdog, read_response, register_task,
+                        class_digest, write_class_ref, merge_states,
+                        tree_merge, dump_state, load_state, STATE_MAGIC,
+                        AGG_STATE_HANDLE, AGG_STATE_PICKLED,
+                        TASK_CLASS_MISSING)
+from ibis.metrics import get_metrics
 from ibis.util import guid
+import ibis.sql.udf as udf
 from ibis.wire import BytesIO
 import ibis.wire as wire
 
 from ibis.compat import unittest
-from ibis.tests.test_server import WorkerTestFixture
+from ibis.server import ServerConnection, ServerError, MSG_TASK
+from ibis.tests.test_server import WorkerTestFixture, wait_until
 
 try:
-    from ibis.comms import SharedMmap, IPCLock, IbisTableWriter
+    from ibis.comms import (SharedMmap, IPCLock, IbisTableReader,
+                            IbisTableWriter)
     SKIP_TESTS = False
 except ImportError:
     SKIP_TESTS = True
@@ -55,6 +73,49 @@ class TestTasks(unittest.TestCase):
         attrs = ['semaphore_id', 'shmem_name', 'shmem_offset', 'shmem_size']
         for attr in attrs:
             self.assertEqual(getattr(task, attr), getattr(decoded, attr))
+        assert decoded.timeout is None
+
+    def test_message_timeout(self):
+        task = IbisTaskMessage(12345, 'foo', 12, 1000, timeout=2.5)
+        decoded = IbisTaskMessage.decode(task.encode())
+        assert decoded.timeout == 2.5
+        assert decoded.same_task(task)
+
+    def test_message_stream_flag(self):
+        for timeout in [None, 2.5]:
+            task = IbisTaskMessage(12345, 'foo', 12, 1000, timeout=timeout,
+                                   stream=True)
+            decoded = IbisTaskMessage.decode(task.encode())
+            assert decoded.stream
+            assert decoded.timeout == timeout
+
+        assert not IbisTaskMessage.decode(task.encode()[:-4]).stream
+
+    def test_message_wire_format(self):
+        # Unchanged from the field-by-field encoding
+        task = IbisTaskMessage(12345, 'foo', 12, 1000, timeout=2.5)
+        writer = wire.PackedMessageWriter()
+        writer.uint32(12345)
+        writer.string('foo')
+        writer.uint64(12).uint64(1000).uint32(2500)
+        assert task.encode() == writer.get_result()
+
+    def test_message_encode_into(self):
+        task = IbisTaskMessage(12345, 'foo', 12, 1000, timeout=2.5)
+        buf = bytearray(64)
+        end = task.encode_into(buf, 8)
+        assert bytes(buf[8:end]) == task.encode()
+
+        decoded = IbisTaskMessage.decode(memoryview(buf)[8:end])
+        assert decoded.same_task(task)
+        assert decoded.timeout == 2.5
+
+        self.assertRaises(struct.error, task.encode_into, bytearray(10))
+
+    def test_message_truncated(self):
+        encoded = IbisTaskMessage(12345, 'foo', 12, 1000).encode()
+        self.assertRaises(struct.error, IbisTaskMessage.decode,
+                          encoded[:9])
 
 
 class TestPingPongTask(unittest.TestCase):
@@ -88,6 +149,51 @@ class TestPingPongTask(unittest.TestCase):
         assert reader.uint8()
         assert reader.string() == 'pong'
 
+    def test_shared_memory_reused(self):
+        pool = get_segment_pool()
+        hits = pool.hits
+
+        _execute_task(self.task, self.lock)
+
+        self.mm.seek(0)
+        wire.PackedMessageWriter(self.mm).string('ping')
+        self.lock.release()
+        _execute_task(self.task, self.lock)
+
+        assert pool.hits == hits + 1
+
+    def test_metrics_recorded(self):
+        before = get_metrics().snapshot()
+        _execute_task(self.task, self.lock)
+        after = get_metrics().snapshot()
+
+        def count(snap, name):
+            return snap['counters'].get(name, 0)
+
+        def observations(snap, name):
+            return snap['histograms'].get(name, {'count': 0})['count']
+
+        assert count(after, 'tasks.ping') == count(before, 'tasks.ping') + 1
+        assert count(after, 'shmem_out_bytes') > count(before,
+                                                       'shmem_out_bytes')
+        for name in ['decode.ping', 'execute.ping', 'encode.ping',
+                     'lock_wait']:
+            assert observations(after, name) == observations(before,
+                                                             name) + 1
+
+
+def _execute_streamed(task, master_lock, mm):
+    # The task waits for the parts of a streamed response to be drained, so
+    # it has to run in another thread
+    executor = IbisTaskExecutor(task)
+    thread = threading.Thread(target=executor.execute)
+    thread.start()
+
+    master_lock.acquire()
+    response = read_response(mm, master_lock)
+    thread.join()
+    return response
+
 
 def _execute_task(task, master_lock):
     executor = IbisTaskExecutor(task)
@@ -150,12 +256,403 @@ class TestTaskE2E(TestPingPongTask, WorkerTestFixture):
         return msg
 
 
+class TestFramedTaskE2E(TestPingPongTask, WorkerTestFixture):
+
+    def setUp(self):
+        TestPingPongTask.setUp(self)
+        WorkerTestFixture.setUp(self)
+
+        worker_port, _ = self._spawn_worker()
+        self.conn = ServerConnection(('localhost', worker_port))
+
+    def tearDown(self):
+        self.conn.close()
+        TestPingPongTask.tearDown(self)
+        WorkerTestFixture.tearDown(self)
+
+    def _check_pong(self, mm):
+        mm.seek(0)
+        reader = wire.PackedMessageReader(mm)
+        assert reader.uint8()
+        assert reader.string() == 'pong'
+
+    def test_pipelined_tasks(self):
+        # Several tasks in flight on one connection, each with its own lock
+        # and shared memory
+        tasks = [(self.task, self.lock, self.mm)]
+        for i in range(2):
+            path = 'task_%s' % guid()
+            self.paths_to_delete.append(path)
+            lock = IPCLock(is_slave=0)
+            mm = SharedMmap(path, 36, create=True)
+            wire.PackedMessageWriter(mm).string('ping')
+            tasks.append((IbisTaskMessage(lock.semaphore_id, path, 0, 36),
+                          lock, mm))
+
+        ids = [self.conn.send_request(MSG_TASK, task.encode())
+               for task, _, _ in tasks]
+        for request_id in ids:
+            assert self.conn.wait_reply(request_id) == ''
+
+        for _, lock, mm in tasks:
+            wait_until(lambda: lock.acquire(block=False))
+            self._check_pong(mm)
+
+    def test_long_task_message(self):
+        # More than the 1024 bytes a one-shot request can carry
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, *['d' * 200] * 6)
+            os.makedirs(os.path.dirname(path))
+            assert len(path) > 1024
+
+            mm = SharedMmap(path, 36, create=True)
+            wire.PackedMessageWriter(mm).string('ping')
+            task = IbisTaskMessage(self.lock.semaphore_id, path, 0, 36)
+
+            assert self.conn.submit_task(task) == ''
+            wait_until(lambda: self.lock.acquire(block=False))
+            self._check_pong(mm)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_bad_task(self):
+        self.assertRaises(ServerError, self.conn.request, MSG_TASK,
+                          'garbage')
+
+
+class CrashTask(Task):
+
+    def run(self):
+        os._exit(1)
+
+
+class SpinTask(Task):
+
+    def run(self):
+        while True:
+            pass
+
+
+class SleepTask(Task):
+
+    def run(self):
+        # Can't be interrupted
+        time.sleep(60)
+
+
+register_task('__crash__', CrashTask)
+register_task('__spin__', SpinTask)
+register_task('__sleep__', SleepTask)
+
+
+class TestTaskDeadlines(TestPingPongTask):
+
+    def _write_request(self, task_type):
+        self.mm.seek(0)
+        wire.PackedMessageWriter(self.mm).string(task_type)
+
+    def _read_result(self):
+        self.mm.seek(0)
+        reader = wire.PackedMessageReader(self.mm)
+        return reader.uint8(), reader.string()
+
+    def test_deadline_interrupts_task(self):
+        self._write_request('__spin__')
+        self.task.timeout = 0.2
+
+        _execute_task(self.task, self.lock)
+        success, message = self._read_result()
+        assert not success
+        assert 'deadline' in message
+
+    def test_deadline_waiting_for_control(self):
+        # Take the worker's turn, so it never gets control
+        IPCLock(self.lock.semaphore_id).acquire(block=False)
+        self.task.timeout = 0.2
+
+        start = time.time()
+        IbisTaskExecutor(self.task).execute()
+        assert time.time() - start < 5
+
+        # Memory left alone
+        self.mm.seek(0)
+        assert wire.PackedMessageReader(self.mm).string() == 'ping'
+
+    def test_cancel(self):
+        self._write_request('__spin__')
+
+        t = threading.Timer(0.2, get_watchdog().cancel)
+        t.start()
+        _execute_task(self.task, self.lock)
+        t.join()
+
+        success, message = self._read_result()
+        assert not success
+        assert 'cancelled' in message
+
+
+
+class TestPoolTaskE2E(TestPingPongTask, WorkerTestFixture):
+
+    daemon_kwargs = dict(prefork=True, min_workers=1, max_workers=2,
+                         max_worker_tasks=1)
+
+    def setUp(self):
+        # Before the pool workers fork
+        self._kill_grace = tasks.TASK_KILL_GRACE
+        tasks.TASK_KILL_GRACE = 0.2
+
+        # The daemon runs in this process; count its tasks only
+        get_metrics().clear()
+
+        TestPingPongTask.setUp(self)
+        WorkerTestFixture.setUp(self)
+
+    def tearDown(self):
+        TestPingPongTask.tearDown(self)
+        WorkerTestFixture.tearDown(self)
+        tasks.TASK_KILL_GRACE = self._kill_grace
+
+    def _idle_pids(self):
+        return [pid for pid, w in self.daemon.pool_workers.items()
+                if w.idle]
+
+    def _dispatch(self, task):
+        sock = self._connect()
+        sock.send('task' + task.encode())
+        msg = sock.recv(1024)
+        sock.close()
+
+        if msg == 'ok':
+            # Fail rather than hang if control never comes back
+            wait_until(lambda: self.lock.acquire(block=False))
+        return msg
+
+    def _read_result(self):
+        self.mm.seek(0)
+        reader = wire.PackedMessageReader(self.mm)
+        return reader.uint8(), reader.string()
+
+    def _write_request(self, task_type):
+        self.mm.seek(0)
+        wire.PackedMessageWriter(self.mm).string(task_type)
+
+    def test_dispatch_to_pool(self):
+        assert self._dispatch(self.task) == 'ok'
+        assert self._read_result() == (1, 'pong')
+
+    def test_worker_recycled(self):
+        pids = set()
+        for i in range(3):
+            wait_until(lambda: len(self._idle_pids()) == 1)
+            pids.update(self._idle_pids())
+
+            if i > 0:
+                self._write_request('ping')
+                self.lock.release()
+
+            assert self._dispatch(self.task) == 'ok'
+            assert self._read_result() == (1, 'pong')
+
+        # max_worker_tasks=1 retires each worker after a single task
+        assert len(pids) == 3
+
+    def test_worker_died(self):
+        self._write_request('__crash__')
+        assert self._dispatch(self.task) == 'ok'
+
+        success, message = self._read_result()
+        assert not success
+        assert 'died' in message
+
+        # And the pool recovers
+        self._write_request('ping')
+        self.lock.release()
+        assert self._dispatch(self.task) == 'ok'
+        assert self._read_result() == (1, 'pong')
+
+    def test_stats(self):
+        assert self._dispatch(self.task) == 'ok'
+        assert self._read_result() == (1, 'pong')
+
+        # Workers report their metrics as they retire
+        conn = ServerConnection(('localhost', self.daemon.listen_port))
+        wait_until(lambda: 'tasks.ping' in conn.stats()['counters'])
+        stats = conn.stats()
+        conn.close()
+
+        counters = stats['counters']
+        assert counters['tasks.ping'] == 1
+        assert counters['tasks_dispatched'] == 1
+        assert counters['pool.retire'] == 1
+        assert counters['forks.pool'] >= 2
+
+        hists = stats['histograms']
+        for name in ['execute.ping', 'queue_wait', 'pool.worker_startup']:
+            assert hists[name]['count'] >= 1
+
+        assert 0 <= stats['gauges']['pool.utilization'] <= 1
+        assert stats['gauges']['queue_depth'] == 0
+
+    def test_stuck_task_killed(self):
+        self._write_request('__sleep__')
+        self.task.timeout = 0.2
+        assert self._dispatch(self.task) == 'ok'
+
+        success, message = self._read_result()
+        assert not success
+        assert 'deadline' in message
+
+        # Failed once only, and the pool recovers
+        self.task.timeout = None
+        self._write_request('ping')
+        self.lock.release()
+        assert self._dispatch(self.task) == 'ok'
+        assert self._read_result() == (1, 'pong')
+
+    def test_cancel_running_task(self):
+        self._write_request('__spin__')
+
+        sock = self._connect()
+        sock.send('task' + self.task.encode())
+        assert sock.recv(1024) == 'ok'
+        sock.close()
+
+        def cancelled():
+            # Best effort until the worker has started the task
+            sock = self._connect()
+            sock.send('cancel' + self.task.encode())
+            sock.recv(1024)
+            sock.close()
+            return self.lock.acquire(block=False)
+
+        wait_until(cancelled)
+        success, message = self._read_result()
+        assert not success
+        assert 'cancelled' in message
+
+    def test_cancel_unknown_task(self):
+        sock = self._connect()
+        sock.send('cancel' + self.task.encode())
+        assert sock.recv(1024) != 'ok'
+
+    def test_bad_task_message(self):
+        sock = self._connect()
+        sock.send('task' + 'garbage')
+        msg = sock.recv(1024)
+        assert 'Traceback' in msg
+
+
+class TestScalarUDFTask(unittest.TestCase):
+
+    def setUp(self):
+        self.paths_to_delete = []
+        self.lock = IPCLock(is_slave=0)
+
+    def tearDown(self):
+        get_class_cache().clear()
+
+        for path in self.paths_to_delete:
+            try:
+                os.remove(path)
+            except os.error:
+                pass
+
+    def _run_udf(self, func, output, cols, input_type='double',
+                 stream=False):
+        info = udf.PythonUDFInfo(func, [input_type] * len(cols), output)
+        header = info.task_header()
+        writer = IbisTableWriter(cols)
+
+        path = 'task_%s' % guid()
+        size = len(header) + writer.total_size()
+        mm = SharedMmap(path, size, create=True)
+        self.paths_to_delete.append(path)
+
+        mm.write(header)
+        writer.write(mm)
+
+        task = IbisTaskMessage(self.lock.semaphore_id, path, 0, size,
+                               stream=stream)
+        if stream:
+            response = _execute_streamed(task, self.lock, mm)
+        else:
+            _execute_task(task, self.lock)
+            response = mm
+        self.lock.release()
+
+        response.seek(0)
+        reader = wire.PackedMessageReader(response)
+        if not reader.uint8():
+            raise Exception(reader.string())
+
+        table = IbisTableReader(response)
+        assert table.ncolumns == 1
+        return table.get_column(0).to_numpy_for_pandas()
+
+    def test_batch_udf(self):
+        def add(x, y):
+            # Whole columns at once
+            assert len(x) == 1000
+            return x + y
+
+        cols = [double_ex(1000), double_ex(1000)]
+        result = self._run_udf(add, 'double', cols)
+
+        x, y = [col.to_numpy_for_pandas() for col in cols]
+        assert np.allclose(result, x + y, equal_nan=True)
+        assert np.isnan(result).any()
+
+    def test_integer_output_with_nulls(self):
+        def bucket(x):
+            return np.where(x > 0, 1, None)
+
+        col = double_ex(100)
+        result = self._run_udf(bucket, 'int64', [col])
+
+        x = col.to_numpy_for_pandas()
+        assert (pd.isnull(result) == ~(x > 0)).all()
+        assert (result[x > 0] == 1).all()
+
+    def test_wrong_length(self):
+        self.assertRaises(Exception, self._run_udf, lambda x: x[:10],
+                          'double', [double_ex(100)])
+
+    def test_output_larger_than_segment(self):
+        def to_double(x):
+            return x.astype(np.float64)
+
+        col = bool_ex(10000)
+        with pytest.raises(Exception) as exc:
+            self._run_udf(to_double, 'double', [col], input_type='boolean')
+        assert 'does not fit' in str(exc.value)
+
+        result = self._run_udf(to_double, 'double', [col],
+                               input_type='boolean', stream=True)
+        x = col.to_numpy_for_pandas()
+        assert (pd.isnull(result) == pd.isnull(x)).all()
+        assert (result[pd.notnull(x)] == x[pd.notnull(x)]).all()
+
+
 def delete_all_guid_files():
     import glob
     import os
     [os.remove(x) for x in glob.glob('*') if len(x) == 32]
 
 
+class BigResult(object):
+
+    def finalize(self):
+        return np.arange(100000)
+
+
+class FailsLoudly(object):
+
+    def finalize(self):
+        raise ValueError('x' * 1000)
+
+
 class NRows(object):
 
     def __init__(self):
@@ -189,6 +686,46 @@ class Summ(object):
         return self.total
 
 
+class MergesMany(Summ):
+
+    def __init__(self):
+        Summ.__init__(self)
+        self.merged_many = 0
+
+    def merge_many(self, others):
+        self.total += np.sum([other.total for other in others])
+        self.merged_many += len(others)
+        return self
+
+
+class Hist(object):
+
+    # Serialized without pickling
+    state_fields = ('counts', 'nulls')
+
+    def __init__(self):
+        self.counts = np.zeros(10, dtype=np.int64)
+        self.nulls = 0
+
+    def update(self, values):
+        values = pd.Series(values)
+        bins = np.clip(values.dropna().values, -5, 4.99) + 5
+        self.counts += np.bincount(bins.astype(int), minlength=10)
+        self.nulls += int(values.isnull().sum())
+
+    def merge(self, other):
+        self.counts += other.counts
+        self.nulls += other.nulls
+        return self
+
+    def finalize(self):
+        return self.counts
+
+
+def _count(col):
+    return pd.Series(col.to_numpy_for_pandas()).count()
+
+
 class TestAggregateTasks(unittest.TestCase):
 
     def _get_mean_uda(self):
@@ -291,6 +828,117 @@ class TestAggregateTasks(unittest.TestCase):
         ex_total = (pd.Series(larr).sum() + pd.Series(rarr).sum())
         assert result.total == ex_total
 
+    def test_merge_many(self):
+        klass = self._get_mean_uda()
+        cols = self.col_fragments
+
+        states = [self._update(klass, [col]) for col in cols]
+        task, mm = self._make_merge_many_task(states)
+        result = pickle_load(self._run(task, mm))
+
+        assert result.count == sum(_count(col) for col in cols)
+
+    def test_merge_many_hook(self):
+        states = []
+        for i in range(5):
+            state = MergesMany()
+            state.total = i
+            states.append(pickle_dump(state))
+
+        task, mm = self._make_merge_many_task(states)
+        result = pickle_load(self._run(task, mm))
+
+        assert result.total == 10
+        assert result.merged_many == 4
+
+    def test_merge_states_tree(self):
+        merges = []
+
+        class Depth(object):
+
+            def __init__(self):
+                self.depth = 0
+
+            def merge(self, other):
+                merges.append((self.depth, other.depth))
+                self.depth = max(self.depth, other.depth) + 1
+                return self
+
+        result = merge_states([Depth() for i in range(5)])
+        assert len(merges) == 4
+        assert result.depth == 3
+
+        self.assertRaises(ValueError, merge_states, [])
+
+    def test_tree_merge(self):
+        # One state per fragment
+        states = []
+        for i in range(500):
+            state = NRows()
+            state.total = i
+            states.append(pickle_dump(state))
+
+        levels = []
+
+        def merge_batch(batch):
+            task, mm = self._make_merge_many_task(batch)
+            return self._run(task, mm)
+
+        def level_map(f, batches):
+            levels.append(len(batches))
+            return [f(batch) for batch in batches]
+
+        result = tree_merge(states, merge_batch, fanout=16, map=level_map)
+        assert pickle_load(result).finalize() == sum(range(500))
+
+        # Logarithmic depth: 500 -> 32 -> 2 -> 1
+        assert levels == [32, 2, 1]
+
+    def test_tree_merge_leftover(self):
+        def merge_batch(batch):
+            return ''.join(batch)
+
+        assert tree_merge(list('abcde'), merge_batch, fanout=2) == 'abcde'
+        assert tree_merge(['a'], merge_batch) == 'a'
+
+    def test_native_state(self):
+        state = Hist()
+        state.counts[:] = np.arange(10)
+        state.nulls = 3
+
+        data = dump_state(state)
+        assert data.startswith(STATE_MAGIC)
+
+        result = load_state(memoryview(data))
+        assert type(result) is Hist
+        assert (result.counts == state.counts).all()
+        assert result.counts.dtype == np.int64
+        assert result.nulls == 3 and isinstance(result.nulls, int)
+
+        # Views on a copy of their own, to be merged into
+        result.counts += 1
+        assert data == dump_state(state)
+
+    def test_native_state_fallback(self):
+        state = Hist()
+        state.counts = np.array(['a', None], dtype=object)
+
+        data = dump_state(state)
+        assert not data.startswith(STATE_MAGIC)
+        assert list(load_state(data).counts) == ['a', None]
+
+    def test_native_state_tasks(self):
+        cols = self.col_fragments[:2]
+        left = self._update(Hist, [cols[0]])
+        right = self._update(Hist, [cols[1]])
+        assert left.startswith(STATE_MAGIC)
+
+        task, mm = self._make_merge_task(left, right)
+        result = load_state(self._run(task, mm))
+
+        assert result.counts.sum() == _count(cols[0]) + _count(cols[1])
+        assert result.nulls == 2000 - result.counts.sum()
+
     def test_finalize(self):
         klass = self._get_mean_uda()
 
@@ -313,6 +961,181 @@ class TestAggregateTasks(unittest.TestCase):
         ex_result = pd.Series(arr).mean()
         assert result == ex_result
 
+    def test_resident_state(self):
+        klass = self._get_mean_uda()
+        cols = self.col_fragments[:4]
+
+        # Two fragments into one handle, one into another
+        for handle, col in [('q1:0', cols[0]), ('q1:0', cols[1]),
+                            ('q1:1', cols[2])]:
+            task, mm = self._make_update_task(klass, [col], handle=handle)
+            assert self._run(task, mm) == handle
+
+        states = get_agg_states()
+        assert states.get('q1:0').count == (_count(cols[0]) +
+                                            _count(cols[1]))
+
+        # Merge resident q1:1 into q1:0, then a state from another host
+        task, mm = self._make_resident_task('agg-merge-resident', 'q1:0',
+                                            AGG_STATE_HANDLE, 'q1:1')
+        assert self._run(task, mm) == 'q1:0'
+        assert 'q1:1' not in states
+
+        remote = self._update(klass, [cols[3]])
+        task, mm = self._make_resident_task('agg-merge-resident', 'q1:0',
+                                            AGG_STATE_PICKLED, remote)
+        assert self._run(task, mm) == 'q1:0'
+
+        task, mm = self._make_resident_task('agg-finalize-resident', 'q1:0')
+        result = pickle_load(self._run(task, mm))
+        assert 'q1:0' not in states
+
+        arrays = [col.to_numpy_for_pandas() for col in cols]
+        ex_result = pd.concat([pd.Series(arr) for arr in arrays]).mean()
+        assert abs(result - ex_result) < 1e-10
+
+    def test_resident_state_export(self):
+        klass = self._get_mean_uda()
+        col = self.col_fragments[0]
+
+        task, mm = self._make_update_task(klass, [col], handle='q2')
+        self._run(task, mm)
+
+        for release in [0, 1]:
+            task, mm = self._make_resident_task('agg-export-resident', 'q2',
+                                                release)
+            state = pickle_load(self._run(task, mm))
+            assert state.count == _count(col)
+            assert ('q2' in get_agg_states()) == (not release)
+
+    def test_resident_state_unknown_handle(self):
+        task, mm = self._make_resident_task('agg-finalize-resident',
+                                            'no-such-handle')
+        _execute_task(task, self.lock)
+
+        mm.seek(0)
+        reader = wire.PackedMessageReader(mm)
+        assert not reader.uint8()
+        assert 'no-such-handle' in reader.string()
+
+    def test_class_cache(self):
+        klass = self._get_mean_uda()
+        pickled = pickle_dump(klass)
+        digest = class_digest(pickled)
+        col = self.col_fragments[0]
+
+        # Not cached yet, and not sent: the worker asks for it
+        task, mm = self._make_update_task(klass, [col], include_class=False)
+        _execute_task(task, self.lock)
+        self.lock.release()
+
+        mm.seek(0)
+        reader = wire.PackedMessageReader(mm)
+        assert reader.uint8() == TASK_CLASS_MISSING
+        assert reader.string() == digest
+
+        # Resent with the class, which is then cached
+        task, mm = self._make_update_task(klass, [col])
+        first = pickle_load(self._run(task, mm))
+        assert digest in get_class_cache()
+
+        task, mm = self._make_update_task(klass, [col], include_class=False)
+        second = pickle_load(self._run(task, mm))
+        assert second.total == first.total
+
+    def test_class_cache_lru(self):
+        cache = ClassCache(max_entries=2)
+        pickles = [pickle_dump(k) for k in (NRows, Summ, dict)]
+        digests = [class_digest(p) for p in pickles]
+
+        cache.get(digests[0], pickles[0])
+        cache.get(digests[1], pickles[1])
+
+        # Touch the first, so the second is the one dropped
+        assert cache.get(digests[0]) is NRows
+        cache.get(digests[2], pickles[2])
+        assert digests[0] in cache
+        assert digests[1] not in cache
+        assert len(cache) == 2
+
+    def test_class_cache_bad_digest(self):
+        payload = BytesIO()
+        writer = wire.PackedMessageWriter(payload)
+        writer.string('agg-update')
+        writer.string(class_digest('something else'))
+        writer.string(pickle_dump(NRows))
+        writer.uint8(0)
+
+        path = 'task_%s' % guid()
+        mm = SharedMmap(path, 4096, create=True)
+        self.paths_to_delete.append(path)
+        mm.write(payload.getvalue())
+
+        task = IbisTaskMessage(self.lock.semaphore_id, path, 0, 4096)
+        _execute_task(task, self.lock)
+
+        mm.seek(0)
+        reader = wire.PackedMessageReader(mm)
+        assert not reader.uint8()
+        assert 'does not match digest' in reader.string()
+
+    def test_streamed_response(self):
+        # The pickled result is far larger than the shared memory
+        task, mm = self._make_finalize_task(pickle_dump(BigResult()),
+                                            size=4096)
+
+        # Without streaming, the task fails cleanly
+        _execute_task(task, self.lock)
+        self.lock.release()
+        mm.seek(0)
+        reader = wire.PackedMessageReader(mm)
+        assert not reader.uint8()
+        assert 'does not fit' in reader.string()
+
+        task, mm = self._make_finalize_task(pickle_dump(BigResult()),
+                                            size=4096)
+        task.stream = True
+        response = _execute_streamed(task, self.lock, mm)
+
+        reader = wire.PackedMessageReader(response)
+        assert reader.uint8()
+        assert (pickle_load(reader.string()) == np.arange(100000)).all()
+        assert reader.remaining() == 0
+
+    def test_streamed_traceback(self):
+        # Whole, rather than truncated
+        task, mm = self._make_finalize_task(pickle_dump(FailsLoudly()),
+                                            size=128)
+        task.stream = True
+        response = _execute_streamed(task, self.lock, mm)
+
+        reader = wire.PackedMessageReader(response)
+        assert not reader.uint8()
+        message = reader.string()
+        assert message.startswith('Traceback')
+        assert ('x' * 1000) in message
+
+    def test_state_table_ttl(self):
+        table = AggregationStateTable(ttl=600)
+        table.put('a', object())
+        assert table.evict() == 0
+        assert len(table) == 1
+
+        assert table.evict(ttl=-1) == 1
+        assert 'a' not in table
+        self.assertRaises(KeyError, table.get, 'a')
+
+    def _run(self, task, mm):
+        # Run a task and return its result string
+        _execute_task(task, self.lock)
+        self.lock.release()
+
+        mm.seek(0)
+        reader = wire.PackedMessageReader(mm)
+        if not reader.uint8():
+            raise Exception(reader.string())
+        return reader.string()
+
     def _update(self, klass, args):
         task, mm = self._make_update_task(klass, args)
         _execute_task(task, self.lock)
@@ -327,23 +1150,28 @@ class TestAggregateTasks(unittest.TestCase):
 
         return reader.string()
 
-    def _make_update_task(self, uda_class, cols, prior_state=None):
+    def _make_update_task(self, uda_class, cols, prior_state=None,
+                          handle=None, include_class=True):
 
         # Overall layout here:
         # - task name
-        # - serialized agg class
-        # - prior state flag 1/0
-        # - (optional) serialized prior state
+        # - agg class digest and serialized class (possibly empty)
+        # - state flag 0/1/2
+        # - (optional) serialized prior state or resident state handle
         # - serialized table fragment
 
         payload = BytesIO()
         msg_writer = wire.PackedMessageWriter(payload)
         msg_writer.string('agg-update')
-        msg_writer.string(pickle_dump(uda_class))
+        write_class_ref(msg_writer, pickle_dump(uda_class),
+                        include_pickle=include_class)
 
         if prior_state is not None:
-            msg_writer.uint8(1)
+            msg_writer.uint8(AGG_STATE_PICKLED)
             msg_writer.string(pickle_dump(prior_state))
+        elif handle is not None:
+            msg_writer.uint8(AGG_STATE_HANDLE)
+            msg_writer.string(handle)
         else:
             msg_writer.uint8(0)
 
@@ -383,7 +1211,49 @@ class TestAggregateTasks(unittest.TestCase):
 
         return task, mm
 
-    def _make_finalize_task(self, pickled):
+    def _make_merge_many_task(self, states):
+        payload = BytesIO()
+        msg_writer = wire.PackedMessageWriter(payload)
+        msg_writer.string('agg-merge-many')
+        msg_writer.uint32(len(states))
+        for state in states:
+            msg_writer.string(state)
+
+        path = 'task_%s' % guid()
+        size = payload.tell()
+        mm = SharedMmap(path, size, create=True)
+        self.paths_to_delete.append(path)
+
+        mm.write(payload.getvalue())
+
+        task = IbisTaskMessage(self.lock.semaphore_id, path, 0, size)
+
+        return task, mm
+
+    def _make_resident_task(self, task_type, handle, flag=None, value=None):
+        # Header: handle, then a uint8 flag and optionally a string
+        payload = BytesIO()
+        msg_writer = wire.PackedMessageWriter(payload)
+        msg_writer.string(task_type)
+        msg_writer.string(handle)
+        if flag is not None:
+            msg_writer.uint8(flag)
+        if value is not None:
+            msg_writer.string(value)
+
+        # Room for the response
+        path = 'task_%s' % guid()
+        size = max(payload.tell(), 65536)
+        mm = SharedMmap(path, size, create=True)
+        self.paths_to_delete.append(path)
+
+        mm.write(payload.getvalue())
+
+        task = IbisTaskMessage(self.lock.semaphore_id, path, 0, size)
+
+        return task, mm
+
+    def _make_finalize_task(self, pickled, size=None):
         payload = BytesIO()
         msg_writer = wire.PackedMessageWriter(payload)
         msg_writer.string('agg-finalize')
@@ -391,7 +1261,7 @@ class TestAggregateTasks(unittest.TestCase):
 
         # Create memory map of the appropriate size
         path = 'task_%s' % guid()
-        size = payload.tell()
+        size = max(size, payload.tell())
         offset = 0
         mm = SharedMmap(path, size, create=True)
         self.paths_to_delete.append(path)
@@ -403,6 +1273,9 @@ class TestAggregateTasks(unittest.TestCase):
         return task, mm
 
     def tearDown(self):
+        get_agg_states().clear()
+        get_class_cache().clear()
+
         for path in self.paths_to_delete:
             try:
                 os.remove(path)
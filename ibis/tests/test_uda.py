@@ -0,0 +1,129 @@
+# Copyright 2014 Cloudera Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import base64
+
+import numpy as np
+import pandas as pd
+
+from cPickle import loads as pickle_load
+
+from ibis.compat import unittest
+from ibis.uda import UDAEvaluator, uda_evaluate
+
+
+class Mean(object):
+
+    def __init__(self):
+        self.total = 0
+        self.count = 0
+        self.nupdates = 0
+
+    def update(self, values):
+        values = pd.Series(values)
+        self.total += values.sum()
+        self.count += values.count()
+        self.nupdates += 1
+
+    def merge(self, other):
+        self.total += other.total
+        self.count += other.count
+        return self
+
+    def finalize(self):
+        return self.total / float(self.count)
+
+
+class MockCursor(object):
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.executed = []
+        self.pos = 0
+
+    def execute(self, query):
+        self.executed.append(query)
+
+    def fetchmany(self, size):
+        rows = self.rows[self.pos:self.pos + size]
+        self.pos += size
+        return rows
+
+
+class TestUDAEvaluator(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(12345)
+        n = 1000
+        self.frame = pd.DataFrame({
+            'k1': rng.choice(['a', 'b', 'c', None], n),
+            'k2': rng.randint(0, 3, n),
+            'value': rng.randn(n)
+        }, columns=['k1', 'k2', 'value'])
+
+    def _rows(self, columns):
+        return list(self.frame[columns].itertuples(index=False))
+
+    def test_ungrouped(self):
+        cursor = MockCursor(self._rows(['value']))
+        result = uda_evaluate(cursor, Mean, 'my_view', 'value')
+
+        assert cursor.executed == ['SELECT value\nFROM my_view']
+        assert abs(result - self.frame['value'].mean()) < 1e-10
+
+    def test_class_encoded(self):
+        evaluator = UDAEvaluator(Mean, 'my_view', ['value'])
+        assert pickle_load(base64.b64decode(evaluator.uda_encoded)) is Mean
+
+    def test_grouped(self):
+        cursor = MockCursor(self._rows(['k1', 'k2', 'value']))
+        evaluator = UDAEvaluator(Mean, 'my_view', ['value'],
+                                 key_fields=['k1', 'k2'], batch_size=300)
+        result = evaluator.get_result(cursor)
+
+        # One update per group per batch, not per row
+        nbatches = 4
+        assert max(s.nupdates for s in evaluator.states.values()) <= nbatches
+
+        frame = self.frame.copy()
+        frame['k1'] = frame['k1'].fillna('NULL')
+        expected = frame.groupby(['k1', 'k2'])['value'].mean()
+
+        assert len(result) == len(expected)
+        for k1, k2, value in result.itertuples(index=False):
+            if k1 is None:
+                k1 = 'NULL'
+            assert abs(value - expected[k1, k2]) < 1e-10
+
+    def test_merge_evaluators(self):
+        frame = self.frame
+        halves = [frame[:500], frame[500:]]
+
+        evaluators = []
+        for half in halves:
+            evaluator = UDAEvaluator(Mean, 'my_view', 'value',
+                                     key_fields='k2')
+            evaluator.update(half)
+            evaluators.append(evaluator)
+
+        result = evaluators[0].merge(evaluators[1]).finalize()
+        expected = frame.groupby('k2')['value'].mean()
+        result = result.set_index('k2')['result']
+        assert np.allclose(result[expected.index], expected)
+
+    def test_no_rows(self):
+        evaluator = UDAEvaluator(Mean, 'my_view', 'value', key_fields='k1')
+        result = evaluator.get_result(MockCursor([]))
+        assert list(result.columns) == ['k1', 'result']
+        assert len(result) == 0
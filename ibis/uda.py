@@ -13,24 +13,195 @@
 # limitations under the License.
 
 from ibis.cloudpickle import dumps as pickle_dump
+from ibis.sql.exprs import quote_identifier
+import ibis.util as util
 
 import base64
 
+import numpy as np
+import pandas as pd
+
+
+# Rows fetched from the cursor at a time
+FETCH_BATCH_SIZE = 100000
+
 
 class UDAEvaluator(object):
 
-    def __init__(self, uda_class, view_name, uda_fields, key_fields=None):
+    """
+    Evaluate a Python UDA (a class with update, merge and finalize methods)
+    over the rows of a view, optionally grouped by key fields.
+
+    Rows are processed in batches. Each batch is partitioned by key with
+    NumPy, and update is called once per group in the batch with contiguous
+    slices of the UDA fields, rather than once per row. States of the same
+    group from different batches or evaluators are combined with merge, as
+    the agg-merge task does.
+
+    Parameters
+    ----------
+    uda_class : class
+    view_name : string
+    uda_fields : string or list of strings
+      Columns passed to update, in order
+    key_fields : string or list of strings, optional
+    batch_size : int, default FETCH_BATCH_SIZE
+    """
+
+    def __init__(self, uda_class, view_name, uda_fields, key_fields=None,
+                 batch_size=FETCH_BATCH_SIZE):
         self.uda_class = uda_class
 
-        self.uda_encoded = base64.b64_encode(pickle_dump(uda_class))
+        self.uda_encoded = base64.b64encode(pickle_dump(uda_class))
 
         self.view_name = view_name
-        self.uda_fields = uda_fields
+        self.uda_fields = util.promote_list(uda_fields)
+
+        if key_fields is None:
+            key_fields = []
+        self.key_fields = util.promote_list(key_fields)
+
+        self.batch_size = batch_size
+
+        # key tuple (empty when not grouping) -> UDA instance
+        self.states = {}
 
-        self.key_fields = key_fields
+    def get_query(self):
+        fields = self.key_fields + self.uda_fields
+        return 'SELECT {0}\nFROM {1}'.format(
+            ', '.join(quote_identifier(x) for x in fields), self.view_name)
 
     def get_result(self, cursor):
-        pass
+        """
+        Run the query and aggregate its rows
+
+        Returns
+        -------
+        result : finalized UDA value, or a DataFrame with the key fields and
+          a 'result' column if grouping
+        """
+        cursor.execute(self.get_query())
+
+        fields = self.key_fields + self.uda_fields
+        for rows in _fetch_batches(cursor, self.batch_size):
+            batch = pd.DataFrame.from_records(rows, columns=fields)
+            self.update(batch)
+
+        return self.finalize()
+
+    def update(self, batch):
+        """
+        Aggregate a batch of rows
+
+        Parameters
+        ----------
+        batch : DataFrame
+          Containing the key and UDA fields
+        """
+        if len(batch) == 0:
+            return
+
+        values = [batch[name].values for name in self.uda_fields]
+
+        if not self.key_fields:
+            self._state(()).update(*values)
+            return
+
+        keys, order, bounds = _partition(
+            [batch[name].values for name in self.key_fields])
+
+        # One gather per column, so that every group is a contiguous slice
+        values = [arr.take(order) for arr in values]
+        for key, start, end in zip(keys, bounds[:-1], bounds[1:]):
+            self._state(key).update(*[arr[start:end] for arr in values])
+
+    def merge(self, other):
+        """
+        Merge in the per-group states of another evaluator for the same UDA
+        (e.g. one that saw other fragments of the data)
+        """
+        for key, state in other.states.items():
+            if key in self.states:
+                self.states[key] = self.states[key].merge(state)
+            else:
+                self.states[key] = state
+        return self
+
+    def finalize(self):
+        if not self.key_fields:
+            return self._state(()).finalize()
+
+        keys = list(self.states.keys())
+        results = [self.states[key].finalize() for key in keys]
+
+        columns = list(zip(*keys)) if keys else [()] * len(self.key_fields)
+        frame = pd.DataFrame(dict(zip(self.key_fields, columns)),
+                             columns=self.key_fields)
+        frame['result'] = results
+        return frame
+
+    def _state(self, key):
+        try:
+            return self.states[key]
+        except KeyError:
+            state = self.states[key] = self.uda_class()
+            return state
+
+
+def _partition(key_arrays):
+    """
+    Group rows by the values of the key arrays. NULL keys form their own
+    group, as in SQL
+
+    Returns
+    -------
+    keys : list of key tuples, one per group
+    order : ndarray
+      Permutation of the rows putting each group's rows together
+    bounds : ndarray
+      Group i is order[bounds[i]:bounds[i + 1]]
+    """
+    group_ids = None
+    for arr in key_arrays:
+        labels, uniques = pd.factorize(arr)
+
+        # NULLs are labelled -1
+        labels[labels == -1] = len(uniques)
+
+        if group_ids is None:
+            group_ids = labels
+        else:
+            group_ids = group_ids * (len(uniques) + 1) + labels
+
+        # Keep the ids dense
+        group_ids = pd.factorize(group_ids)[0]
+
+    ngroups = group_ids.max() + 1
+    order = group_ids.argsort(kind='mergesort')
+    bounds = np.zeros(ngroups + 1, dtype=np.int64)
+    np.cumsum(np.bincount(group_ids, minlength=ngroups), out=bounds[1:])
+
+    # Key values from the first row of each group
+    first_rows = order[bounds[:-1]]
+    key_columns = [[_null_to_none(x) for x in arr.take(first_rows)]
+                   for arr in key_arrays]
+    return list(zip(*key_columns)), order, bounds
+
+
+def _null_to_none(value):
+    return None if pd.isnull(value) else value
+
+
+def _fetch_batches(cursor, batch_size):
+    if not hasattr(cursor, 'fetchmany'):
+        yield cursor.fetchall()
+        return
+
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            break
+        yield rows
 
 
 def uda_evaluate(cursor, uda_class, view_name, uda_fields, key_fields=None):
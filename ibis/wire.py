@@ -20,17 +20,164 @@ except ImportError:
     from io import BytesIO
 
 
-class PackedMessageReader(object):
+# Field formats, compiled once
+UINT8 = struct.Struct('b')
+UINT32 = struct.Struct('I')
+UINT64 = struct.Struct('Q')
+
+
+class BufferReader(object):
+
+    """
+    Reads packed fields at an advancing offset into anything supporting the
+    buffer protocol (bytes, bytearray, memoryview, SharedMmap), without
+    copying the buffer or allocating per field
+
+    Parameters
+    ----------
+    buf : buffer
+    offset : int, default 0
+    """
+
+    def __init__(self, buf, offset=0):
+        self.view = memoryview(buf)
+        self.pos = offset
+
+    def tell(self):
+        return self.pos
+
+    def remaining(self):
+        """
+        Bytes left to read
+        """
+        return len(self.view) - self.pos
+
+    def unpack(self, st):
+        """
+        Read several fields at once
+
+        Parameters
+        ----------
+        st : struct.Struct
+
+        Returns
+        -------
+        values : tuple
+        """
+        values = st.unpack_from(self.view, self.pos)
+        self.pos += st.size
+        return values
+
+    def uint8(self):
+        return self.unpack(UINT8)[0]
+
+    def uint32(self):
+        return self.unpack(UINT32)[0]
+
+    def uint64(self):
+        return self.unpack(UINT64)[0]
+
+    def string(self):
+        """
+        uint32_t prefixed, copied out as bytes
+        """
+        return self.string_view().tobytes()
+
+    def string_view(self):
+        """
+        uint32_t prefixed, as a memoryview on the buffer (no copy)
+        """
+        return self.read_view(self.uint32())
+
+    def read_view(self, nbytes):
+        """
+        The next nbytes bytes, as a memoryview on the buffer (no copy)
+        """
+        start = self.pos
+        if start + nbytes > len(self.view):
+            raise ValueError('Reading %d bytes would run past the end of the '
+                             'buffer' % nbytes)
+        self.pos += nbytes
+        return self.view[start:self.pos]
+
+
+class BufferWriter(object):
 
     """
+    Writes packed fields at an advancing offset into a writable buffer
+    (bytearray, writable memoryview, SharedMmap) in place
+
+    Parameters
+    ----------
+    buf : buffer
+    offset : int, default 0
+    """
+
+    def __init__(self, buf, offset=0):
+        self.view = memoryview(buf)
+        self.pos = offset
+
+    def tell(self):
+        return self.pos
+
+    def pack(self, st, *values):
+        """
+        Write several fields at once
+
+        Parameters
+        ----------
+        st : struct.Struct
+        values : field values
+        """
+        st.pack_into(self.view, self.pos, *values)
+        self.pos += st.size
+        return self
+
+    def uint8(self, val):
+        return self.pack(UINT8, val)
+
+    def uint32(self, val):
+        return self.pack(UINT32, val)
+
+    def uint64(self, val):
+        return self.pack(UINT64, val)
+
+    def string(self, val):
+        """
+        uint32_t prefixed
+        """
+        if self.pos + UINT32.size + len(val) > len(self.view):
+            raise ValueError('Buffer is too small for a string of length %d'
+                             % len(val))
+        self.uint32(len(val))
+        return self.write(val)
+
+    def write(self, data):
+        """
+        Copy in raw bytes
+        """
+        end = self.pos + len(data)
+        if end > len(self.view):
+            raise ValueError('Buffer is too small to write %d bytes'
+                             % len(data))
+        self.view[self.pos:end] = data
+        self.pos = end
+        return self
+
+
+class PackedMessageReader(object):
 
     """
+    Reads packed fields from bytes (see BufferReader) or from the current
+    position of a file-like object, e.g. a SharedMmap, which is left after
+    the fields read
+    """
 
     def __init__(self, msg):
         self.msg = msg
 
         if isinstance(msg, basestring):
-            self.buf = BytesIO(msg)
+            self.buf = BufferReader(msg)
         elif hasattr(msg, 'read'):
             self.buf = msg
         else:
@@ -40,19 +187,29 @@ class PackedMessageReader(object):
         """
         uint32_t prefixed
         """
+        if isinstance(self.buf, BufferReader):
+            return self.buf.string()
         return read_string(self.buf)
 
     def uint8(self):
-        return self._unpack('b', 1)
+        return self._unpack(UINT8)
 
     def uint32(self):
-        return self._unpack('I', 4)
+        return self._unpack(UINT32)
 
     def uint64(self):
-        return self._unpack('Q', 8)
+        return self._unpack(UINT64)
+
+    def remaining(self):
+        """
+        Bytes left to read
+        """
+        return len(self.msg) - self.buf.tell()
 
-    def _unpack(self, fmt, size):
-        return struct.unpack(fmt, self.buf.read(size))[0]
+    def _unpack(self, st):
+        if isinstance(self.buf, BufferReader):
+            return self.buf.unpack(st)[0]
+        return st.unpack(self.buf.read(st.size))[0]
 
 
 class PackedMessageWriter(object):
@@ -86,31 +243,76 @@ class PackedMessageWriter(object):
         return self
 
 
+# Framed messages, for persistent connections carrying any number of
+# (possibly pipelined) requests. A connection starts with FRAME_MAGIC, then
+# each frame is a header (uint32 payload length, uint8 message type, uint32
+# request id) followed by the payload
+FRAME_MAGIC = 'IBF1'
+FRAME_HEADER = struct.Struct('=IBI')
+
+
+def pack_frame(msg_type, request_id, payload=''):
+    return FRAME_HEADER.pack(len(payload), msg_type, request_id) + payload
+
+
+class FrameReader(object):
+
+    """
+    Splits a byte stream into (message type, request id, payload) frames,
+    however the bytes happen to arrive
+    """
+
+    def __init__(self):
+        self._buf = bytearray()
+
+    def feed(self, data):
+        """
+        Returns
+        -------
+        frames : list of (msg_type, request_id, payload) tuples
+          The frames completed by data, if any
+        """
+        self._buf.extend(data)
+
+        frames = []
+        pos = 0
+        while len(self._buf) - pos >= FRAME_HEADER.size:
+            length, msg_type, request_id = FRAME_HEADER.unpack_from(
+                self._buf, pos)
+
+            start = pos + FRAME_HEADER.size
+            if len(self._buf) < start + length:
+                break
+
+            frames.append((msg_type, request_id,
+                           bytes(self._buf[start:start + length])))
+            pos = start + length
+
+        del self._buf[:pos]
+        return frames
+
+
 def write_string(buf, val):
-    write_uint32(buf, len(val))
+    buf.write(UINT32.pack(len(val)))
     buf.write(val)
 
 
 def read_string(buf):
-    slen = _read(buf, 'I', 4)
+    slen = _read(buf, UINT32)
     return buf.read(slen)
 
 
 def write_uint8(buf, val):
-    _write(buf, 'b', val)
+    buf.write(UINT8.pack(val))
 
 
 def write_uint32(buf, val):
-    _write(buf, 'I', val)
+    buf.write(UINT32.pack(val))
 
 
 def write_uint64(buf, val):
-    _write(buf, 'Q', val)
-
-
-def _write(buf, fmt, val):
-    buf.write(struct.pack(fmt, val))
+    buf.write(UINT64.pack(val))
 
 
-def _read(buf, fmt, size):
-    return struct.unpack(fmt, buf.read(size))[0]
+def _read(buf, st):
+    return st.unpack(buf.read(st.size))[0]
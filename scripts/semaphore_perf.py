@@ -1,40 +1,131 @@
-from ibis.comms import IPCLock
-import threading
+#! /usr/bin/env python
+# Copyright 2015 Cloudera Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
 
-class Counter:
+# Measures the cost of handing control back and forth between two processes
+# with the comms IPC locks (SysV semaphores vs. the spin-then-futex shared
+# memory lock). Reports handoffs per second and round trip latency
+# percentiles.
 
-    def __init__(self):
-        self.total = 0
+from __future__ import print_function
 
-    def inc(self):
-        self.total += 1
+import argparse
+import os
+import tempfile
+import time
 
-def run_test():
-    counter = Counter()
-    ceiling = 1000
+import numpy as np
 
+from ibis.comms import (IPCLock, SharedMemoryLock, SharedMmap,
+                        DEFAULT_SPIN_COUNT, HAVE_SHARED_MEMORY_LOCK)
+
+
+def _ping_pong(master, make_slave, iterations):
+    # The child process answers each of our handoffs; we time the round trip
+    # (two handoffs) on our side
+    pid = os.fork()
+    if pid == 0:
+        slave = make_slave()
+        for i in range(iterations + 1):
+            slave.acquire()
+            slave.release()
+
+        # Don't exit until the parent has taken our last handoff; SEM_UNDO
+        # would otherwise revert it
+        slave.acquire()
+        os._exit(0)
+
+    timings = np.empty(iterations, dtype=np.float64)
+
+    # Wait for the child to be ready
+    master.acquire()
+
+    for i in range(iterations):
+        start = time.time()
+        master.release()
+        master.acquire()
+        timings[i] = time.time() - start
+
+    master.release()
+    os.waitpid(pid, 0)
+    return timings
+
+
+def bench_semaphores(iterations):
     master = IPCLock(is_slave=0)
-    slave = IPCLock(master.semaphore_id)
-
-    def ping():
-        while True:
-            with slave:
-                counter.inc()
-                if counter.total > ceiling:
-                    break
-
-    def pong():
-        while True:
-            with master:
-                counter.inc()
-                if counter.total > ceiling:
-                    break
-
-    t1 = threading.Thread(target=pong)
-    t1.start()
-
-    t2 = threading.Thread(target=ping)
-    t2.start()
-
-    t1.join()
-    t2.join()
+    slave_id = master.semaphore_id
+    return _ping_pong(master, lambda: IPCLock(slave_id), iterations)
+
+
+def bench_shared_memory(iterations, spin_count):
+    path = tempfile.mktemp(prefix='ibis-semaphore-perf-')
+    try:
+        mm = SharedMmap(path, 64, create=True)
+        master = SharedMemoryLock(mm, is_slave=0, spin_count=spin_count)
+
+        def make_slave():
+            return SharedMemoryLock(SharedMmap(path, 64),
+                                    spin_count=spin_count)
+
+        return _ping_pong(master, make_slave, iterations)
+    finally:
+        os.remove(path)
+
+
+def report(name, timings):
+    total = timings.sum()
+    micros = timings * 1e6
+    p50, p90, p99, p999 = np.percentile(micros, [50, 90, 99, 99.9])
+    print('%-30s %12.0f %9.1f %9.1f %9.1f %9.1f %9.1f'
+          % (name, 2 * len(timings) / total, p50, p90, p99, p999,
+             micros.max()))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    # IPCLock uses SEM_UNDO, whose per-process adjustment counters overflow
+    # (ERANGE) after 32767 unmatched operations
+    parser.add_argument('-n', '--iterations', type=int, default=20000,
+                        help='Number of round trips to time')
+    parser.add_argument('--spin-count', type=int, default=None,
+                        help='SharedMemoryLock spin iterations before '
+                        'sleeping (default depends on the CPU count)')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+
+    print('%d round trips, latencies in microseconds' % args.iterations)
+    print('%-30s %12s %9s %9s %9s %9s %9s'
+          % ('lock', 'handoffs/s', 'p50', 'p90', 'p99', 'p99.9', 'max'))
+
+    report('IPCLock', bench_semaphores(args.iterations))
+
+    if HAVE_SHARED_MEMORY_LOCK:
+        spin_count = args.spin_count
+        if spin_count is None:
+            spin_count = DEFAULT_SPIN_COUNT
+
+        report('SharedMemoryLock (spin %d)' % spin_count,
+               bench_shared_memory(args.iterations, spin_count))
+        if spin_count != 0:
+            report('SharedMemoryLock (spin 0)',
+                   bench_shared_memory(args.iterations, 0))
+    else:
+        print('SharedMemoryLock not supported on this platform')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,418 @@
+#! /usr/bin/env python
+# Copyright 2015 Cloudera Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# End-to-end load generator for the task server. Starts a pre-fork
+# IbisServerNode daemon, stands in for the Impala side it reports to, and
+# drives it from concurrent simulated query fragments (processes), each
+# with its own shared memory segment and IPCLock, running rounds of
+# agg-update, agg-update, agg-merge and agg-finalize tasks on comms tables.
+#
+# Reports throughput, p50/p99 task latency (submission until control comes
+# back) and CPU per task (fragments, daemon and workers) for each worker
+# count and batch size.
+
+from __future__ import print_function
+
+import argparse
+import cPickle
+import os
+import socket
+import struct
+import tempfile
+import time
+
+import numpy as np
+
+import ibis.comms as comms
+from ibis.cloudpickle import dumps as pickle_dump
+from ibis.metrics import format_metrics
+from ibis.server import IbisServerNode, ServerConnection
+from ibis.tasks import (AGG_STATE_NONE, IbisTaskMessage, TASK_CLASS_MISSING,
+                        read_response, write_class_ref)
+import ibis.wire as wire
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+
+TASK_TYPES = ['agg-update', 'agg-merge', 'agg-finalize']
+
+
+class Mean(object):
+
+    def __init__(self):
+        self.total = 0
+        self.count = 0
+
+    def update(self, values):
+        self.total += np.nansum(values)
+        self.count += len(values) - np.isnan(values).sum()
+
+    def merge(self, other):
+        self.total += other.total
+        self.count += other.count
+        return self
+
+    def finalize(self):
+        return self.total / float(self.count)
+
+
+# ---------------------------------------------------------------------
+# Impala stand-in and daemon
+
+
+def start_daemon(workers):
+    """
+    Fork a pre-fork daemon with a fixed pool of workers
+
+    Returns
+    -------
+    pid, port : daemon process id and port
+    """
+    # Takes the place of the Impala server socket the daemon reports to
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1)
+    _, server_port = listener.getsockname()
+
+    pid = os.fork()
+    if pid == 0:
+        listener.close()
+
+        # Keep the daemon's chatter out of the report
+        devnull = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(devnull, 1)
+        try:
+            daemon = IbisServerNode(server_port=server_port, prefork=True,
+                                    min_workers=workers,
+                                    max_workers=workers)
+            daemon.run_daemon()
+        finally:
+            os._exit(0)
+
+    sock, _ = listener.accept()
+    port, = struct.unpack('I', sock.recv(1024))
+    sock.send('ok')
+    sock.close()
+    listener.close()
+
+    # Let the pool fill before measuring anything
+    time.sleep(0.5)
+    return pid, port
+
+
+def stop_daemon(pid, port):
+    conn = ServerConnection(('127.0.0.1', port))
+    conn.shutdown()
+    conn.close()
+    os.waitpid(pid, 0)
+
+
+def server_cpu_seconds(pid):
+    # User and system time of the daemon and its pool workers
+    if psutil is None:
+        return np.nan
+
+    proc = psutil.Process(pid)
+    get_children = getattr(proc, 'children', None) or proc.get_children
+    total = 0
+    for p in [proc] + list(get_children(recursive=True)):
+        try:
+            get_times = getattr(p, 'cpu_times', None) or p.get_cpu_times
+            times = get_times()
+        except psutil.Error:
+            # Exited in the meantime
+            continue
+        total += times.user + times.system
+    return total
+
+
+# ---------------------------------------------------------------------
+# Simulated query fragments
+
+
+class Fragment(object):
+
+    """
+    The Impala side of one query fragment: a shared memory segment and an
+    IPCLock for its tasks, and a connection to the daemon
+    """
+
+    def __init__(self, port, segment_size):
+        self.conn = ServerConnection(('127.0.0.1', port))
+        self.lock = comms.IPCLock(is_slave=0)
+
+        self.path = tempfile.mktemp(prefix='ibis-task-perf-',
+                                    dir=_shm_dir())
+        self.segment_size = segment_size
+        self.mm = comms.SharedMmap(self.path, segment_size, create=True)
+
+        self.uda_pickled = pickle_dump(Mean)
+
+        # task type -> latencies
+        self.timings = dict((kind, []) for kind in TASK_TYPES)
+
+        # Whether this side holds the segment: after each response, until
+        # the next task is submitted
+        self.have_control = False
+
+    def close(self):
+        if self.have_control:
+            self.lock.release()
+        self.conn.close()
+        self.mm.close()
+        os.remove(self.path)
+
+    def run_round(self, table):
+        left = self.update(table)
+        right = self.update(table)
+        _, merged = self.run_task('agg-merge',
+                                  self._header('agg-merge', left, right))
+        self.run_task('agg-finalize', self._header('agg-finalize', merged))
+
+    def update(self, table, include_class=False):
+        writer = wire.PackedMessageWriter()
+        writer.string('agg-update')
+        write_class_ref(writer, self.uda_pickled,
+                        include_pickle=include_class)
+        writer.uint8(AGG_STATE_NONE)
+
+        status, result = self.run_task('agg-update', writer.get_result(),
+                                       table=table)
+        if status == TASK_CLASS_MISSING:
+            # First task for this class in the worker that got it
+            return self.update(table, include_class=True)
+        return result
+
+    def _header(self, kind, *states):
+        writer = wire.PackedMessageWriter()
+        writer.string(kind)
+        for state in states:
+            writer.string(state)
+        return writer.get_result()
+
+    def run_task(self, kind, header, table=None):
+        if self.have_control:
+            # Hand the segment back for the next task
+            self.lock.release()
+
+        self.mm.seek(0)
+        self.mm.write(header)
+        if table is not None:
+            table.write(self.mm)
+
+        task = IbisTaskMessage(self.lock.semaphore_id, self.path, 0,
+                               self.segment_size, stream=True)
+
+        start = time.time()
+        self.conn.submit_task(task)
+        self.lock.acquire()
+        response = read_response(self.mm, self.lock)
+        elapsed = time.time() - start
+        self.have_control = True
+
+        reader = wire.PackedMessageReader(response)
+        status = reader.uint8()
+        if status == TASK_CLASS_MISSING:
+            return status, None
+
+        result = reader.string()
+        if not status:
+            raise Exception('%s failed: %s' % (kind, result))
+
+        self.timings[kind].append(elapsed)
+        return status, result
+
+
+def _shm_dir():
+    if os.path.isdir('/dev/shm'):
+        return '/dev/shm'
+    return None
+
+
+def make_table(batch_size, seed):
+    rng = np.random.RandomState(seed)
+    values = rng.randn(batch_size)
+    values[rng.rand(batch_size) < 0.1] = np.nan
+    return comms.IbisTableWriter([comms.masked_from_pandas(values,
+                                                           'double')])
+
+
+def run_fragment(port, batch_size, rounds, warmup, seed):
+    table = make_table(batch_size, seed)
+
+    # Room for the table and the task header ahead of it, class included
+    fragment = Fragment(port, table.total_size() + 65536)
+    try:
+        for i in range(warmup):
+            fragment.run_round(table)
+        warmup_tasks = sum(len(v) for v in fragment.timings.values())
+        fragment.timings = dict((kind, []) for kind in TASK_TYPES)
+
+        start = time.time()
+        cpu_start = sum(os.times()[:2])
+        for i in range(rounds):
+            fragment.run_round(table)
+        cpu = sum(os.times()[:2]) - cpu_start
+        end = time.time()
+    finally:
+        fragment.close()
+
+    return {'timings': fragment.timings, 'cpu': cpu,
+            'start': start, 'end': end, 'warmup_tasks': warmup_tasks}
+
+
+def run_fragments(port, nfragments, batch_size, rounds, warmup):
+    """
+    Run fragments in parallel processes
+
+    Returns
+    -------
+    results : list of dicts from run_fragment
+    wall : float
+      Seconds from the first fragment done warming up to the last one
+      finishing
+    """
+    pipes = []
+    for i in range(nfragments):
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(read_fd)
+            try:
+                result = run_fragment(port, batch_size, rounds, warmup,
+                                      seed=i)
+                data = cPickle.dumps(result, cPickle.HIGHEST_PROTOCOL)
+            except Exception as e:
+                data = cPickle.dumps(e)
+            with os.fdopen(write_fd, 'wb') as f:
+                f.write(data)
+            os._exit(0)
+
+        os.close(write_fd)
+        pipes.append((pid, read_fd))
+
+    results = []
+    for pid, read_fd in pipes:
+        with os.fdopen(read_fd, 'rb') as f:
+            results.append(cPickle.loads(f.read()))
+        os.waitpid(pid, 0)
+
+    for result in results:
+        if isinstance(result, Exception):
+            raise result
+
+    wall = (max(r['end'] for r in results) -
+            min(r['start'] for r in results))
+    return results, wall
+
+
+# ---------------------------------------------------------------------
+# Reporting
+
+
+HEADER_FORMAT = '%7s %9s %-13s %9s %9s %9s %12s'
+ROW_FORMAT = '%7d %9d %-13s %9.0f %9.3f %9.3f %12s'
+
+
+def print_header():
+    print(HEADER_FORMAT % ('workers', 'batch', 'task', 'tasks/s',
+                           'p50 ms', 'p99 ms', 'cpu/task ms'))
+
+
+def report(workers, batch_size, results, wall, server_cpu, by_type):
+    timings = dict((kind, np.concatenate([r['timings'][kind]
+                                          for r in results]))
+                   for kind in TASK_TYPES)
+    everything = np.concatenate(timings.values())
+
+    # The server's CPU time covers the warmup rounds too
+    ntasks = len(everything)
+    cpu = (sum(r['cpu'] for r in results) / ntasks +
+           server_cpu / (ntasks + sum(r['warmup_tasks'] for r in results)))
+
+    def row(name, values, cpu_per_task):
+        p50, p99 = np.percentile(values * 1000, [50, 99])
+        print(ROW_FORMAT % (workers, batch_size, name, len(values) / wall,
+                            p50, p99, cpu_per_task))
+
+    # CPU time is only measured per process, not per task type
+    row('all', everything, '%.3f' % (cpu * 1000))
+    if by_type:
+        for kind in TASK_TYPES:
+            row(kind, timings[kind], '-')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', default='1,2,4',
+                        help='Comma-separated pool sizes to try')
+    parser.add_argument('--batch-sizes', default='1000,10000,100000',
+                        help='Comma-separated rows per agg-update')
+    parser.add_argument('--fragments', type=int, default=4,
+                        help='Concurrent simulated query fragments')
+    parser.add_argument('--rounds', type=int, default=50,
+                        help='update, update, merge, finalize rounds per '
+                        'fragment')
+    parser.add_argument('--warmup', type=int, default=2,
+                        help='Rounds per fragment left out of the results')
+    parser.add_argument('--by-type', action='store_true',
+                        help='Also report each task type')
+    parser.add_argument('--stats', action='store_true',
+                        help="Dump the daemon's metrics after each worker "
+                        "count")
+    return parser.parse_args()
+
+
+def _int_list(value):
+    return [int(x) for x in value.split(',')]
+
+
+def main():
+    args = parse_args()
+
+    print('%d fragments, %d rounds each (4 tasks per round)'
+          % (args.fragments, args.rounds))
+    if psutil is None:
+        print('psutil is not installed: cpu/task leaves out the server')
+    print_header()
+
+    for workers in _int_list(args.workers):
+        pid, port = start_daemon(workers)
+        try:
+            for batch_size in _int_list(args.batch_sizes):
+                cpu_start = server_cpu_seconds(pid)
+                results, wall = run_fragments(port, args.fragments,
+                                              batch_size, args.rounds,
+                                              args.warmup)
+                server_cpu = server_cpu_seconds(pid) - cpu_start
+                if np.isnan(server_cpu):
+                    server_cpu = 0
+
+                report(workers, batch_size, results, wall, server_cpu,
+                       args.by_type)
+
+            if args.stats:
+                conn = ServerConnection(('127.0.0.1', port))
+                print(format_metrics(conn.stats()))
+                conn.close()
+        finally:
+            stop_daemon(pid, port)
+
+
+if __name__ == '__main__':
+    main()
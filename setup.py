@@ -83,6 +83,9 @@ if COMMS_EXT_ENABLED:
         # though.
         comms_ext_libraries.append('uuid')
 
+        # shm_open / shm_unlink
+        comms_ext_libraries.append('rt')
+
     comms_ext = Extension('ibis.comms',
                           ['ibis/comms.pyx',
                            'ibis/src/ipc_support.c'],